@@ -11,10 +11,42 @@ Created on Tue Dec 10 10:43:03 2024
 
 
 
+import argparse
+import ast
+import asyncio
+import bisect
+import collections
+import contextlib
 import csv
-from datetime import datetime
+import heapq
+import os
+from datetime import datetime, timedelta
 from colorama import Fore, Style, init
+try:
+    import numpy as np  # Opcional: avaluació vectoritzada de llindars
+except ImportError:
+    np = None
+import itertools
 import json  # Afegir per treballar amb JSON
+import math
+import multiprocessing
+import queue
+import random
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import Future, wait
+try:
+    import fcntl  # Bloquejos de fitxer entre processos (POSIX)
+except ImportError:
+    fcntl = None
+    import msvcrt  # Windows
+try:
+    import resource  # Memòria màxima dels processos per al simulador (no disponible a Windows)
+except ImportError:
+    resource = None
 
 # Inicialitzar colorama
 init(autoreset=True)
@@ -50,6 +82,48 @@ def is_valid_time(time_str):
     except ValueError:
         return False
 
+# ------------------ Codecs ------------------
+
+def _decode_date(text):
+    # La forma ISO (YYYY-MM-DD) es llegeix sense strptime, que és molt més lent;
+    # les dates escrites amb format_date (DD-MMM-YYYY) també s'accepten
+    text = text.strip()
+    try:
+        return datetime.fromisoformat(text).date()
+    except ValueError:
+        return datetime.strptime(text, "%d-%b-%Y").date()
+
+
+def _decode_string_list(text):
+    # Llista com a text: "['a', 'b']" / '["a", "b"]' o bé "a, b"
+    items = ast.literal_eval(text) if text.startswith("[") else text.split(",")
+    return [str(item).strip() for item in items if str(item).strip()]
+
+
+# Codecs de columna: nom -> (descodificador del text del CSV, codificador cap al CSV).
+# Una cel·la buida sempre es llegeix com None (o llista buida).
+COLUMN_CODECS = {
+    "str": (lambda text: text, lambda value: value),
+    "int": (lambda text: int(text) if text else None, lambda value: value),
+    "float": (lambda text: float(text) if text else None, lambda value: value),
+    "date": (lambda text: _decode_date(text) if text else None,
+             lambda value: value.isoformat() if hasattr(value, "isoformat") else value),
+    "json": (lambda text: json.loads(text) if text else None, json.dumps),
+    "pyliteral": (lambda text: ast.literal_eval(text) if text else [], repr),
+    "strlist": (lambda text: _decode_string_list(text) if text else [], json.dumps),
+}
+
+
+def _sniff_json(text):
+    """Descodificador per a taules sense esquema: intenta convertir camps que semblen JSON."""
+    if text.startswith("{") or text.startswith("["):  # Comprova si és JSON
+        try:
+            return json.loads(text)
+        except json.JSONDecodeError:
+            pass
+    return text
+
+
 # ------------------ Singleton ------------------
 
 class User:
@@ -80,6 +154,189 @@ class Familiar(User):
 
 
 
+class WriteAheadLog:
+    """
+    Registre d'escriptura anticipada d'una taula CSV: una fila JSON per línia.
+    Les escriptures que arriben mentre es fa un fsync s'agrupen i es confirmen
+    totes amb el següent (group commit). Amb `read_only` només es llegeix el
+    registre que escriu un altre procés (p. ex. als processos de fragment).
+    Les escriptures i la compactació es fan amb <fitxer>.wal.lock bloquejat,
+    perquè el menú i el servidor poden compartir el mateix registre.
+    """
+
+    def __init__(self, path, commit_delay=0.0, read_only=False):
+        self.path = path
+        self.commit_delay = commit_delay  # Espera opcional per agrupar més escriptures
+        self.read_only = read_only
+        self.lock_path = path + ".lock"
+        self.commits = 0
+        self.records = 0
+        self.io_lock = threading.Lock()  # Exclou escriptures mentre es compacta
+        self._cond = threading.Condition()
+        self._pending = []
+        self._closed = read_only
+        self._file, self._thread = None, None
+        if not read_only:
+            self._file = open(path, mode='a', encoding='utf-8')
+            self._thread = threading.Thread(target=self._run, name=f"wal-{os.path.basename(path)}", daemon=True)
+            self._thread.start()
+
+    def append(self, rows):
+        """Escriu les files al registre i no retorna fins que són al disc (fsync)."""
+        waiter = {"done": threading.Event(), "error": None, "count": len(rows),
+                  "data": "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows)}
+        with self._cond:
+            if self._closed:
+                raise ValueError(f"El registre {self.path} està tancat o és només de lectura.")
+            self._pending.append(waiter)
+            self._cond.notify()
+        waiter["done"].wait()
+        if waiter["error"]:
+            raise waiter["error"]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+            if self.commit_delay:
+                time.sleep(self.commit_delay)
+            with self._cond:
+                batch, self._pending = self._pending, []
+            error = None
+            with self.io_lock, _process_lock(self.lock_path):
+                try:
+                    self._file.write("".join(w["data"] for w in batch))
+                    self._file.flush()
+                    os.fsync(self._file.fileno())
+                    self.commits += 1
+                    self.records += sum(w["count"] for w in batch)
+                except OSError as e:
+                    error = e
+            for waiter in batch:
+                waiter["error"] = error
+                waiter["done"].set()
+
+    def replay(self):
+        """Retorna les files confirmades. Una última línia incompleta (escriptura tallada) s'ignora."""
+        rows = []
+        try:
+            with open(self.path, mode='r', encoding='utf-8') as file:
+                for line in file:
+                    if not line.endswith("\n"):
+                        break
+                    try:
+                        rows.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        break
+        except FileNotFoundError:
+            pass
+        return rows
+
+    def stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return (0, 0)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def size(self):
+        return self.stamp()[1]
+
+    def truncate(self):
+        """Buida el registre un cop el seu contingut ja és a la instantània CSV (cal tenir els bloquejos)."""
+        self._file.truncate(0)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        if self.read_only:
+            return
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self._file.close()
+
+
+@contextlib.contextmanager
+def _process_lock(path):
+    """Bloqueig exclusiu sobre el fitxer `path` (es crea si cal), compartit entre processos i fils."""
+    with open(path, mode='a+b') as file:
+        if fcntl is not None:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        else:
+            file.seek(0)
+            msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+            else:
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class IDSequence:
+    """
+    Seqüència persistent d'identificadors d'una taula (<fitxer>.seq). Guarda
+    l'últim ID lliurat, de manera que obtenir-ne un de nou és O(1) i no cal
+    llegir la taula. Cada avanç es fa amb el fitxer bloquejat (<fitxer>.seq.lock)
+    i rellegint-lo, perquè diversos processos (el menú, el servidor, la tasca
+    de recordatoris) no lliurin el mateix ID, i es desa de forma atòmica.
+    """
+
+    def __init__(self, path, initial_value=0):
+        self.path = path
+        self._lock = threading.Lock()
+        with _process_lock(path + ".lock"):
+            if not os.path.exists(path):
+                self._save(initial_value() if callable(initial_value) else initial_value)
+            self._last = self._read()
+
+    def _read(self):
+        with open(self.path, mode='r', encoding='utf-8') as file:
+            return int(file.read().strip() or 0)
+
+    def _save(self, value):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, mode='w', encoding='utf-8') as file:
+            file.write(str(value))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.path)
+
+    def next(self):
+        """Retorna el següent ID."""
+        return self.reserve(1)[0]
+
+    def reserve(self, count):
+        """Reserva un bloc de `count` IDs consecutius (p. ex. per a importacions massives)."""
+        with self._lock, _process_lock(self.path + ".lock"):
+            first = self._read() + 1
+            self._save(first + count - 1)
+            self._last = first + count - 1
+        return range(first, first + count)
+
+    @property
+    def last(self):
+        return self._last
+
+
+def _fsync_directory(path):
+    """Assegura que un os.replace dins del directori és persistent (no disponible a Windows)."""
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
 class CSVManager:
     _instances = {}
 
@@ -87,57 +344,1713 @@ class CSVManager:
         if file_path not in cls._instances:
             instance = super().__new__(cls)
             instance.file_path = file_path
+            instance._fieldnames = None  # Capçalera actual del fitxer
+            instance._row_keys = None  # Claus de les files ja escrites (per evitar duplicats)
+            instance._cache = None  # Còpia en memòria de les files vives: {clau primària (o posició): fila}
+            instance._primary_key = None
+            instance._dead_rows = 0  # Versions antigues d'una clau primària que encara són al fitxer
+            instance._stamp = None  # (mtime, mida) del fitxer quan es va omplir la memòria cau
+            instance.hits = 0
+            instance.misses = 0
+            instance._indexes = {}  # columna -> {valor: [files]}
+            instance._lock = threading.RLock()
+            instance._generation = 0  # Augmenta cada cop que la memòria cau es torna a omplir
+            instance._wal = None
+            instance._compactor = None
+            instance._sequence = None
+            instance._schema = None  # {columna: nom del codec}; sense esquema es manté la detecció de JSON
+            instance.decode_errors = 0
             cls._instances[file_path] = instance
         return cls._instances[file_path]
-    
-    def read(self):
+
+    def __init__(self, file_path, indexes=(), primary_key=None, schema=None):
+        if primary_key is not None and primary_key != self._primary_key:
+            self._primary_key = primary_key
+            self.invalidate()
+        if schema is not None and schema != self._schema:
+            unknown = set(schema.values()) - set(COLUMN_CODECS)
+            if unknown:
+                raise ValueError(f"Codecs desconeguts per {file_path}: {', '.join(sorted(unknown))}")
+            self._schema = dict(schema)
+            self.invalidate()
+        for column in indexes:
+            self.create_index(column)
+
+    def _file_stamp(self):
+        """Retorna (mtime, mida) del fitxer (i del seu registre WAL), o None si no existeix."""
         try:
-            with open(self.file_path, mode='r', encoding='utf-8') as file:
-                data = list(csv.DictReader(file))
-                for row in data:
-                    # Converteix camps JSON de nou als seus tipus originals
-                    for key, value in row.items():
-                        if value.startswith("{") or value.startswith("["):  # Comprova si és JSON
-                            try:
-                                row[key] = json.loads(value)
-                            except json.JSONDecodeError:
-                                pass
-                return data
+            stat = os.stat(self.file_path)
         except FileNotFoundError:
-            print(f"El fitxer {self.file_path} no existeix.")
+            return None
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if self._wal is not None:
+            stamp += self._wal.stamp()
+        return stamp
+
+    def _is_fresh(self):
+        """Indica si la memòria cau correspon encara al contingut del fitxer."""
+        return self._cache is not None and self._stamp == self._file_stamp()
+
+    def invalidate(self):
+        """Descarta la memòria cau; la propera lectura tornarà a llegir el fitxer."""
+        self._fieldnames, self._row_keys, self._cache, self._stamp = None, None, None, None
+        self._dead_rows = 0
+        self._indexes = dict.fromkeys(self._indexes)
+
+    def _decoders(self, fieldnames):
+        """Compila (un cop per capçalera) el descodificador de cada columna."""
+        if self._schema is None:
+            return [_sniff_json] * len(fieldnames)
+        plain = COLUMN_CODECS["str"][0]
+        return [COLUMN_CODECS[self._schema[name]][0] if name in self._schema else plain for name in fieldnames]
+
+    def _decode_values(self, fieldnames, decoders, values):
+        """Converteix una fila de textos als tipus declarats."""
+        try:
+            return {name: decode(value) for name, decode, value in zip(fieldnames, decoders, values)}
+        except (ValueError, SyntaxError, TypeError):
+            # Dades antigues que no segueixen l'esquema: es conserva el text de les cel·les errònies
+            self.decode_errors += 1
+            row = {}
+            for name, decode, value in zip(fieldnames, decoders, values):
+                try:
+                    row[name] = decode(value)
+                except (ValueError, SyntaxError, TypeError):
+                    row[name] = value
+            return row
+
+    def _scan(self):
+        """
+        Genera la capçalera i després cada fila (llista de textos) del CSV,
+        seguides de les files confirmades al registre WAL que encara no s'hi han bolcat.
+        """
+        try:
+            file = open(self.file_path, mode='r', newline='', encoding='utf-8')
+        except FileNotFoundError:
+            return
+        with file:
+            reader = csv.reader(file)
+            fieldnames = next(reader, None)
+            if not fieldnames:
+                return
+            yield fieldnames
+            width = len(fieldnames)
+            for values in reader:
+                yield (values + [""] * width)[:width]
+        if self._wal is not None:
+            for row in self._wal.replay():
+                yield list(self._row_key(row, fieldnames))
+
+    def _load(self):
+        """Llegeix el fitxer una vegada i omple la capçalera, les claus i la memòria cau."""
+        with self._lock:
+            if self._is_fresh():
+                self.hits += 1
+                return
+            self.misses += 1
+            self.invalidate()
+            self._generation += 1
+            stamp = self._file_stamp()
+            scan = self._scan()
+            self._fieldnames, self._row_keys, self._cache = next(scan, None), set(), {}
+            decoders = self._decoders(self._fieldnames or [])
+            for values in scan:
+                self._row_keys.add(tuple(values))
+                self._put(self._decode_values(self._fieldnames, decoders, values))
+            self._stamp = stamp
+            for column in self._indexes:
+                self._build_index(column)
+
+    def _put(self, row):
+        """
+        Desa una fila a la memòria cau. Amb clau primària, la fila substitueix la
+        versió anterior de la mateixa clau (la darrera escrita és la vigent).
+        """
+        if self._primary_key is None:
+            self._cache[len(self._cache)] = row
+            return None
+        key = self._index_key(row.get(self._primary_key))
+        previous = self._cache.get(key)
+        if previous is not None:
+            self._dead_rows += 1
+        self._cache[key] = row
+        return previous
+
+    def read(self):
+        """
+        Retorna les files del fitxer. Mentre el fitxer no canviï (mtime i mida)
+        es reutilitza la còpia en memòria; les files es comparteixen amb la
+        memòria cau i no s'han de modificar.
+        """
+        try:
+            if self._file_stamp() is None:
+                print(f"El fitxer {self.file_path} no existeix.")
+                return []
+            self._load()
+            return list(self._cache.values())
+        except Exception as e:
+            self.invalidate()
+            print(f"Error en llegir {self.file_path}: {e}")
             return []
+
+    def iter_rows(self, columns=None):
+        """
+        Recorre les files una a una, amb memòria constant. Si la memòria cau és
+        vàlida s'hi itera directament; si no, es llegeix el fitxer en streaming
+        sense omplir-la. `columns` limita les columnes que es converteixen i es
+        retornen; les que la taula no té es retornen buides (""), tant des de la
+        memòria cau com en streaming. Es pot aturar en qualsevol moment (p. ex.
+        amb `next()` o `break`). En streaming, una taula amb clau primària pot retornar versions antigues
+        d'una fila abans de la vigent.
+        """
+        if self._is_fresh():
+            self.hits += 1
+            for row in list(self._cache.values()):
+                yield row if columns is None else {c: row.get(c, "") for c in columns}
+            return
+        if self._file_stamp() is None:
+            print(f"El fitxer {self.file_path} no existeix.")
+            return
+        scan = self._scan()
+        fieldnames = next(scan, None) or []
+        names = [c for c in (columns or fieldnames) if c in fieldnames]
+        positions = [fieldnames.index(c) for c in names]
+        decoders = self._decoders(names)
+        missing = [c for c in columns or () if c not in fieldnames]
+        for values in scan:
+            row = self._decode_values(names, decoders, [values[i] for i in positions])
+            yield {c: row.get(c, "") for c in columns} if missing else row
+
+    def version(self):
+        """Identificador de la versió actual del fitxer; canvia amb qualsevol escriptura."""
+        return self._file_stamp()
+
+    def cache_stats(self):
+        """Encerts i errades de la memòria cau d'aquest fitxer."""
+        return {"hits": self.hits, "misses": self.misses,
+                "rows": len(self._cache) if self._cache is not None else 0,
+                "dead_rows": self._dead_rows, "decode_errors": self.decode_errors}
+
+    def _encode_row(self, row):
+        """Converteix una fila al text que es desa al CSV segons l'esquema de la taula."""
+        if self._schema is None:
+            # Converteix qualsevol estructura no hashable a JSON
+            return {k: (json.dumps(v) if isinstance(v, (dict, list)) else v) for k, v in row.items()}
+        encoded = {}
+        for k, v in row.items():
+            if v is None or isinstance(v, str):
+                encoded[k] = v
+            elif k in self._schema:
+                encoded[k] = COLUMN_CODECS[self._schema[k]][1](v)
+            else:
+                encoded[k] = json.dumps(v) if isinstance(v, (dict, list)) else v
+        return encoded
+
+    @staticmethod
+    def _row_key(row, fieldnames):
+        """Clau d'una fila tal com quedaria escrita al CSV (tot text, buit per None)."""
+        return tuple("" if row.get(name) is None else str(row.get(name)) for name in fieldnames)
+
+    def _load_state(self):
+        """Retorna la capçalera i les claus de les files existents."""
+        self._load()
+        return self._fieldnames, self._row_keys
+
+    def _remember(self, header, rows, generation=None):
+        """Afegeix a la memòria cau (i als índexs) les files que aquest gestor acaba d'escriure."""
+        if self._cache is None or (generation is not None and generation != self._generation):
+            # La memòria cau s'ha tornat a llegir mentrestant: la propera lectura ja les inclourà
+            self.invalidate()
+            return
+        self._fieldnames = header
+        decoders = self._decoders(header)
+        for row in rows:
+            key = self._row_key(row, header)
+            self._row_keys.add(key)
+            decoded = self._decode_values(header, decoders, key)
+            previous = self._put(decoded)
+            for column, index in self._indexes.items():
+                if index is not None:
+                    if previous is not None:
+                        index[self._index_key(previous.get(column))].remove(previous)
+                    index.setdefault(self._index_key(decoded.get(column)), []).append(decoded)
+        self._stamp = self._file_stamp()
+
+    # ------------------ Índexs ------------------
+
+    def create_index(self, column):
+        """Declara un índex hash sobre `column`; es manté al dia a cada escriptura."""
+        if column not in self._indexes:
+            self._indexes[column] = None
+            if self._cache is not None:
+                self._build_index(column)
+
+    def _build_index(self, column):
+        index = {}
+        for row in self._cache.values():
+            index.setdefault(self._index_key(row.get(column)), []).append(row)
+        self._indexes[column] = index
+
+    @staticmethod
+    def _index_key(value):
+        """Valor d'una cel·la tal com apareix al CSV, per poder-lo fer servir de clau."""
+        if value is None:
+            return ""
+        return json.dumps(value) if isinstance(value, (dict, list)) else str(value)
+
+    def find(self, column, value):
+        """Retorna les files on `column` == `value` (O(1) si la columna té índex)."""
+        try:
+            if self._file_stamp() is None:
+                return []
+            self._load()
         except Exception as e:
+            self.invalidate()
             print(f"Error en llegir {self.file_path}: {e}")
             return []
+        value = self._index_key(value)
+        if column in self._indexes:
+            return list(self._indexes[column].get(value, []))
+        if column == self._primary_key:
+            row = self._cache.get(value)
+            return [row] if row is not None else []
+        return [row for row in self._cache.values() if self._index_key(row.get(column)) == value]
+
+    def find_one(self, column, value):
+        """
+        Retorna la primera fila on `column` == `value`, o None. Sense índex
+        es recorre el fitxer en streaming i s'atura al primer resultat.
+        """
+        if column in self._indexes or column == self._primary_key:
+            rows = self.find(column, value)
+            return rows[0] if rows else None
+        value = self._index_key(value)
+        return next((row for row in self.iter_rows() if self._index_key(row.get(column)) == value), None)
 
+    def append(self, fieldnames, rows):
+        """
+        Afegeix files al final del fitxer sense llegir ni reescriure les existents.
+        Si el fitxer no existeix es crea amb la capçalera `fieldnames`. Amb el
+        registre WAL actiu, les files es confirmen al registre (fsync compartit).
+        """
+        rows = [self._encode_row(row) for row in rows]
+        if not rows:
+            return
+        try:
+            with self._lock:
+                header, _ = self._load_state()
+                if not header:
+                    header = list(fieldnames)
+                    for row in rows:
+                        header += [k for k in row if k not in header]
+                    if self._wal is not None:
+                        # La capçalera va a la instantània; les files, al registre
+                        self._replace_file(header, [])
+                        self._fieldnames = header
+                    else:
+                        with open(self.file_path, mode='w', newline='', encoding='utf-8') as file:
+                            writer = csv.DictWriter(file, fieldnames=header)
+                            writer.writeheader()
+                            writer.writerows(rows)
+                        self._remember(header, rows)
+                        return
+                extra = [k for row in rows for k in row if k not in header]
+                if extra:
+                    # Columnes noves: cal reescriure la capçalera (compactació)
+                    self.compact(header + list(dict.fromkeys(extra)), rows)
+                    return
+                if self._wal is None:
+                    missing_newline = self._missing_newline()
+                    with open(self.file_path, mode='a', newline='', encoding='utf-8') as file:
+                        if missing_newline:
+                            # Fitxer editat a mà sense salt final: la fila nova no s'ha d'enganxar a l'última
+                            file.write("\r\n")
+                        writer = csv.DictWriter(file, fieldnames=header)
+                        writer.writerows(rows)
+                    self._remember(header, rows)
+                    return
+                generation = self._generation
+            # Fora del bloqueig, perquè diversos fils comparteixin el mateix fsync
+            self._wal.append(rows)
+            with self._lock:
+                self._remember(header, rows, generation)
+        except Exception as e:
+            self.invalidate()
+            print(f"Error en escriure a {self.file_path}: {e}")
+
+    def _missing_newline(self):
+        """Indica si el fitxer no acaba amb un salt de línia."""
+        with open(self.file_path, mode='rb') as file:
+            file.seek(0, os.SEEK_END)
+            if file.tell() == 0:
+                return False
+            file.seek(-1, os.SEEK_END)
+            return file.read(1) not in (b"\n", b"\r")
 
-    
     def write(self, fieldnames, data):
+        """
+        Desa les files de `data` afegint-les al final del fitxer; mai el reescriu sencer.
+        Sense clau primària, les files repetides s'ignoren. Amb clau primària, cada fila
+        és un upsert: substitueix la versió anterior de la seva clau (si ha canviat) i,
+        quan les versions antigues superen les vives, el fitxer es compacta.
+        """
+        header, keys = self._load_state()
+        header = header or list(fieldnames)
+        new_rows, seen = [], set()
+        for row in data:
+            row = self._encode_row(row)
+            key = self._row_key(row, header)
+            if self._primary_key is not None:
+                current = self._cache.get(self._index_key(row.get(self._primary_key)))
+                if current is not None and self._row_key(self._encode_row(current), header) == key:
+                    continue
+            elif key in keys or key in seen:
+                continue
+            seen.add(key)
+            new_rows.append(row)
+        self.append(fieldnames, new_rows)
+        if self._primary_key is not None and self._cache is not None and self._dead_rows > len(self._cache):
+            self.compact()
+
+    def compact(self, fieldnames=None, extra_rows=()):
+        """
+        Reescriu el fitxer sencer eliminant les files duplicades (o les versions
+        antigues de cada clau primària) i bolcant-hi el registre WAL. És l'única
+        operació que fa una reescriptura completa; s'escriu en un fitxer temporal
+        i es substitueix de manera atòmica. Amb registre WAL, tot es fa amb el
+        bloqueig entre processos: cap altre procés hi pot afegir files entre la
+        lectura i el buidatge.
+        """
         try:
-            # Llegeix les dades existents
-            existing_data = self.read()
-    
-            # Combina les dades existents amb les noves, evitant duplicats
-            combined_data = {}
-            for row in existing_data:
-                # Converteix qualsevol estructura no hashable a JSON
-                row = {k: (json.dumps(v) if isinstance(v, (dict, list)) else v) for k, v in row.items()}
-                combined_data[tuple(row.items())] = row
-            for new_row in data:
-                # Converteix qualsevol estructura no hashable a JSON
-                new_row = {k: (json.dumps(v) if isinstance(v, (dict, list)) else v) for k, v in new_row.items()}
-                combined_data[tuple(new_row.items())] = new_row
-    
-            # Escriu totes les dades al fitxer
-            with open(self.file_path, mode='w', newline='', encoding='utf-8') as file:
-                writer = csv.DictWriter(file, fieldnames=fieldnames)
-                writer.writeheader()
-                writer.writerows(combined_data.values())
+            if self._wal is not None and self._wal.read_only:
+                raise ValueError("el registre WAL és d'un altre procés (només lectura)")
+            with contextlib.ExitStack() as stack:
+                stack.enter_context(self._lock)
+                if self._wal is not None:
+                    stack.enter_context(self._wal.io_lock)
+                    stack.enter_context(_process_lock(self._wal.lock_path))
+                scan = self._scan()
+                header = next(scan, None) or []
+                combined_data = {}
+                new_header = list(fieldnames or header)
+                for row in itertools.chain((dict(zip(header, values)) for values in scan),
+                                           (self._encode_row(row) for row in extra_rows)):
+                    if self._primary_key is not None:
+                        # Només es conserva la darrera versió de cada clau primària
+                        combined_data.pop(self._index_key(row.get(self._primary_key)), None)
+                        combined_data[self._index_key(row.get(self._primary_key))] = row
+                    else:
+                        combined_data[self._row_key(row, new_header)] = row
+                self._replace_file(new_header, combined_data.values())
+                if self._wal is not None:
+                    self._wal.truncate()
+                self.invalidate()
         except Exception as e:
-            print(f"Error en escriure a {self.file_path}: {e}")
+            print(f"Error en compactar {self.file_path}: {e}")
+
+    def _replace_file(self, fieldnames, rows):
+        """Escriu una nova instantània del fitxer de manera atòmica i persistent."""
+        tmp_path = self.file_path + ".tmp"
+        with open(tmp_path, mode='w', newline='', encoding='utf-8') as file:
+            writer = csv.DictWriter(file, fieldnames=fieldnames, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(rows)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.file_path)
+        _fsync_directory(self.file_path)
+
+    # ------------------ Seqüència d'IDs ------------------
+
+    def _id_sequence(self):
+        with self._lock:
+            if self._sequence is None:
+                if self._primary_key is None:
+                    raise ValueError(f"La taula {self.file_path} no té clau primària per generar IDs.")
+                # Només la primera vegada: es parteix del valor més alt que ja hi ha a la taula
+                self._sequence = IDSequence(self.file_path + ".seq", lambda: max(
+                    (int(row[self._primary_key]) for row in self.iter_rows(columns=(self._primary_key,))
+                     if str(row[self._primary_key]).isdigit()), default=0) if self.version() else 0)
+            return self._sequence
+
+    def next_id(self):
+        """Retorna un ID nou per a la clau primària sense llegir la taula."""
+        return self._id_sequence().next()
+
+    def reserve_ids(self, count):
+        """Reserva `count` IDs consecutius; retorna un `range`."""
+        return self._id_sequence().reserve(count)
+
+    # ------------------ Registre WAL ------------------
+
+    def enable_wal(self, compact_interval=30.0, compact_min_bytes=1 << 20, commit_delay=0.0, read_only=False):
+        """
+        Activa el registre d'escriptura anticipada (<fitxer>.wal). Si el registre
+        conté files d'una execució anterior es bolquen al CSV (replay). Un fil en
+        segon pla compacta el registre cada `compact_interval` segons si supera
+        `compact_min_bytes`. Amb `read_only` les lectures inclouen el registre que
+        manté un altre procés, però aquest gestor no hi escriu ni el compacta.
+        """
+        with self._lock:
+            if self._wal is not None:
+                return
+            self._wal = WriteAheadLog(self.file_path + ".wal", commit_delay, read_only)
+            self.invalidate()
+            if read_only:
+                return
+            if self._wal.size() > 0:
+                self.compact()
+            self._compactor = threading.Event()
+        threading.Thread(
+            target=self._compact_periodically, args=(self._compactor, compact_interval, compact_min_bytes),
+            name=f"compactor-{os.path.basename(self.file_path)}", daemon=True
+        ).start()
+
+    def _compact_periodically(self, stop, interval, min_bytes):
+        while not stop.wait(interval):
+            if self._wal is not None and self._wal.size() >= min_bytes:
+                self.compact()
+
+    def close(self):
+        """Atura la compactació en segon pla, bolca el registre WAL i el tanca."""
+        with self._lock:
+            if self._wal is None:
+                return
+            if not self._wal.read_only:
+                self._compactor.set()
+                self.compact()
+            self._wal.close()
+            self._wal, self._compactor = None, None
+            self.invalidate()
+
+
+# ------------------ Measurement store ------------------
+
+class MeasurementStore:
+    """
+    Magatzem de mesures de constants vitals particionat per usuari i per dia:
+    <base_dir>/<user_id>/<YYYY-MM-DD>.csv amb les columnes constant, value i timestamp.
+    Les consultes per rang de temps només obren les particions del rang demanat.
+    Amb `aggregates` (RollingAggregates) cada mesura desada actualitza també els
+    agregats per finestres de temps de l'usuari.
+
+    Retenció per nivells: les mesures en brut es guarden `retention["raw"]` dies;
+    després es resumeixen per minut (<user_id>/minute/<dia>.csv) i, passats
+    `retention["minute"]` dies, per hora (<user_id>/hour/<dia>.csv), amb recompte,
+    mínim, màxim i mitjana. Les consultes combinen tots els nivells que existeixen
+    per a cada dia (una mesura endarrerida d'un dia ja resumit torna a crear-ne
+    la partició en brut fins a la propera compactació).
+    """
+    FIELDNAMES = ["constant", "value", "timestamp"]
+    ROLLUP_FIELDNAMES = ["constant", "timestamp", "count", "min", "max", "mean"]
+    # nivell -> (nivell d'origen, amplada de la cubeta en segons)
+    TIERS = {"minute": ("raw", 60), "hour": ("minute", 3600)}
+    RETENTION = {"raw": 8, "minute": 90}  # Dies que es conserva cada nivell abans de resumir-lo
+
+    def __init__(self, base_dir, aggregates=None, retention=None):
+        self.base_dir = base_dir
+        self.aggregates = aggregates
+        self.retention = {**self.RETENTION, **(retention or {})}
+        self._partitions = set()  # Particions amb el directori ja creat
+        # Usuaris amb els agregats ja carregats des del disc -> {partició: mida que hi està comptada}
+        self._warmed = {}
+        self._lock = threading.RLock()
+        self._compactor = None
+
+    def _user_dir(self, user_id):
+        return os.path.join(self.base_dir, str(user_id))
+
+    def _partition_path(self, user_id, day, tier="raw"):
+        directory = self._user_dir(user_id) if tier == "raw" else os.path.join(self._user_dir(user_id), tier)
+        return os.path.join(directory, f"{day.isoformat()}.csv")
+
+    @staticmethod
+    def _to_datetime(timestamp):
+        """Moment d'una mesura com a hora local sense zona (les dates amb zona, p. ex. "...Z", s'hi converteixen)."""
+        moment = timestamp if isinstance(timestamp, datetime) else datetime.fromisoformat(timestamp)
+        return moment.astimezone().replace(tzinfo=None) if moment.tzinfo is not None else moment
+
+    def append(self, user_id, constant, value, timestamp):
+        """Desa una sola mesura a la partició del seu dia."""
+        self.append_many([(user_id, constant, value, timestamp)])
+
+    def append_many(self, measurements):
+        """
+        Desa una llista de tuples (user_id, constant, value, timestamp).
+        Les mesures s'agrupen per partició i cada partició s'obre un sol cop.
+        """
+        partitions, added = {}, []
+        for user_id, constant, value, timestamp in measurements:
+            moment = self._to_datetime(timestamp)
+            partitions.setdefault((str(user_id), moment.date()), []).append(
+                {"constant": constant, "value": float(value), "timestamp": moment.isoformat()}
+            )
+            added.append((str(user_id), constant, float(value), moment))
+        if self.aggregates is not None:
+            # Els agregats d'un usuari es carreguen del disc abans d'escriure-hi mesures noves
+            for user_id in {user_id for user_id, _ in partitions}:
+                self._warm(user_id)
+        with self._lock:
+            for (user_id, day), rows in partitions.items():
+                path = self._partition_path(user_id, day)
+                if path not in self._partitions:
+                    os.makedirs(self._user_dir(user_id), exist_ok=True)
+                    self._partitions.add(path)
+                with open(path, mode='a', newline='', encoding='utf-8') as file:
+                    size = file.tell()
+                    stamps = self._warmed.get(user_id)
+                    if stamps is not None:
+                        # Les particions només creixen: si no fan la mida coneguda, un altre procés
+                        # hi ha escrit des de la darrera vegada i els agregats han quedat antics
+                        fresh = stamps.get(path, 0) == size
+                    writer = csv.DictWriter(file, fieldnames=self.FIELDNAMES)
+                    if size == 0:
+                        # Partició nova (o que la compactació d'un altre procés acaba d'esborrar)
+                        writer.writeheader()
+                    writer.writerows(rows)
+                    if stamps is not None:
+                        stamps[path] = file.tell() if fresh else None
+        if self.aggregates is not None:
+            for user_id, constant, value, moment in added:
+                self.aggregates.add(user_id, constant, value, moment)
+        return len(added)
+
+    def _warm_stamps(self, user_id):
+        """Mida de les particions en brut de l'usuari dins de la finestra més llarga."""
+        now = datetime.now()
+        day = (now - timedelta(seconds=self.aggregates.horizon())).date()
+        stamps = {}
+        while day <= now.date():
+            path = self._partition_path(user_id, day)
+            try:
+                stamps[path] = os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+            day += timedelta(days=1)
+        return stamps
+
+    def _warm(self, user_id):
+        """Carrega als agregats les mesures desades de l'usuari dins de la finestra més llarga."""
+        user_id = str(user_id)
+        if user_id in self._warmed:
+            return
+        self._warmed[user_id] = self._warm_stamps(user_id)
+        for row in self.last_hours(user_id, hours=self.aggregates.horizon() / 3600):
+            self.aggregates.add(user_id, row["constant"], row["value"], row["timestamp"])
+
+    def summary(self, user_id, now=None):
+        """
+        Resum agregat per constant de l'usuari (vegeu RollingAggregates.summary).
+        Si un altre procés (p. ex. el servidor d'ingesta) ha escrit a les particions
+        de la finestra, els agregats es tornen a carregar del disc.
+        """
+        user_id = str(user_id)
+        with self._lock:
+            known = self._warmed.get(user_id)
+            if known is not None and any(known.get(path) != stamp
+                                         for path, stamp in self._warm_stamps(user_id).items()):
+                del self._warmed[user_id]
+                self.aggregates.forget(user_id)
+        self._warm(user_id)
+        return self.aggregates.summary(user_id, now)
+
+    def _tier_days(self, user_id, tier="raw", suffix=".csv"):
+        """Dies amb partició (o amb un fitxer acabat en `suffix`) del nivell indicat."""
+        directory = self._user_dir(user_id) if tier == "raw" else os.path.join(self._user_dir(user_id), tier)
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return set()
+        return {datetime.strptime(name[:-len(suffix)], "%Y-%m-%d").date() for name in names if name.endswith(suffix)}
+
+    def _days(self, user_id, start, end):
+        """
+        Dies del rang [start, end] que cal llegir. Amb els dos límits es recorren les
+        dates del rang (els noms de les particions de cada nivell són coneguts i les
+        que no existeixen es descarten en llegir-les), de manera que el cost depèn
+        del rang i no de tot l'historial; si en falta algun, es llisten les particions.
+        """
+        if start is not None and end is not None:
+            if not os.path.isdir(self._user_dir(user_id)):
+                return []
+            return [start.date() + timedelta(days=offset) for offset in range((end.date() - start.date()).days + 1)]
+        days = set()
+        for tier in ("raw", *self.TIERS):
+            days |= self._tier_days(user_id, tier)
+        return [d for d in sorted(days) if (start is None or d >= start.date()) and (end is None or d <= end.date())]
+
+    def _read_partition(self, path):
+        """Files de la partició, o None si no existeix."""
+        try:
+            with open(path, mode='r', newline='', encoding='utf-8') as file:
+                return list(csv.DictReader(file))
+        except FileNotFoundError:
+            return None
+
+    def _read_day(self, user_id, day):
+        """
+        Llegeix totes les particions del dia (de la més resumida a la més detallada) i
+        retorna parelles (nivell, files). Es llegeixen amb el bloqueig de la compactació
+        perquè cap mesura es compti dues vegades ni es perdi mentre es resumeix.
+        """
+        levels = []
+        with self._lock:
+            for level in (*reversed(self.TIERS), "raw"):
+                rows = self._read_partition(self._partition_path(user_id, day, level))
+                if rows:
+                    levels.append((level, rows))
+        return levels
+
+    def query(self, user_id, constant=None, start=None, end=None):
+        """
+        Retorna les mesures de l'usuari (opcionalment d'una constant) entre
+        `start` i `end`, ordenades per partició. Només s'obren les particions dels dies del rang.
+        Els dies ja resumits retornen una fila per cubeta amb `value` igual a la
+        mitjana i les columnes `count`, `min` i `max`.
+        """
+        start = self._to_datetime(start) if start else None
+        end = self._to_datetime(end) if end else None
+        results = []
+        for day in self._days(user_id, start, end):
+            day_results, levels = [], self._read_day(user_id, day)
+            for tier, rows in levels:
+                for row in rows:
+                    if constant is not None and row["constant"] != constant:
+                        continue
+                    moment = datetime.fromisoformat(row["timestamp"])
+                    if (start and moment < start) or (end and moment > end):
+                        continue
+                    if tier == "raw":
+                        day_results.append({"user_id": str(user_id), "constant": row["constant"],
+                                            "value": float(row["value"]), "timestamp": row["timestamp"]})
+                    else:
+                        day_results.append({"user_id": str(user_id), "constant": row["constant"],
+                                            "value": float(row["mean"]), "timestamp": row["timestamp"],
+                                            "count": int(row["count"]), "min": float(row["min"]),
+                                            "max": float(row["max"])})
+            # Si el dia té més d'un nivell, les files es tornen a ordenar per moment
+            results += sorted(day_results, key=lambda r: r["timestamp"]) if len(levels) > 1 else day_results
+        return results
+
+    def last_hours(self, user_id, constant=None, hours=24, now=None):
+        """Mesures de les darreres `hours` hores (p. ex. freqüència cardíaca de les últimes 24 h)."""
+        now = now or datetime.now()
+        return self.query(user_id, constant, start=now - timedelta(hours=hours), end=now)
+
+    def is_empty(self):
+        return not os.path.isdir(self.base_dir) or not os.listdir(self.base_dir)
+
+    # ------------------ Retenció i resums ------------------
+
+    @staticmethod
+    def _rollup(rows, width):
+        """
+        Agrupa files (constant, timestamp, count, min, max, mean) en cubetes de
+        `width` segons. Les files en brut compten com una cubeta d'una sola mesura.
+        """
+        buckets = {}
+        for row in rows:
+            if "value" in row:
+                value = float(row["value"])
+                count, low, high, mean = 1, value, value, value
+            else:
+                count, low, high, mean = int(row["count"]), float(row["min"]), float(row["max"]), float(row["mean"])
+            moment = datetime.fromisoformat(row["timestamp"])
+            seconds = moment.hour * 3600 + moment.minute * 60 + moment.second
+            start = datetime.combine(moment.date(), datetime.min.time()) + timedelta(seconds=seconds - seconds % width)
+            key = (row["constant"], start)
+            if key not in buckets:
+                buckets[key] = [count, low, high, mean * count]
+            else:
+                bucket = buckets[key]
+                bucket[0] += count
+                bucket[1] = min(bucket[1], low)
+                bucket[2] = max(bucket[2], high)
+                bucket[3] += mean * count
+        return [
+            {"constant": constant, "timestamp": start.isoformat(), "count": count, "min": low, "max": high,
+             "mean": round(total / count, 6)}
+            for (constant, start), (count, low, high, total) in sorted(buckets.items(), key=lambda item: item[0][1])
+        ]
+
+    def _write_atomic(self, path, fieldnames, rows):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(descriptor, mode='w', newline='', encoding='utf-8') as file:
+            writer = csv.DictWriter(file, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(rows)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def _finish_roll(marker_path, target_path):
+        """Acaba un resum confirmat: l'origen (ara `marker_path`) ja és dins de <destí>.next."""
+        if os.path.exists(target_path + ".next"):
+            os.replace(target_path + ".next", target_path)
+        os.remove(marker_path)
+
+    def _roll_partition(self, user_id, day, tier):
+        """
+        Resumeix la partició del dia del nivell d'origen de `tier` i l'esborra. Es fa
+        amb el bloqueig de l'usuari, compartit entre processos (el menú i el servidor
+        poden compactar el mateix directori), i en passos que es poden reprendre: el
+        resum s'escriu a <destí>.next, l'origen es reanomena a <origen>.rolled (des
+        d'aquí ja forma part del resum i no es torna a sumar) i llavors es substitueix
+        el destí. Retorna si s'ha resumit (False si un altre procés ja ho havia fet).
+        """
+        source, width = self.TIERS[tier]
+        source_path = self._partition_path(user_id, day, source)
+        target_path = self._partition_path(user_id, day, tier)
+        marker_path = source_path + ".rolled"
+        with self._lock, _process_lock(os.path.join(self._user_dir(user_id), ".lock")):
+            if os.path.exists(marker_path):
+                self._finish_roll(marker_path, target_path)  # Resum interromput després de confirmar-se
+            source_rows = self._read_partition(source_path)
+            if source_rows is None:
+                return False
+            # Si el dia ja tenia resum (mesures endarrerides), es combinen
+            rows = (self._read_partition(target_path) or []) + source_rows
+            self._write_atomic(target_path + ".next", self.ROLLUP_FIELDNAMES, self._rollup(rows, width))
+            os.replace(source_path, marker_path)
+            self._partitions.discard(source_path)
+            self._finish_roll(marker_path, target_path)
+            return True
+
+    def compact_tiers(self, now=None, owns=None):
+        """
+        Resumeix les particions que han superat la retenció del seu nivell.
+        `owns(user_id)` limita la compactació als usuaris d'un fragment.
+        Retorna el nombre de particions resumides.
+        """
+        today = (now or datetime.now()).date()
+        rolled = 0
+        try:
+            users = os.listdir(self.base_dir)
+        except FileNotFoundError:
+            return 0
+        for user_id in users:
+            if not os.path.isdir(self._user_dir(user_id)) or (owns is not None and not owns(user_id)):
+                continue
+            for tier, (source, _) in self.TIERS.items():
+                limit = today - timedelta(days=self.retention[source])
+                # També els dies d'un resum que es va interrompre (queda <dia>.csv.rolled)
+                days = self._tier_days(user_id, source) | self._tier_days(user_id, source, ".csv.rolled")
+                for day in sorted(days):
+                    if day < limit and self._roll_partition(user_id, day, tier):
+                        rolled += 1
+        return rolled
+
+    def enable_retention(self, interval=3600.0, owns=None):
+        """Aplica la retenció ara i, en segon pla, cada `interval` segons."""
+        if self._compactor is not None:
+            return
+        self._compactor = threading.Event()
+        self._compactor_thread = threading.Thread(
+            target=self._compact_tiers_periodically, args=(self._compactor, interval, owns),
+            name="compactor-mesures", daemon=True
+        )
+        self._compactor_thread.start()
+
+    def _compact_tiers_periodically(self, stop, interval, owns):
+        while not stop.is_set():
+            try:
+                self.compact_tiers(owns=owns)
+            except Exception as e:
+                # Un error en una passada no ha d'aturar la retenció
+                print(f"Error en compactar les mesures de {self.base_dir}: {e}")
+            stop.wait(interval)
+
+    def close(self):
+        """Atura la compactació de nivells en segon pla i espera que acabi la passada en curs."""
+        if self._compactor is not None:
+            self._compactor.set()
+            self._compactor_thread.join()
+            self._compactor = None
+
+    def import_rows(self, rows):
+        """Importa files amb el format de constants.csv (user_id, constant, value, timestamp)."""
+        return self.append_many((r["user_id"], r["constant"], r["value"], r["timestamp"]) for r in rows)
+
+
+class RollingAggregates:
+    """
+    Agregats incrementals per (user_id, constant) sobre finestres lliscants:
+    darrer valor, recompte, mínim, màxim, mitjana i percentils aproximats.
+    Cada finestra és un anell de cubetes de temps amb un histograma de valors
+    arrodonits a `resolution`; afegir una mesura és O(1) i una consulta només
+    recorre les cubetes de la finestra (un nombre fix), sense llegir cap fitxer.
+    Els límits de les finestres tenen la precisió d'una cubeta.
+    """
+    # finestra -> (durada de la finestra, durada de cada cubeta) en segons
+    WINDOWS = {"1h": (3600, 300), "24h": (86400, 3600), "7d": (7 * 86400, 6 * 3600)}
+    PERCENTILES = (0.5, 0.9, 0.99)
+    EPOCH = datetime(1970, 1, 1)
+
+    def __init__(self, windows=None, resolution=0.1):
+        self.windows = windows or self.WINDOWS
+        self.resolution = resolution
+        self._series = {}  # user_id -> constant -> {"last": (moment, valor), finestra: anell de cubetes}
+
+    def horizon(self):
+        """Durada (en segons) de la finestra més llarga."""
+        return max(span for span, _ in self.windows.values())
+
+    def _seconds(self, moment):
+        return (moment - self.EPOCH).total_seconds()
+
+    def forget(self, user_id):
+        """Descarta els agregats de l'usuari (p. ex. per tornar-los a carregar del disc)."""
+        self._series.pop(str(user_id), None)
+
+    def add(self, user_id, constant, value, timestamp):
+        """Afegeix una mesura a totes les finestres de la sèrie (O(1))."""
+        moment = MeasurementStore._to_datetime(timestamp)
+        value = float(value)
+        constants = self._series.setdefault(str(user_id), {})
+        series = constants.get(constant)
+        if series is None:
+            series = constants[constant] = {"last": None}
+            for name, (span, width) in self.windows.items():
+                series[name] = [None] * (span // width)
+        if series["last"] is None or moment >= series["last"][0]:
+            series["last"] = (moment, value)
+        seconds, bin_key = self._seconds(moment), round(value / self.resolution)
+        for name, (_, width) in self.windows.items():
+            ring = series[name]
+            slot = int(seconds // width)
+            bucket = ring[slot % len(ring)]
+            if bucket is None or bucket[0] < slot:
+                # Cubeta nova: substitueix la que ha sortit de la finestra
+                bucket = ring[slot % len(ring)] = [slot, 0, 0.0, value, value, {}]
+            elif bucket[0] > slot:
+                continue  # Mesura més antiga que tota la finestra
+            bucket[1] += 1
+            bucket[2] += value
+            bucket[3] = min(bucket[3], value)
+            bucket[4] = max(bucket[4], value)
+            bucket[5][bin_key] = bucket[5].get(bin_key, 0) + 1
+
+    def stats(self, user_id, constant, window="24h", now=None):
+        """Recompte, mínim, màxim, mitjana i percentils de la finestra que acaba a `now`."""
+        series = self._series.get(str(user_id), {}).get(constant)
+        if series is None:
+            return {"count": 0}
+        _, width = self.windows[window]
+        ring = series[window]
+        now_slot = int(self._seconds(MeasurementStore._to_datetime(now or datetime.now())) // width)
+        buckets = [b for b in ring if b is not None and now_slot - len(ring) < b[0] <= now_slot]
+        count = sum(b[1] for b in buckets)
+        if not count:
+            return {"count": 0}
+        histogram = {}
+        for bucket in buckets:
+            for bin_key, hits in bucket[5].items():
+                histogram[bin_key] = histogram.get(bin_key, 0) + hits
+        result = {
+            "count": count,
+            "min": min(b[3] for b in buckets),
+            "max": max(b[4] for b in buckets),
+            "mean": sum(b[2] for b in buckets) / count,
+        }
+        # Percentils a partir de l'histograma acumulat
+        ordered, seen, pending = sorted(histogram.items()), 0, list(self.PERCENTILES)
+        for bin_key, hits in ordered:
+            seen += hits
+            while pending and seen >= pending[0] * count:
+                result[f"p{round(pending.pop(0) * 100)}"] = round(bin_key * self.resolution, 6)
+        return result
+
+    def summary(self, user_id, now=None):
+        """
+        Retorna {constant: {"last": valor, "timestamp": moment, finestra: estadístiques}}
+        per a totes les constants de l'usuari.
+        """
+        summary = {}
+        for constant, series in sorted(self._series.get(str(user_id), {}).items()):
+            moment, value = series["last"]
+            summary[constant] = {"last": value, "timestamp": moment.isoformat()}
+            for window in self.windows:
+                summary[constant][window] = self.stats(user_id, constant, window, now)
+        return summary
+
+
+# ------------------ Thresholds ------------------
+
+class ThresholdTable:
+    """
+    Llindars de thresholds.csv compilats en memòria i indexats pel nom
+    normalitzat de la constant. Només es tornen a compilar quan el fitxer canvia.
+    """
+
+    def __init__(self, thresholds_manager):
+        self.thresholds_manager = thresholds_manager
+        self._version = object()
+        self._limits = {}  # constant normalitzada -> (mínim, màxim, fila)
+        self._invalid = {}  # constant normalitzada -> missatge d'error
+        self.compilations = 0
+
+    @staticmethod
+    def normalize(constant):
+        return " ".join(str(constant).split()).casefold()
+
+    def _refresh(self):
+        version = self.thresholds_manager.version()
+        if version == self._version:
+            return
+        limits, invalid = {}, {}
+        for row in self.thresholds_manager.read():
+            key = self.normalize(row.get("constant", ""))
+            try:
+                min_level = float(row["min_level"]) if row.get("min_level") not in (None, "") else float('-inf')
+                max_level = float(row["max_level"]) if row.get("max_level") not in (None, "") else float('inf')
+            except ValueError as e:
+                invalid[key] = str(e)
+                limits.pop(key, None)
+                continue
+            limits[key] = (min_level, max_level, row)
+            invalid.pop(key, None)
+        self._limits, self._invalid, self._version = limits, invalid, version
+        self.compilations += 1
+
+    def limits(self, constant):
+        """Retorna (mínim, màxim, fila) de la constant, o None si no té llindars vàlids."""
+        self._refresh()
+        return self._limits.get(self.normalize(constant))
+
+    def error(self, constant):
+        """Missatge d'error si els llindars configurats per la constant no són numèrics."""
+        self._refresh()
+        return self._invalid.get(self.normalize(constant))
+
+    def is_out_of_range(self, constant, value):
+        limits = self.limits(constant)
+        return limits is not None and (value < limits[0] or value > limits[1])
+
+    def evaluate_batch(self, constants, values):
+        """
+        Marca quins valors són fora de rang. `constants` pot ser un sol nom
+        (per a tot el lot) o una seqüència paral·lela a `values`. Amb NumPy
+        retorna un array booleà; sense, una llista.
+        """
+        self._refresh()
+        unbounded = (float('-inf'), float('inf'))
+        if isinstance(constants, str):
+            low, high = self._limits.get(self.normalize(constants), unbounded)[:2]
+            if np is not None:
+                array = np.asarray(values, dtype=float)
+                return (array < low) | (array > high)
+            return [v < low or v > high for v in values]
+        # Un codi per constant diferent i una taula petita de límits per codi
+        codes, table = {}, [unbounded]
+        for constant in set(constants):
+            limits = self._limits.get(self.normalize(constant))
+            codes[constant] = len(table) if limits else 0
+            if limits:
+                table.append(limits[:2])
+        if np is not None:
+            index = np.fromiter((codes[c] for c in constants), dtype=np.intp, count=len(constants))
+            bounds = np.array(table, dtype=float)
+            array = np.asarray(values, dtype=float)
+            return (array < bounds[index, 0]) | (array > bounds[index, 1])
+        return [v < table[codes[c]][0] or v > table[codes[c]][1] for c, v in zip(constants, values)]
+
+
+# ------------------ Anomaly detection ------------------
+
+# Configuració dels detectors per constant (nom normalitzat); les claus que falten
+# es prenen de "default" i un valor None desactiva el detector.
+#   ewma_alpha / ewma_sigmas: mitjana i variància exponencials i desviacions tolerades
+#   zscore_window / zscore: mida de la finestra mòbil i valor z màxim
+#   max_rate: canvi màxim per segon entre mesures consecutives
+#   min_samples: mesures necessàries abans d'avaluar la sèrie
+ANOMALY_RULES = {
+    "default": {"ewma_alpha": 0.1, "ewma_sigmas": 4.0, "zscore_window": 30, "zscore": 3.5,
+                "max_rate": None, "min_samples": 10},
+    "heart rate": {"max_rate": 1.0},
+    "blood pressure": {"max_rate": 1.0},
+    "temperature": {"ewma_sigmas": 5.0, "max_rate": 0.01},
+}
+
+
+class AnomalyDetector:
+    """
+    Detectors en línia per (user_id, constant): EWMA, valor z sobre una finestra
+    mòbil i velocitat de canvi. Cada sèrie té un estat de mida fixa que
+    s'actualitza en O(1) per mesura. Els detectors només es notifiquen quan
+    comencen a disparar-se, no a cada mesura d'una mateixa excursió.
+    """
+
+    def __init__(self, rules=None):
+        self.rules = rules or ANOMALY_RULES
+        self._compiled = {}  # constant normalitzada -> regles combinades amb "default"
+        self._series = {}  # (user_id, constant normalitzada) -> estat
+
+    def rule(self, constant):
+        key = ThresholdTable.normalize(constant)
+        if key not in self._compiled:
+            self._compiled[key] = {**self.rules["default"], **self.rules.get(key, {})}
+        return self._compiled[key]
+
+    def _new_state(self, rule):
+        return {"count": 0, "mean": 0.0, "variance": 0.0,
+                "window": collections.deque(maxlen=rule["zscore_window"] or 1), "sum": 0.0, "squares": 0.0,
+                "last": None, "active": set()}
+
+    def observe(self, user_id, constant, value, timestamp):
+        """
+        Afegeix una mesura a la sèrie i retorna la llista de detectors que
+        s'hi acaben de disparar ("ewma", "zscore", "rate").
+        """
+        rule = self.rule(constant)
+        key = (str(user_id), ThresholdTable.normalize(constant))
+        state = self._series.get(key)
+        if state is None:
+            state = self._series[key] = self._new_state(rule)
+        value = float(value)
+        moment = MeasurementStore._to_datetime(timestamp)
+        firing = set()
+        ready = state["count"] >= rule["min_samples"]
+
+        # EWMA: desviació respecte de la mitjana exponencial
+        if rule["ewma_sigmas"] is not None:
+            if ready and state["variance"] > 0 and \
+                    abs(value - state["mean"]) > rule["ewma_sigmas"] * math.sqrt(state["variance"]):
+                firing.add("ewma")
+        difference = value - state["mean"] if state["count"] else 0.0
+        increment = rule["ewma_alpha"] * difference
+        state["mean"] = state["mean"] + increment if state["count"] else value
+        state["variance"] = (1 - rule["ewma_alpha"]) * (state["variance"] + difference * increment)
+
+        # Valor z sobre les darreres `zscore_window` mesures (sumes mòbils)
+        window = state["window"]
+        if rule["zscore"] is not None and ready and len(window) > 1:
+            mean = state["sum"] / len(window)
+            variance = max(state["squares"] / len(window) - mean * mean, 0.0)
+            if variance > 0 and abs(value - mean) / math.sqrt(variance) > rule["zscore"]:
+                firing.add("zscore")
+        if len(window) == window.maxlen:
+            oldest = window[0]
+            state["sum"] -= oldest
+            state["squares"] -= oldest * oldest
+        window.append(value)
+        state["sum"] += value
+        state["squares"] += value * value
+
+        # Velocitat de canvi respecte de la mesura anterior
+        if rule["max_rate"] is not None and state["last"] is not None:
+            elapsed = (moment - state["last"][0]).total_seconds()
+            if elapsed > 0 and abs(value - state["last"][1]) / elapsed > rule["max_rate"]:
+                firing.add("rate")
+        state["last"] = (moment, value)
+        state["count"] += 1
+
+        new = firing - state["active"]
+        state["active"] = firing
+        return sorted(new)
+
+
+# ------------------ Alerts ------------------
+
+# Regles d'encaminament d'alertes per constant (nom normalitzat). `high_deviation` és la
+# desviació relativa respecte del llindar a partir de la qual el risc és "Alt".
+# `suppress_seconds`: durant aquest temps des de la darrera repetició, les alertes iguals
+# (usuari, constant, risc) no es tornen a desar; `escalate_after`: repeticions de l'episodi
+# a partir de les quals es desa una alerta escalada a risc "Alt".
+ALERT_RULES = {
+    "default": {"high_deviation": 0.25, "suppress_seconds": 900, "escalate_after": 5},
+    "heart rate": {"high_deviation": 0.2},
+    "blood pressure": {"high_deviation": 0.15},
+    "temperature": {"high_deviation": 0.03},
+}
+
+
+class AlertDispatcher:
+    """
+    Cua d'alertes no bloquejant. Quan una mesura supera els llindars s'hi
+    encua l'alerta i un fil en segon pla la classifica segons les regles
+    (nivell de risc per constant i desviació, contacte del pacient) i desa
+    les alertes a alertes.csv per lots.
+
+    Les alertes es dedupliquen per episodis (usuari, constant, risc): només es
+    desa la primera, les repeticions dins de la finestra de supressió es
+    compten, es desa una alerta escalada quan l'episodi arriba a
+    `escalate_after` repeticions i, quan la constant torna al rang normal, un
+    resum de l'episodi.
+    """
+    FIELDNAMES = ["user_id", "constant", "value", "risk_level", "contact_number", "additional_info"]
+
+    def __init__(self, alerts_manager, profiles_manager=None, rules=None, contact_resolver=None,
+                 batch_size=500, flush_interval=0.5, care_index=None):
+        self.alerts_manager = alerts_manager
+        self.profiles_manager = profiles_manager
+        self.rules = rules or ALERT_RULES
+        self.care_index = care_index
+        # Funció user_id -> telèfon; per defecte, el del personal sanitari de la
+        # xarxa del pacient (si hi ha índex) i, si no n'hi ha, el del perfil mèdic
+        self.contact_resolver = contact_resolver or self._care_phone
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.dispatched = 0
+        self.suppressed = 0
+        self.failed = 0  # Alertes que no s'han pogut processar o desar (es registren al log)
+        self._episodes = {}  # (user_id, constant normalitzada) -> risc -> episodi obert
+        self.open_series = set()  # Sèries amb algun episodi obert (consultable des d'altres fils)
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="alert-dispatcher", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Desa les alertes pendents i atura el fil."""
+        if self._thread is not None:
+            self.queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def enqueue(self, user_id, constant, value, limits=None, timestamp=None, detectors=None, info=None):
+        """
+        Encua una alerta i retorna immediatament. `limits` és (mínim, màxim) si s'ha
+        superat un llindar; `detectors`, els detectors d'anomalies que s'han disparat;
+        `info`, dades addicionals que es desen a additional_info.
+        """
+        self.open_series.add((str(user_id), ThresholdTable.normalize(constant)))
+        self.queue.put({"user_id": str(user_id), "constant": constant, "value": float(value),
+                        "limits": limits, "timestamp": timestamp or datetime.now().isoformat(),
+                        "detectors": list(detectors or []), "info": info})
+
+    def recover(self, user_id, constant, value, timestamp=None):
+        """
+        Notifica una mesura dins del rang normal. Si la sèrie tenia episodis
+        oberts, s'encua el tancament (amb el resum) i retorna True.
+        """
+        if (str(user_id), ThresholdTable.normalize(constant)) not in self.open_series:
+            return False
+        self.queue.put({"user_id": str(user_id), "constant": constant, "value": float(value), "limits": None,
+                        "timestamp": timestamp or datetime.now().isoformat(), "recovery": True})
+        return True
+
+    def _run(self):
+        running = True
+        while running:
+            batch, taken = [], 0
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+                while True:
+                    taken += 1
+                    if item is None:
+                        running = False
+                        break
+                    batch.append(item)
+                    if len(batch) >= self.batch_size:
+                        break
+                    item = self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            try:
+                rows = []
+                for item in batch:
+                    # Una alerta errònia no ha d'aturar el fil ni fer perdre la resta del lot
+                    try:
+                        rows += self.process(item)
+                    except Exception as e:
+                        self.failed += 1
+                        print(f"Error en processar l'alerta {item}: {e}")
+                if rows:
+                    try:
+                        self.alerts_manager.append(self.FIELDNAMES, rows)
+                        self.dispatched += len(rows)
+                    except Exception as e:
+                        self.failed += len(rows)
+                        print(f"Error en desar {len(rows)} alertes: {e}")
+            finally:
+                for _ in range(taken):
+                    self.queue.task_done()
+
+    def flush(self):
+        """Espera que totes les alertes encuades fins ara s'hagin desat."""
+        self.queue.join()
+
+    def risk_level(self, constant, value, limits):
+        """Nivell de risc segons la desviació relativa respecte del llindar superat."""
+        if not limits:
+            return "Mitjà"
+        min_level, max_level = limits
+        bound = max_level if value > max_level else min_level
+        deviation = abs(value - bound) / abs(bound) if bound not in (0, float('inf'), float('-inf')) else 1.0
+        return "Alt" if deviation >= self._rule(constant, "high_deviation") else "Mitjà"
+
+    def _rule(self, constant, name):
+        rule = self.rules.get(ThresholdTable.normalize(constant), self.rules["default"])
+        return rule.get(name, self.rules["default"][name])
+
+    def process(self, item):
+        """
+        Aplica la deduplicació per episodis a una alerta encuada i retorna les
+        files que cal desar (cap si queda suprimida).
+        """
+        series = (item["user_id"], ThresholdTable.normalize(item["constant"]))
+        moment = MeasurementStore._to_datetime(item["timestamp"])
+        if item.get("recovery"):
+            return self._close_episodes(series, item)
+        risk_level = self.risk_level(item["constant"], item["value"], item["limits"])
+        episodes = self._episodes.setdefault(series, {})
+        episode = episodes.get(risk_level)
+        if episode is None or (moment - episode["last"]).total_seconds() > self._rule(item["constant"], "suppress_seconds"):
+            episodes[risk_level] = {"constant": item["constant"], "first": moment, "last": moment, "count": 1,
+                                    "min": item["value"], "max": item["value"]}
+            self.open_series.add(series)
+            return [self.route(item)]
+        episode["last"] = max(episode["last"], moment)
+        episode["count"] += 1
+        episode["min"] = min(episode["min"], item["value"])
+        episode["max"] = max(episode["max"], item["value"])
+        if episode["count"] == self._rule(item["constant"], "escalate_after"):
+            row = self.route(item)
+            row["risk_level"] = "Alt"
+            row["additional_info"].update({"escalated": True, "severity": risk_level, "repeats": episode["count"]})
+            return [row]
+        self.suppressed += 1
+        return []
+
+    def _close_episodes(self, series, item):
+        """Tanca els episodis oberts de la sèrie i retorna una fila de resum per a cadascun."""
+        self.open_series.discard(series)
+        rows = []
+        for risk_level, episode in self._episodes.pop(series, {}).items():
+            rows.append({
+                "user_id": item["user_id"],
+                "constant": episode["constant"],
+                "value": item["value"],
+                "risk_level": "Resolt",
+                "contact_number": self._contact(item["user_id"]),
+                "additional_info": {"timestamp": item["timestamp"], "source": "auto", "recovery": True,
+                                    "severity": risk_level, "repeats": episode["count"],
+                                    "first": episode["first"].isoformat(), "last": episode["last"].isoformat(),
+                                    "min": episode["min"], "max": episode["max"]},
+            })
+        return rows
+
+    def _contact(self, user_id):
+        """Telèfon de contacte de l'alerta; si no es pot resoldre, l'alerta es desa igualment sense."""
+        try:
+            return self.contact_resolver(user_id) or ""
+        except Exception as e:
+            print(f"Error en resoldre el contacte de l'usuari {user_id}: {e}")
+            return ""
+
+    def _care_phone(self, user_id):
+        phone = self.care_index.care_phone(user_id) if self.care_index is not None else ""
+        return phone or self._profile_phone(user_id)
+
+    def _profile_phone(self, user_id):
+        if self.profiles_manager is None:
+            return ""
+        profile = self.profiles_manager.find_one("user_id", user_id)
+        return profile.get("phone", "") if profile else ""
+
+    def route(self, item):
+        """Converteix una alerta encuada en la fila que es desa a alertes.csv."""
+        additional_info = {"timestamp": item["timestamp"], "limits": list(item["limits"] or []), "source": "auto"}
+        if item.get("detectors"):
+            additional_info["detectors"] = item["detectors"]
+        if item.get("info"):
+            additional_info.update(item["info"])
+        return {
+            "user_id": item["user_id"],
+            "constant": item["constant"],
+            "value": item["value"],
+            "risk_level": self.risk_level(item["constant"], item["value"], item["limits"]),
+            "contact_number": self._contact(item["user_id"]),
+            "additional_info": additional_info,
+        }
+
+
+# ------------------ Device liveness ------------------
+
+class LivenessMonitor:
+    """
+    Control de vida dels dispositius IoT. Cada dispositiu té un termini (darrera
+    mesura + `missed_samples` períodes de mostreig declarats) guardat en un
+    monticle: cada mesura l'actualitza en O(log n) i `check` només treu del
+    cim els terminis vençuts, sense recórrer tots els dispositius. Quan un
+    termini venç s'encua una alerta "Dispositiu silenciós" i, quan el
+    dispositiu torna a enviar mesures, se'n tanca l'episodi.
+    """
+    CONSTANT = "Dispositiu silenciós"
+
+    def __init__(self, alert_dispatcher=None, missed_samples=3, grace_seconds=30.0):
+        self.alert_dispatcher = alert_dispatcher
+        self.missed_samples = missed_samples
+        self.grace_seconds = grace_seconds
+        self._heap = []  # (termini, número de sèrie); les entrades obsoletes es descarten en treure-les
+        self._devices = {}  # número de sèrie -> [termini, user_id, període permès, darrera mesura]
+        self.silent = {}  # número de sèrie -> moment en què s'ha detectat el silenci
+        self._lock = threading.Lock()
+        self._stop = None
+
+    def _allowed(self, frequency):
+        try:
+            frequency = float(frequency)
+        except (TypeError, ValueError):
+            return None
+        return frequency * self.missed_samples + self.grace_seconds if frequency > 0 else None
+
+    def watch_devices(self, devices, now=None):
+        """Comença a vigilar (des de `now`) els dispositius de dispositius_iot.csv."""
+        now = now or datetime.now()
+        with self._lock:
+            for device in devices:
+                allowed = self._allowed(device.get("sampling_frequency"))
+                serial_number = device.get("serial_number")
+                if allowed is None or not serial_number or serial_number in self._devices:
+                    continue
+                deadline = now + timedelta(seconds=allowed)
+                self._devices[serial_number] = [deadline, str(device.get("user_id", "")), allowed, None]
+                self._heap.append((deadline, serial_number))
+            heapq.heapify(self._heap)
+
+    def heartbeat(self, serial_number, user_id, timestamp, frequency):
+        """Registra una mesura del dispositiu i n'allarga el termini (O(log n))."""
+        allowed = self._allowed(frequency)
+        if allowed is None:
+            return
+        moment = MeasurementStore._to_datetime(timestamp)
+        recovered = None
+        with self._lock:
+            device = self._devices.get(serial_number)
+            if device is not None and device[3] is not None and moment <= device[3]:
+                return  # Mesura endarrerida: el termini no canvia
+            deadline = moment + timedelta(seconds=allowed)
+            self._devices[serial_number] = [deadline, str(user_id), allowed, moment]
+            heapq.heappush(self._heap, (deadline, serial_number))
+            if serial_number in self.silent:
+                recovered = self.silent.pop(serial_number)
+            # Les entrades obsoletes no poden ocupar més del doble del monticle útil
+            if len(self._heap) > 2 * len(self._devices) + 1024:
+                self._heap = [(d[0], serial) for serial, d in self._devices.items() if serial not in self.silent]
+                heapq.heapify(self._heap)
+        if recovered is not None and self.alert_dispatcher is not None:
+            self.alert_dispatcher.recover(user_id, f"{self.CONSTANT} ({serial_number})",
+                                          (moment - recovered).total_seconds(), moment.isoformat())
+
+    def check(self, now=None):
+        """Encua una alerta per cada dispositiu amb el termini vençut i en retorna els números de sèrie."""
+        now = MeasurementStore._to_datetime(now) if now else datetime.now()
+        expired = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                deadline, serial_number = heapq.heappop(self._heap)
+                device = self._devices.get(serial_number)
+                if device is None or device[0] != deadline or serial_number in self.silent:
+                    continue  # Entrada obsoleta: el dispositiu ha enviat mesures després
+                self.silent[serial_number] = deadline
+                expired.append((serial_number, device))
+        for serial_number, (deadline, user_id, allowed, last_seen) in expired:
+            if self.alert_dispatcher is not None:
+                silence = (now - deadline).total_seconds() + allowed
+                self.alert_dispatcher.enqueue(
+                    user_id, f"{self.CONSTANT} ({serial_number})", silence, (0.0, allowed), now.isoformat(),
+                    info={"serial_number": serial_number, "last_seen": last_seen.isoformat() if last_seen else None}
+                )
+        return [serial_number for serial_number, _ in expired]
+
+    def start(self, interval=10.0):
+        """Comprova els terminis cada `interval` segons en un fil en segon pla."""
+        if self._stop is None:
+            self._stop = threading.Event()
+            threading.Thread(target=self._run, args=(self._stop, interval), name="liveness-monitor",
+                             daemon=True).start()
+        return self
+
+    def _run(self, stop, interval):
+        while not stop.wait(interval):
+            self.check()
+
+    def stop(self):
+        if self._stop is not None:
+            self._stop.set()
+            self._stop = None
+
+
+# ------------------ Appointment calendar ------------------
+
+class AppointmentCalendar:
+    """
+    Índex de cites.csv per metge i per usuari i dia: per a cada (metge o usuari,
+    dia) es guarda la llista ordenada d'hores d'inici (en minuts). Totes les
+    cites duren `slot_minutes`, de manera que un solapament es detecta amb una
+    cerca binària (O(log n)). L'índex es construeix un sol cop llegint només les
+    columnes necessàries, s'actualitza amb cada cita nova i es torna a construir
+    si cites.csv canvia per altres camins.
+    """
+
+    def __init__(self, appointments_manager, slot_minutes=30, day_start="08:00", day_end="20:00"):
+        self.appointments_manager = appointments_manager
+        self.slot_minutes = slot_minutes
+        self.day_start = self._minutes(day_start)
+        self.day_end = self._minutes(day_end)
+        self._starts = {}  # ("doctor" | "user", clau, dia ISO) -> hores d'inici ordenades
+        self._version = object()
+
+    @staticmethod
+    def _minutes(time_text):
+        hours, minutes = str(time_text).strip().split(":")[:2]
+        return int(hours) * 60 + int(minutes)
+
+    @staticmethod
+    def _day(date):
+        if hasattr(date, "isoformat"):
+            return date.isoformat()
+        try:
+            return datetime.strptime(str(date).strip(), "%Y-%m-%d").date().isoformat()
+        except ValueError:
+            return str(date).strip()
+
+    @staticmethod
+    def _keys(doctor, user_id, day):
+        return ("doctor", ThresholdTable.normalize(doctor), day), ("user", str(user_id), day)
+
+    def _refresh(self):
+        version = self.appointments_manager.version()
+        if version == self._version:
+            return
+        self._starts = {}
+        for row in self.appointments_manager.iter_rows(["user_id", "doctor", "date", "time"]):
+            self._insert(row)
+        self._version = version
+
+    def _insert(self, appointment):
+        try:
+            start = self._minutes(appointment["time"])
+        except (KeyError, ValueError):
+            return  # Cita sense hora vàlida: no ocupa cap franja
+        for key in self._keys(appointment.get("doctor", ""), appointment.get("user_id", ""),
+                              self._day(appointment.get("date", ""))):
+            bisect.insort(self._starts.setdefault(key, []), start)
+
+    def _overlaps(self, key, start):
+        starts = self._starts.get(key)
+        if not starts:
+            return False
+        index = bisect.bisect_right(starts, start - self.slot_minutes)
+        return index < len(starts) and starts[index] < start + self.slot_minutes
+
+    def conflict(self, doctor, user_id, date, time):
+        """Retorna el motiu si el metge o l'usuari ja tenen una cita que se solapa, o None."""
+        self._refresh()
+        doctor_key, user_key = self._keys(doctor, user_id, self._day(date))
+        start = self._minutes(time)
+        if self._overlaps(doctor_key, start):
+            return f"El doctor {doctor} ja té una cita el {self._day(date)} a les {time}."
+        if self._overlaps(user_key, start):
+            return f"L'usuari {user_id} ja té una cita el {self._day(date)} a les {time}."
+        return None
+
+    def add(self, appointment, version_before):
+        """
+        Afegeix al calendari una cita que s'acaba de desar. `version_before` és la
+        versió de cites.csv d'abans d'escriure-la: si l'índex hi correspon, només
+        s'hi insereix la cita; si no, es deixa per reconstruir a la propera consulta.
+        """
+        if self._version == version_before:
+            self._insert(appointment)
+            self._version = self.appointments_manager.version()
+        self._version = self.appointments_manager.version()
+
+    def free_slots(self, doctor, start_date, days=7):
+        """Franges lliures del metge, per dia, des de `start_date` durant `days` dies."""
+        self._refresh()
+        first = datetime.strptime(self._day(start_date), "%Y-%m-%d").date()
+        free = {}
+        for offset in range(days):
+            day = (first + timedelta(days=offset)).isoformat()
+            key = self._keys(doctor, "", day)[0]
+            free[day] = [
+                f"{start // 60:02d}:{start % 60:02d}"
+                for start in range(self.day_start, self.day_end - self.slot_minutes + 1, self.slot_minutes)
+                if not self._overlaps(key, start)
+            ]
+        return free
+
+
+# ------------------ Notification inbox ------------------
+
+class NotificationInbox:
+    """
+    Safata de notificacions per usuari. Per a cada usuari es guarda la llista
+    ordenada dels seus notification_id; una pàgina (de la més nova a la més
+    antiga) és un tall d'aquesta llista a partir del cursor, i les files es
+    recuperen per clau primària, de manera que obrir la safata costa el que
+    la pàgina. El darrer identificador llegit de cada usuari es desa a
+    `reads_manager` i el nombre de no llegides surt d'una cerca binària.
+    """
+
+    def __init__(self, notifications_manager, reads_manager=None):
+        self.notifications_manager = notifications_manager
+        self.reads_manager = reads_manager
+        self._ids = {}  # user_id -> notification_id (enters) ordenats
+        self._version = object()
+
+    @staticmethod
+    def _id(notification):
+        try:
+            return int(notification.get("notification_id"))
+        except (TypeError, ValueError):
+            return None
+
+    def _refresh(self):
+        version = self.notifications_manager.version()
+        if version == self._version:
+            return
+        self._ids = {}
+        if version is not None:
+            for notification in self.notifications_manager.iter_rows(["notification_id", "user_id"]):
+                self._insert(notification)
+        self._version = version
+
+    def _insert(self, notification):
+        notification_id = self._id(notification)
+        if notification_id is None:
+            return
+        ids = self._ids.setdefault(str(notification.get("user_id")), [])
+        if not ids or ids[-1] < notification_id:
+            ids.append(notification_id)  # El cas habitual: els identificadors creixen
+        else:
+            position = bisect.bisect_left(ids, notification_id)
+            if ids[position] != notification_id:
+                ids.insert(position, notification_id)
+
+    def add(self, notifications, version_before):
+        """
+        Afegeix a la safata les notificacions que s'acaben de desar. Com a
+        AppointmentCalendar.add, només si l'índex corresponia a `version_before`.
+        """
+        if self._version == version_before:
+            for notification in notifications:
+                self._insert(notification)
+            self._version = self.notifications_manager.version()
+
+    def last_read(self, user_id):
+        if self.reads_manager is None:
+            return 0
+        row = self.reads_manager.find_one("user_id", str(user_id))
+        return int(row.get("last_read_id") or 0) if row else 0
+
+    def unread_count(self, user_id):
+        self._refresh()
+        ids = self._ids.get(str(user_id), [])
+        return len(ids) - bisect.bisect_right(ids, self.last_read(user_id))
+
+    def page(self, user_id, limit=10, cursor=None):
+        """
+        Retorna {"items", "next_cursor", "unread"}: fins a `limit` notificacions de
+        l'usuari anteriors a `cursor` (l'identificador retornat per la pàgina
+        anterior), de la més nova a la més antiga.
+        """
+        self._refresh()
+        ids = self._ids.get(str(user_id), [])
+        end = len(ids) if cursor is None else bisect.bisect_left(ids, int(cursor))
+        start = max(0, end - limit)
+        items = [row for row in (self.notifications_manager.find_one("notification_id", str(notification_id))
+                                 for notification_id in reversed(ids[start:end])) if row is not None]
+        return {"items": items, "next_cursor": ids[start] if start > 0 else None,
+                "unread": self.unread_count(user_id)}
+
+    def mark_read(self, user_id, up_to=None):
+        """Marca com a llegides les notificacions fins a `up_to` (per defecte, totes)."""
+        self._refresh()
+        ids = self._ids.get(str(user_id), [])
+        up_to = ids[-1] if up_to is None and ids else up_to
+        if self.reads_manager is None or up_to is None or int(up_to) <= self.last_read(user_id):
+            return
+        self.reads_manager.write(["user_id", "last_read_id"], [{"user_id": str(user_id), "last_read_id": int(up_to)}])
+
+
+# ------------------ Care network index ------------------
+
+class CareNetworkIndex:
+    """
+    Índex invers de la taula de membres de les xarxes socials: per a cada DNI,
+    les xarxes on apareix (network_id, rol, telèfons), i per a cada user_id, els
+    membres de les xarxes on ha afegit algú. Es construeix una sola vegada
+    llegint només les columnes necessàries, es reconstrueix si la taula canvia
+    des de fora i `add` hi afegeix els membres nous, de manera que trobar els
+    contactes d'un pacient no recorre les xarxes.
+    """
+    CARE_ROLES = ("Metge", "Infermer")  # Ordre de preferència del contacte d'una alerta
+    COLUMNS = ("network_id", "user_id", "name", "dni", "phones", "role")
+
+    def __init__(self, members_manager):
+        self.members_manager = members_manager
+        self._by_dni = {}  # dni -> [entrada]
+        self._by_network = {}  # network_id -> [entrada]
+        self._networks_by_user = {}  # user_id -> network_id (en ordre d'alta)
+        self._seen = set()  # (network_id, dni) ja indexats
+        self._version = object()
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        version = self.members_manager.version()
+        if version == self._version:
+            return
+        self._by_dni, self._by_network, self._networks_by_user, self._seen = {}, {}, {}, set()
+        if version is not None:
+            for member in self.members_manager.iter_rows(self.COLUMNS):
+                self._insert(member)
+        self._version = version
+
+    def _insert(self, member):
+        network_id, dni = str(member.get("network_id")), str(member.get("dni") or "").strip()
+        if member.get("user_id"):
+            self._networks_by_user.setdefault(str(member["user_id"]), {})[network_id] = None
+        if (network_id, dni) in self._seen:
+            return
+        self._seen.add((network_id, dni))
+        entry = {"network_id": network_id, "name": member.get("name"), "dni": dni,
+                 "role": member.get("role"), "phones": [p.strip() for p in member.get("phones") or [] if p.strip()]}
+        self._by_network.setdefault(network_id, []).append(entry)
+        self._by_dni.setdefault(dni, []).append(entry)
+
+    def add(self, members, version_before):
+        """
+        Afegeix a l'índex els membres que s'acaben de desar. Com a
+        AppointmentCalendar.add, només si l'índex corresponia a `version_before`.
+        """
+        with self._lock:
+            if self._version == version_before:
+                for member in members:
+                    self._insert(member)
+                self._version = self.members_manager.version()
+
+    def networks_of(self, dni):
+        """Xarxes on és la persona amb aquest DNI: [{"network_id", "role", "phones", ...}]."""
+        with self._lock:
+            self._refresh()
+            return [dict(entry) for entry in self._by_dni.get(str(dni).strip(), [])]
+
+    def contacts(self, user_id, roles=None):
+        """Membres de les xarxes de l'usuari, opcionalment només dels rols indicats."""
+        with self._lock:
+            self._refresh()
+            return [dict(entry) for network_id in self._networks_by_user.get(str(user_id), {})
+                    for entry in self._by_network.get(network_id, [])
+                    if roles is None or entry["role"] in roles]
+
+    def care_phone(self, user_id):
+        """Primer telèfon del personal sanitari de l'usuari segons CARE_ROLES, o ""."""
+        contacts = self.contacts(user_id, self.CARE_ROLES)
+        for role in self.CARE_ROLES:
+            for contact in contacts:
+                if contact["role"] == role and contact["phones"]:
+                    return contact["phones"][0]
+        return ""
 
-    
-    
 
 # ------------------ Factory ------------------
 
@@ -262,8 +2175,7 @@ class UserController:
 
     def register_user(self):
         self.view.display_message("\n--- REGISTRE D'USUARI ---")
-        users = self.users_manager.read()
-        user_id = len(users) + 1
+        user_id = self.users_manager.next_id()
         name = self.view.get_input("Introdueix el teu nom: ")
         email = self.view.get_input("Introdueix el teu correu electrònic: ")
         registration_date = format_date(datetime.now())
@@ -289,17 +2201,16 @@ class UserController:
         user_dict = {k: v for k, v in user.__dict__.items() if v is not None and k != "parameters"}
         user_dict["type"] = user_type  # Afegir el tipus d'usuari explícitament
 
-        users.append(user.__dict__)  # Convertim l'objecte en diccionari per guardar-lo al CSV
-        self.users_manager.write(["user_id", "name", "email", "registration_date", "type"], users)
+        # Només s'afegeix la fila nova; el fitxer no es reescriu
+        self.users_manager.write(["user_id", "name", "email", "registration_date", "type"], [user_dict])
         self.view.display_message(f"Usuari registrat amb èxit: {user.__dict__}")
 
 
 
     def confirm_user_id(self):
-        users = self.users_manager.read()
         while True:
             user_id = self.view.get_input("Introdueix el ID d'usuari: ")
-            user_data = next((u for u in users if u["user_id"] == user_id), None)
+            user_data = self.users_manager.find_one("user_id", user_id)
             if user_data:
                 user_type = user_data.get("type", "generic")
     
@@ -346,17 +2257,23 @@ class UserController:
 
 
 class SocialNetworkController:
-    def __init__(self, social_network_manager, users_controller, view):
+    NETWORK_FIELDNAMES = ["network_id", "title", "creation_date", "members_count"]
+    MEMBER_FIELDNAMES = ["network_id", "user_id", "name", "dni", "phones", "role", "details"]
+
+    def __init__(self, social_network_manager, users_controller, view, members_manager=None, care_index=None):
         self.social_network_manager = social_network_manager
         self.users_controller = users_controller
         self.view = view
+        # Taula de membres (una fila per membre i xarxa); sense, els membres van dins de `members`
+        self.members_manager = members_manager
+        self.care_index = care_index
 
     def manage_social_network(self):
         self.view.display_message("\n--- GESTIONAR XARXA SOCIAL ---")
         networks = self.social_network_manager.read()
         action = validate_input(
-            "Què vols fer? (1: Crear Xarxa Social, 2: Veure Xarxes Socials, 3: Afegir Membres, 4: Veure total de participants per grup): ",
-            lambda x: x in ["1", "2", "3","4"],
+            "Què vols fer? (1: Crear Xarxa Social, 2: Veure Xarxes Socials, 3: Afegir Membres, 4: Veure total de participants per grup, 5: Veure membres d'una xarxa, 6: Buscar xarxes per DNI): ",
+            lambda x: x in ["1", "2", "3", "4", "5", "6"],
             "Opció no vàlida. Si us plau, intenta-ho de nou.",
         )
 
@@ -368,23 +2285,21 @@ class SocialNetworkController:
             self.add_members_to_network(networks)
         elif action =='4':
             self.display_members_count()
+        elif action == "5":
+            self.view_network_members()
+        elif action == "6":
+            self.view_person_networks()
 
 
     def create_social_network(self, networks):
-        # Llegim les xarxes socials actuals
-        all_networks = self.social_network_manager.read()
-    
         # Creem la nova xarxa social
         title = self.view.get_input("Introdueix el títol de la xarxa social: ")
         creation_date = format_date(datetime.now())
-        network_id = str(len(all_networks) + 1)
+        network_id = str(self.social_network_manager.next_id())
         new_network = Factory.create_social_network(network_id, title, creation_date)
     
-        # Afegim la nova xarxa a la llista de xarxes existents
-        all_networks.append(new_network)
-    
-        # Actualitzem el fitxer CSV
-        self.social_network_manager.write(["network_id", "title", "creation_date", "members_count", "members"], all_networks)
+        # Afegim la nova xarxa al final del fitxer CSV
+        self.social_network_manager.write(["network_id", "title", "creation_date", "members_count", "members"], [new_network])
         self.view.display_message(f"Xarxa social '{title}' creada amb èxit.")
 
     def view_social_networks(self, networks):
@@ -402,7 +2317,7 @@ class SocialNetworkController:
             return
 
         network_id = self.view.get_input("Introdueix el `network_id` de la xarxa on vols afegir membres: ")
-        network = next((n for n in networks if n["network_id"] == network_id), None)
+        network = self.social_network_manager.find_one("network_id", network_id)
 
         if not network:
             self.view.display_message(f"No s'ha trobat cap xarxa amb el `network_id` {network_id}.")
@@ -432,11 +2347,7 @@ class SocialNetworkController:
         gender = self.view.get_input("Introdueix el gènere: ")
         birth_date = validate_input("Introdueix la data de naixement (YYYY-MM-DD): ", is_valid_date, "Data no vàlida.")
         member = Factory.create_social_member(name, dni, phones, "Família", relationship=relationship, gender=gender, birth_date=birth_date)
-        if "members" not in network or not isinstance(network["members"], list):
-            network["members"] = []
-
-        network["members"].append(member)
-        self.update_network_members(network)
+        self.add_member(network, user_id, member)
 
     def add_friend_member(self, network, user_id):
         name = self.view.get_input("Introdueix el nom de l'amic: ")
@@ -446,11 +2357,7 @@ class SocialNetworkController:
         birth_date = validate_input("Introdueix la data de naixement (YYYY-MM-DD): ", is_valid_date, "Data no vàlida.")
         hobbies = self.view.get_input("Introdueix els hobbies de l'amic (separats per comes): ").split(",")
         member = Factory.create_social_member(name, dni, phones, "Amics", gender=gender, birth_date=birth_date, hobbies=hobbies)
-        if "members" not in network or not isinstance(network["members"], list):
-            network["members"] = []
-
-        network["members"].append(member)
-        self.update_network_members(network)
+        self.add_member(network, user_id, member)
 
     def add_medical_staff_member(self, network, user_id):
         name = self.view.get_input("Introdueix el nom del personal sanitari: ")
@@ -465,14 +2372,78 @@ class SocialNetworkController:
         else:
             home_assistance = self.view.get_input("Realitza assistència domiciliària? (sí/no): ").strip().lower() == "sí"
             member = Factory.create_social_member(name, dni, phones, "Infermer", hospital=hospital, home_assistance=home_assistance)
-        if "members" not in network or not isinstance(network["members"], list):
-            network["members"] = []
-
-        network["members"].append(member)
-        self.update_network_members(network)
+        self.add_member(network, user_id, member)
         
         
 
+    @staticmethod
+    def _with_member(network, member):
+        """Retorna una còpia de la xarxa amb el nou membre (les files llegides són compartides amb la memòria cau)."""
+        members = network.get("members") if isinstance(network.get("members"), list) else []
+        return {**network, "members": members + [member]}
+
+    def add_member(self, network, user_id, member):
+        """
+        Afegeix un membre a la xarxa. Amb taula de membres, el membre s'hi afegeix
+        com una fila nova i la xarxa només actualitza el comptador (O(1), sense
+        reescriure la resta de membres); sense, es reescriu la llista `members`.
+        """
+        if self.members_manager is None:
+            self.update_network_members(self._with_member(network, member))
+            return
+        network_id = str(network["network_id"])
+        if any(str(m.get("network_id")) == network_id for m in self.members_manager.find("dni", member["dni"])):
+            self.view.display_message(f"La persona amb DNI {member['dni']} ja és membre de la xarxa {network_id}.")
+            return
+        row = {"network_id": network_id, "user_id": user_id, **member}
+        version = self.members_manager.version()
+        self.members_manager.append(self.MEMBER_FIELDNAMES, [row])
+        if self.care_index is not None:
+            self.care_index.add([row], version)
+        members_count = int(network.get("members_count") or 0) + 1
+        self.social_network_manager.write(self.NETWORK_FIELDNAMES, [{
+            **{k: v for k, v in network.items() if k != "members"}, "members_count": members_count
+        }])
+        self.view.display_message(f"Nou membre afegit a la xarxa amb ID {network_id}.")
+
+    def network_members(self, network_id):
+        """Membres d'una xarxa (només es llegeixen els de la xarxa demanada)."""
+        if self.members_manager is None:
+            network = self.social_network_manager.find_one("network_id", network_id)
+            return list(network.get("members") or []) if network else []
+        return self.members_manager.find("network_id", str(network_id))
+
+    def view_network_members(self):
+        network_id = self.view.get_input("Introdueix el `network_id` de la xarxa: ")
+        members = self.network_members(network_id)
+        if not members:
+            self.view.display_message(f"La xarxa {network_id} no té membres.")
+            return
+        self.view.display_message(f"\n--- Membres de la xarxa {network_id} ---")
+        for member in members:
+            phones = ", ".join(member.get("phones") or [])
+            self.view.display_message(f"{member.get('name')} ({member.get('role')}) - DNI: {member.get('dni')} - Telèfons: {phones}")
+
+    def person_networks(self, dni):
+        """Xarxes on apareix un DNI, amb el rol i els telèfons que hi té."""
+        if self.care_index is not None:
+            return self.care_index.networks_of(dni)
+        if self.members_manager is None:
+            return [{"network_id": str(network["network_id"]), **member}
+                    for network in self.social_network_manager.read()
+                    for member in network.get("members") or [] if member.get("dni") == dni]
+        return self.members_manager.find("dni", dni)
+
+    def view_person_networks(self):
+        dni = self.view.get_input("Introdueix el DNI: ").strip()
+        networks = self.person_networks(dni)
+        if not networks:
+            self.view.display_message(f"La persona amb DNI {dni} no és a cap xarxa.")
+            return
+        for entry in networks:
+            phones = ", ".join(entry.get("phones") or [])
+            self.view.display_message(f"Xarxa {entry['network_id']}: {entry.get('role')} - Telèfons: {phones}")
+
     def update_network_members(self, network):
         network["members_count"] = len(network["members"])
         self.social_network_manager.write(["network_id", "title", "creation_date", "members_count", "members"], [network])
@@ -485,25 +2456,20 @@ class SocialNetworkController:
         """
         Mostra el total de membres per cada grup únic (network_id).
         """
-        # Llegeix totes les xarxes socials existents
-        all_networks = self.social_network_manager.read()
+        # Recorre les xarxes en streaming, sense convertir la columna `members`
+        networks = self.social_network_manager.iter_rows(columns=("network_id", "title", "members_count"))
     
-        if not all_networks:
+        # Cada xarxa té una sola versió vigent (la darrera escrita), no cal sumar duplicats
+        members_count_map = {}
+        for network in networks:
+            members_count_map[network["network_id"]] = {
+                "title": network["title"],
+                "total_members": int(network["members_count"]) if network.get("members_count") else 0
+            }
+
+        if not members_count_map:
             self.view.display_message("No hi ha xarxes socials registrades.")
             return
-    
-        # Mapa per comptar el nombre de membres per cada network_id
-        members_count_map = {}
-        for network in all_networks:
-            network_id = network["network_id"]
-            members_count = int(network["members_count"]) if "members_count" in network else 0
-            if network_id not in members_count_map:
-                members_count_map[network_id] = {
-                    "title": network["title"],
-                    "total_members": members_count
-                }
-            else:
-                members_count_map[network_id]["total_members"] += members_count
 
         # Mostra els resultats
         self.view.display_message("\n--- Total Membres per Grup ---")
@@ -512,16 +2478,15 @@ class SocialNetworkController:
 
     
 class AppointmentController:
-    def __init__(self, appointments_manager, users_controller, view):
+    def __init__(self, appointments_manager, users_controller, view, calendar=None):
         self.appointments_manager = appointments_manager
         self.users_controller = users_controller
         self.view = view
+        self.calendar = calendar
 
     def schedule_appointment(self):
         self.view.display_message("\n--- PROGRAMAR CITA MÈDICA ---")
         user_id = self.users_controller.confirm_user_id()
-        appointments = self.appointments_manager.read()
-        appointment_id = len(appointments) + 1
         
         doctor = self.view.get_input("Introdueix el nom del doctor: ")
         specialty = self.view.get_input("Introdueix l'especialitat mèdica: ")
@@ -529,48 +2494,165 @@ class AppointmentController:
         time = validate_input("Introdueix l'hora (HH:MM): ", is_valid_time, "Hora no vàlida.")
         medical_comment = self.view.get_input("Descriu la teva situació mèdica actual (15-20 paraules): ")
         
-
-
+        # Es rebutgen les cites que se solapen amb una altra del metge o del pacient
+        if self.calendar is not None:
+            conflict = self.calendar.conflict(doctor, user_id, date, time)
+            if conflict:
+                free = next(iter(self.calendar.free_slots(doctor, date, days=1).values()))
+                self.view.display_message(conflict)
+                self.view.display_message(f"Hores lliures del doctor {doctor} el {date}: {', '.join(free) or 'cap'}")
+                return
+
+        # L'ID es reserva un cop acceptada la cita, perquè les rebutjades no en gastin
+        appointment_id = self.appointments_manager.next_id()
         appointment = Factory.create_appointment(appointment_id, user_id, doctor, specialty, date, time, medical_comment)
         
-        appointments.append(appointment)
-        
-        self.appointments_manager.write(["appointment_id", "user_id", "doctor", "specialty", "date", "time", "medical_comment"], appointments)
+        version = self.appointments_manager.version()
+        self.appointments_manager.write(["appointment_id", "user_id", "doctor", "specialty", "date", "time", "medical_comment"], [appointment])
+        if self.calendar is not None:
+            self.calendar.add(appointment, version)
         
         self.view.display_message(f"Cita programada amb èxit: {appointment}")
 
+    def view_free_slots(self):
+        self.view.display_message("\n--- HORES LLIURES D'UN METGE ---")
+        doctor = self.view.get_input("Introdueix el nom del doctor: ")
+        date = validate_input("Introdueix la data d'inici (YYYY-MM-DD): ", is_valid_date, "Data no vàlida.")
+        calendar = self.calendar or AppointmentCalendar(self.appointments_manager)
+        for day, slots in calendar.free_slots(doctor, date).items():
+            self.view.display_message(f"{day}: {', '.join(slots) or 'cap hora lliure'}")
+
 
 class NotificationController:
-    def __init__(self, notifications_manager, users_controller, view):
+    FIELDNAMES = ["notification_id", "user_id", "message", "timestamp", "reminder_key"]
+
+    def __init__(self, notifications_manager, users_controller, view, appointments_manager=None, inbox=None):
         self.notifications_manager = notifications_manager
         self.users_controller = users_controller
         self.view = view
+        self.appointments_manager = appointments_manager
+        self.inbox = inbox
 
     def send_notification(self):
         self.view.display_message("\n--- ENVIAR NOTIFICACIÓ ---")
         user_id = self.users_controller.confirm_user_id()
-        notifications = self.notifications_manager.read()
-        notification_id = len(notifications) + 1
+        notification_id = self.notifications_manager.next_id()
         message = self.view.get_input("Introdueix el missatge de la notificació: ")
         notification = Factory.create_notification(notification_id, user_id, message)
-        notifications.append(notification)
-        self.notifications_manager.write(["notification_id", "user_id", "message", "timestamp"], notifications)
+        version = self.notifications_manager.version()
+        self.notifications_manager.write(["notification_id", "user_id", "message", "timestamp"], [notification])
+        if self.inbox is not None:
+            self.inbox.add([notification], version)
         self.view.display_message(f"Notificació enviada amb èxit: {notification}")
 
+    @staticmethod
+    def _appointment_moment(appointment):
+        """Data i hora de la cita com a datetime, o None si no són vàlides."""
+        try:
+            day = appointment.get("date")
+            day = day if hasattr(day, "isoformat") else _decode_date(str(day or ""))
+            hours, minutes = str(appointment.get("time", "")).strip().split(":")
+            return datetime(day.year, day.month, day.day, int(hours), int(minutes))
+        except ValueError:
+            return None
+
+    def upcoming_appointments(self, hours=24, now=None):
+        """
+        Parelles (moment, cita) entre `now` i `now + hours`, llegint cites.csv una sola
+        vegada i només les columnes necessàries. Si una cita apareix diverses vegades,
+        mana la darrera versió.
+        """
+        now = now or datetime.now()
+        end = now + timedelta(hours=hours)
+        upcoming = {}
+        if self.appointments_manager is None or self.appointments_manager.version() is None:
+            return []
+        columns = ["appointment_id", "user_id", "doctor", "specialty", "date", "time"]
+        for appointment in self.appointments_manager.iter_rows(columns):
+            moment = self._appointment_moment(appointment)
+            if moment is not None and now <= moment < end:
+                upcoming[appointment["appointment_id"]] = (moment, appointment)
+            else:
+                upcoming.pop(appointment["appointment_id"], None)
+        return sorted(upcoming.values(), key=lambda item: item[0])
+
+    def send_appointment_reminders(self, hours=24, now=None):
+        """
+        Crea un recordatori per a cada cita de les properes `hours` hores i els desa
+        tots amb una sola escriptura. Cada recordatori té una clau determinista
+        (cita i moment) indexada a notificacions.csv, de manera que tornar a
+        executar la tasca no en duplica cap. Retorna el nombre de recordatoris nous.
+        """
+        now = now or datetime.now()
+        pending = []
+        for moment, appointment in self.upcoming_appointments(hours, now):
+            key = f"cita:{appointment['appointment_id']}:{moment.isoformat()}"
+            if self.notifications_manager.find_one("reminder_key", key) is None:
+                message = (f"Recordatori: cita amb {appointment['doctor']} ({appointment['specialty']}) "
+                           f"el {moment:%Y-%m-%d} a les {moment:%H:%M}.")
+                pending.append((appointment["user_id"], message, key))
+        if not pending:
+            return 0
+        ids = self.notifications_manager.reserve_ids(len(pending))
+        reminders = [
+            {**Factory.create_notification(notification_id, user_id, message), "reminder_key": key}
+            for notification_id, (user_id, message, key) in zip(ids, pending)
+        ]
+        version = self.notifications_manager.version()
+        self.notifications_manager.append(self.FIELDNAMES, reminders)
+        if self.inbox is not None:
+            self.inbox.add(reminders, version)
+        return len(pending)
+
+    def view_inbox(self, page_size=10):
+        self.view.display_message("\n--- LES MEVES NOTIFICACIONS ---")
+        user_id = self.users_controller.confirm_user_id()
+        inbox = self.inbox or NotificationInbox(self.notifications_manager)
+        page = inbox.page(user_id, page_size)
+        self.view.display_message(f"Notificacions no llegides: {page['unread']}")
+        newest = page["items"][0]["notification_id"] if page["items"] else None
+        while True:
+            for notification in page["items"]:
+                self.view.display_message(f"[{notification.get('timestamp', '')}] {notification.get('message', '')}")
+            if page["next_cursor"] is None:
+                break
+            if self.view.get_input("Veure'n més? (s/n): ").strip().lower() != "s":
+                break
+            page = inbox.page(user_id, page_size, page["next_cursor"])
+        if newest is None:
+            self.view.display_message("No tens cap notificació.")
+        elif page["next_cursor"] is None:
+            # El cursor de lectura és un sol ID: només avança si s'han vist totes les pàgines
+            inbox.mark_read(user_id, newest)
+        else:
+            self.view.display_message("Les notificacions es marcaran com a llegides quan les hagis vist totes.")
+
+    def send_reminders(self):
+        self.view.display_message("\n--- RECORDATORIS DE CITES ---")
+        hours = int(validate_input("Hores d'antelació (per defecte 24): ",
+                                   lambda x: not x.strip() or x.strip().isdigit(), "Introdueix un nombre d'hores.") or 24)
+        created = self.send_appointment_reminders(hours)
+        self.view.display_message(f"S'han enviat {created} recordatoris de cites de les properes {hours} hores.")
+
 class ParameterController:
-    def __init__(self, parameters_manager, users_controller, view):
+    def __init__(self, parameters_manager, users_controller, view, measurement_store=None):
         self.parameters_manager = parameters_manager
         self.users_controller = users_controller
         self.view = view
+        self.measurement_store = measurement_store
 
     
     def view_parameters(self):
         self.view.display_message("\n--- VEURE PARÀMETRES DE SALUT ---")
         user_id = self.users_controller.confirm_user_id()
-        parameters = self.parameters_manager.read()
-    
-        # Filtrem paràmetres per l'usuari en específic
-        user_parameters = [p for p in parameters if p["user_id"] == user_id]
+        if self.measurement_store is not None and self.measurement_store.aggregates is not None:
+            self.display_summary(user_id, self.measurement_store.summary(user_id))
+            return
+        # Consultem només els paràmetres de l'usuari (particions pròpies o índex)
+        if self.measurement_store is not None:
+            user_parameters = self.measurement_store.query(user_id)
+        else:
+            user_parameters = self.parameters_manager.find("user_id", user_id)
     
         if user_parameters:
             for param in user_parameters:
@@ -582,6 +2664,22 @@ class ParameterController:
                 self.view.display_message(f"{constant}: {value}")
         else:
             self.view.display_message("No s'han trobat paràmetres per aquest usuari.")
+
+    def display_summary(self, user_id, summary):
+        """Mostra el darrer valor de cada constant i els agregats de cada finestra."""
+        if not summary:
+            self.view.display_message("No s'han trobat paràmetres per aquest usuari.")
+            return
+        self.view.display_message(f"\n--- PARÀMETRES DE SALUT DE L'USUARI {user_id} ---")
+        for constant, values in summary.items():
+            self.view.display_message(f"{constant}: {values['last']} ({values['timestamp']})")
+            for window, stats in values.items():
+                if not isinstance(stats, dict) or not stats["count"]:
+                    continue
+                self.view.display_message(
+                    f"  {window}: n={stats['count']} mín={stats['min']} màx={stats['max']} "
+                    f"mitjana={stats['mean']:.1f} p50={stats['p50']} p90={stats['p90']} p99={stats['p99']}"
+                )
             
 class MedicalProfileController:
     def __init__(self, profiles_manager, users_controller, view):
@@ -619,23 +2717,28 @@ class MedicalProfileController:
 
         # Crear i guardar el perfil mèdic
         profile = Factory.create_medical_profile(user_id, birth_date, gender, blood_group, allergies, address, phone, medical_comment, medications)
-        profiles.append(profile)
-        self.profiles_manager.write(["user_id", "birth_date", "gender", "blood_group", "allergies", "address", "phone", "medical_comment", "medications"], profiles)
+        self.profiles_manager.write(["user_id", "birth_date", "gender", "blood_group", "allergies", "address", "phone", "medical_comment", "medications"], [profile])
         self.view.display_message(f"Perfil mèdic creat amb èxit per l'usuari {user_id}.")
          
 class IoTDeviceController:
-    def __init__(self, iot_manager, constants_manager, thresholds_manager, alerts_manager, users_controller, view):
+    def __init__(self, iot_manager, constants_manager, thresholds_manager, alerts_manager, users_controller, view,
+                 measurement_store=None, alert_dispatcher=None, anomaly_detector=None, liveness_monitor=None):
         self.iot_manager = iot_manager
         self.constants_manager = constants_manager
         self.thresholds_manager = thresholds_manager  
         self.alerts_manager = alerts_manager
         self.users_controller = users_controller
         self.view = view
+        self.measurement_store = measurement_store
+        self.threshold_table = ThresholdTable(thresholds_manager)
+        self.alert_dispatcher = alert_dispatcher
+        self.anomaly_detector = anomaly_detector
+        self.liveness_monitor = liveness_monitor
+        self._devices, self._devices_version = {}, object()
 
     def add_iot_device(self):
         self.view.display_message("\n--- AFEGIR DISPOSITIU IoT ---")
         user_id = self.users_controller.confirm_user_id()
-        devices = self.iot_manager.read()
 
         name = self.view.get_input("Introdueix el nom del dispositiu IoT: ")
         serial_number = self.view.get_input("Introdueix el número de sèrie únic: ")
@@ -647,8 +2750,7 @@ class IoTDeviceController:
             "user_id": user_id,
             **Factory.create_iot_device(name, serial_number, constants_list, sampling_frequency)
         }
-        devices.append(new_device)
-        self.iot_manager.write(["user_id", "name", "serial_number", "constants", "sampling_frequency"], devices)
+        self.iot_manager.write(["user_id", "name", "serial_number", "constants", "sampling_frequency"], [new_device])
         self.view.display_message(f"Dispositiu IoT '{name}' afegit per l'usuari amb ID {user_id}.")
 
     def configure_thresholds(self):
@@ -665,15 +2767,13 @@ class IoTDeviceController:
             "units": units.strip() if units else None,
         }
 
-        thresholds_data = self.thresholds_manager.read()
-        thresholds_data.append(thresholds)
-        self.thresholds_manager.write(["constant", "min_level", "max_level", "units"], thresholds_data)
+        self.thresholds_manager.write(["constant", "min_level", "max_level", "units"], [thresholds])
         self.view.display_message(f"Llindars configurats per la constant '{constant}'.")
 
     def record_measurement(self):
         self.view.display_message("\n--- REGISTRAR UNA MESURA ---")
         user_id = self.users_controller.confirm_user_id()
-        devices = [d for d in self.iot_manager.read() if d["user_id"] == user_id]
+        devices = self.iot_manager.find("user_id", user_id)
 
         if not devices:
             self.view.display_message("Aquest usuari no té dispositius IoT associats.")
@@ -698,36 +2798,185 @@ class IoTDeviceController:
 
         value = float(self.view.get_input(f"Introdueix el valor de {constant}: "))
         timestamp = datetime.now().isoformat()
+        if self.liveness_monitor is not None:
+            self.liveness_monitor.heartbeat(device.get("serial_number"), user_id, timestamp,
+                                            device.get("sampling_frequency"))
 
-        # Afegim la mesura al fitxer de constants
-        parameters = self.constants_manager.read()
-        parameters.append({
-            "user_id": user_id,
-            "constant": constant,
-            "value": value,
-            "timestamp": timestamp
-        })
-        self.constants_manager.write(["user_id", "constant", "value", "timestamp"], parameters)
+        # Afegim la mesura a la partició de l'usuari o al final del fitxer de constants
+        if self.measurement_store is not None:
+            self.measurement_store.append(user_id, constant, value, timestamp)
+        else:
+            self.constants_manager.write(["user_id", "constant", "value", "timestamp"], [{
+                "user_id": user_id,
+                "constant": constant,
+                "value": value,
+                "timestamp": timestamp
+            }])
         self.view.display_message(f"Mesura registrada: {constant} = {value} (Usuari ID {user_id})")
 
-        # Comprovar llindars i generar alerta si cal
-        self.check_thresholds(constant, value, user_id)
+        # Comprovar detectors i llindars i generar una sola alerta si cal
+        detectors = self.check_anomalies(constant, value, user_id, timestamp, enqueue=False)
+        self.check_thresholds(constant, value, user_id, timestamp, detectors)
 
-    def check_thresholds(self, constant, value, user_id):
-        thresholds = self.thresholds_manager.read()
-        threshold = next((t for t in thresholds if t["constant"] == constant), None)
-    
-        if not threshold:
-            self.view.display_message(f"No hi ha llindars configurats per la constant {constant}.")
-            return
+    @staticmethod
+    def _declared_constants(device):
+        """Constants que declara un dispositiu (llista JSON, llista Python o text separat per comes)."""
+        constants = device.get("constants") or []
+        if isinstance(constants, str):
+            constants = ast.literal_eval(constants) if constants.startswith("[") else constants.split(",")
+        return {str(c).strip().lower(): str(c).strip() for c in constants if str(c).strip()}
+
+    def _device_registry(self):
+        """Dispositius ja consultats, vàlids mentre dispositius_iot.csv no canviï."""
+        version = self.iot_manager.version()
+        if version != self._devices_version:
+            self._devices, self._devices_version = {}, version
+        return self._devices
+
+    def _device_entry(self, serial_number):
+        device = self.iot_manager.find_one("serial_number", serial_number)
+        return device, (self._declared_constants(device) if device is not None else {})
+
+    def device_info(self, serial_number):
+        """Retorna (dispositiu, constants declarades) pel número de sèrie; el dispositiu és None si no existeix."""
+        registry = self._device_registry()
+        if serial_number not in registry:
+            registry[serial_number] = self._device_entry(serial_number)
+        return registry[serial_number]
+
+    def ingest_measurements(self, readings):
+        """
+        Registra un lot de mesures sense interacció.
+        `readings` és una llista de tuples (user_id, serial_number, constant, value, timestamp).
+        Cada mesura es valida contra les constants declarades pel dispositiu, totes
+        les vàlides es desen en una sola escriptura i després es comproven els llindars
+        de tot el lot i, si n'hi ha, els detectors d'anomalies. Retorna un diccionari
+        amb les mesures acceptades, les rebutjades (amb el motiu), les que superen els
+        llindars i les anòmales.
+        """
+        registry = self._device_registry()
+        accepted, rejected = [], []
+        heartbeats = {}  # número de sèrie -> (user_id, darrer moment, freqüència)
+        for reading in readings:
+            user_id, serial_number, constant, value, timestamp = reading
+            if serial_number not in registry:
+                registry[serial_number] = self._device_entry(serial_number)
+            device, constants = registry[serial_number]
+            if device is None:
+                rejected.append((reading, "Dispositiu no registrat"))
+                continue
+            if device.get("user_id") and str(device["user_id"]) != str(user_id):
+                rejected.append((reading, "El dispositiu pertany a un altre usuari"))
+                continue
+            declared = constants.get(str(constant).strip().lower())
+            if declared is None:
+                rejected.append((reading, "Constant no declarada pel dispositiu"))
+                continue
+            try:
+                value = float(value)
+                timestamp = MeasurementStore._to_datetime(timestamp)
+            except (TypeError, ValueError):
+                rejected.append((reading, "Valor o data no vàlids"))
+                continue
+            accepted.append((str(user_id), declared, value, timestamp.isoformat()))
+            if serial_number not in heartbeats or timestamp > heartbeats[serial_number][1]:
+                heartbeats[serial_number] = (str(user_id), timestamp, device.get("sampling_frequency"))
+
+        # Un sol batec per dispositiu i lot per al control de vida
+        if self.liveness_monitor is not None:
+            for serial_number, (user_id, timestamp, frequency) in heartbeats.items():
+                self.liveness_monitor.heartbeat(serial_number, user_id, timestamp, frequency)
+
+        # Una sola escriptura per a tot el lot
+        if accepted:
+            if self.measurement_store is not None:
+                self.measurement_store.append_many(accepted)
+            else:
+                self.constants_manager.append(
+                    ["user_id", "constant", "value", "timestamp"],
+                    [{"user_id": u, "constant": c, "value": v, "timestamp": t} for u, c, v, t in accepted]
+                )
 
-        try:
-            min_level = float(threshold["min_level"]) if threshold["min_level"] else float('-inf')
-            max_level = float(threshold["max_level"]) if threshold["max_level"] else float('inf')
-            if value < min_level or value > max_level:
-                self.generate_alert(constant, value, threshold, user_id)
-        except ValueError as e:
-            self.view.display_message(f"Error al validar llindars: {e}. Els valors no són vàlids per la constant {constant}.")
+        # Llindars de tot el lot en una sola avaluació
+        out_of_range = self.threshold_table.evaluate_batch([m[1] for m in accepted], [m[2] for m in accepted])
+        breaches = [
+            {"user_id": user_id, "constant": constant, "value": value, "timestamp": timestamp,
+             "threshold": self.threshold_table.limits(constant)[2]}
+            for (user_id, constant, value, timestamp), flagged in zip(accepted, out_of_range) if flagged
+        ]
+        anomalies = []
+        if self.anomaly_detector is not None:
+            for user_id, constant, value, timestamp in accepted:
+                detectors = self.anomaly_detector.observe(user_id, constant, value, timestamp)
+                if detectors:
+                    anomalies.append({"user_id": user_id, "constant": constant, "value": value,
+                                      "timestamp": timestamp, "detectors": detectors})
+        if self.alert_dispatcher is not None:
+            # Una sola alerta per mesura, amb els detectors que s'hi hagin disparat
+            fired = {(a["user_id"], a["constant"], a["timestamp"]): a for a in anomalies}
+            for breach in breaches:
+                limits = self.threshold_table.limits(breach["constant"])
+                anomaly = fired.pop((breach["user_id"], breach["constant"], breach["timestamp"]), None)
+                self.alert_dispatcher.enqueue(breach["user_id"], breach["constant"], breach["value"], limits[:2],
+                                              breach["timestamp"], anomaly["detectors"] if anomaly else None)
+            for anomaly in fired.values():
+                self.alert_dispatcher.enqueue(anomaly["user_id"], anomaly["constant"], anomaly["value"], None,
+                                              anomaly["timestamp"], anomaly["detectors"])
+            # Mesures normals de sèries amb alertes obertes: tancament de l'episodi
+            if self.alert_dispatcher.open_series:
+                flagged = {(a["user_id"], a["constant"], a["timestamp"]) for a in anomalies}
+                for (user_id, constant, value, timestamp), out in zip(accepted, out_of_range):
+                    if not out and (user_id, constant, timestamp) not in flagged:
+                        self.alert_dispatcher.recover(user_id, constant, value, timestamp)
+        return {"accepted": len(accepted), "rejected": rejected, "breaches": breaches, "anomalies": anomalies}
+
+    def check_thresholds(self, constant, value, user_id, timestamp=None, detectors=None):
+        """
+        Comprova els llindars de la mesura. Amb distribuïdor d'alertes s'encua una
+        sola alerta per mesura, amb els `detectors` d'anomalies que s'hi hagin
+        disparat (com a ingest_measurements); una mesura normal tanca l'episodi obert.
+        """
+        limits = None
+        error = self.threshold_table.error(constant)
+        if error:
+            self.view.display_message(f"Error al validar llindars: {error}. Els valors no són vàlids per la constant {constant}.")
+        else:
+            limits = self.threshold_table.limits(constant)
+            if not limits:
+                self.view.display_message(f"No hi ha llindars configurats per la constant {constant}.")
+        out_of_range = limits is not None and (value < limits[0] or value > limits[1])
+
+        if self.alert_dispatcher is None:
+            if out_of_range:
+                self.generate_alert(constant, value, limits[2], user_id)
+        elif out_of_range or detectors:
+            # L'alerta s'encua i s'encamina en segon pla, sense aturar el registre de mesures
+            self.alert_dispatcher.enqueue(user_id, constant, value, limits[:2] if out_of_range else None,
+                                          timestamp, detectors)
+            self.view.display_message(f"Alerta encuada per la constant {constant} (Valor: {value}).")
+        else:
+            self.alert_dispatcher.recover(user_id, constant, value, timestamp)
+
+    def check_liveness(self, now=None):
+        """Comprova els terminis dels dispositius i retorna els que han quedat en silenci."""
+        return self.liveness_monitor.check(now) if self.liveness_monitor is not None else []
+
+    def check_anomalies(self, constant, value, user_id, timestamp=None, enqueue=True):
+        """
+        Passa la mesura pels detectors d'anomalies (a més dels llindars) i avisa si se'n
+        dispara algun. Amb `enqueue=False` només els retorna, perquè check_thresholds
+        els inclogui a l'única alerta de la mesura.
+        """
+        if self.anomaly_detector is None:
+            return []
+        detectors = self.anomaly_detector.observe(user_id, constant, value, timestamp or datetime.now())
+        if detectors:
+            self.view.display_message(
+                f"Anomalia detectada per la constant {constant} (Valor: {value}): {', '.join(detectors)}."
+            )
+            if enqueue and self.alert_dispatcher is not None:
+                self.alert_dispatcher.enqueue(user_id, constant, value, None, timestamp, detectors)
+        return detectors
 
     def generate_alert(self, constant, value, threshold, user_id):
         alert_type = validate_input(
@@ -762,39 +3011,134 @@ class IoTDeviceController:
             "additional_info": additional_info
         }
 
-        alerts_data = self.alerts_manager.read()
-        alerts_data.append(alert)
         self.alerts_manager.write(
             ["user_id", "constant", "value", "risk_level", "contact_number", "additional_info"],
-            alerts_data
+            [alert]
         )
         self.view.display_message(f"Alerta generada per la constant {constant} (Valor: {value}).")
     
     
+DATA_DIR = r"C:\Users\abell\Downloads"
+
+
+def migrate_social_members(social_network_manager, members_manager):
+    """
+    Trasllada els membres guardats dins de la columna `members` de cada xarxa a
+    la taula de membres i deixa la columna buida amb el comptador al dia.
+    Retorna el nombre de membres traslladats (0 si no s'han pogut desar: llavors
+    la columna antiga no es toca).
+    """
+    member_keys = ("name", "dni", "phones", "role", "details")
+    members, networks = [], []
+    for network in social_network_manager.read():
+        embedded = network.get("members") if isinstance(network.get("members"), list) else []
+        if not embedded:
+            continue
+        for member in embedded:
+            if not isinstance(member, dict):
+                continue
+            # Els membres antics guarden els detalls (parentiu, hospital...) com a claus soltes
+            details = {k: v for k, v in member.items() if k not in member_keys}
+            details.update(member.get("details") or {})
+            members.append({"network_id": str(network["network_id"]), "user_id": "",
+                            **{k: member.get(k) for k in member_keys[:4]}, "details": details})
+        networks.append({**network, "members": [], "members_count": len(embedded)})
+    # Primer els membres (la taula es crea encara que no n'hi hagi, perquè la
+    # migració no es repeteixi). compact() no propaga els errors: es comprova
+    # rellegint la taula que hi són tots abans de buidar la columna antiga
+    members_manager.compact(SocialNetworkController.MEMBER_FIELDNAMES, members)
+    written = {(row.get("network_id"), row.get("dni")) for row in members_manager.read()}
+    if any((member["network_id"], member["dni"]) not in written for member in members):
+        print("No s'han pogut desar els membres de les xarxes; la columna `members` es conserva.")
+        return 0
+    if networks:
+        social_network_manager.write(SocialNetworkController.NETWORK_FIELDNAMES + ["members"], networks)
+    return len(members)
+
+
+def create_managers(data_dir=DATA_DIR, read_only=False):
+    """
+    Crea els gestors de totes les taules (amb índexs, clau primària, esquema i
+    registre WAL) i el magatzem de mesures. Retorna un diccionari per nom de taula.
+    Amb `read_only` el registre WAL només es llegeix i no es fa la importació
+    inicial de mesures ni la retenció (p. ex. als processos de fragment, que
+    només llegeixen les taules i escriuen mesures dels seus usuaris).
+    """
+    path = lambda name: os.path.join(data_dir, name)
+    managers = {
+        "users": CSVManager(path("usuaris.csv"), indexes=("email",), primary_key="user_id", schema={}),
+        "appointments": CSVManager(path("cites.csv"), indexes=("user_id",), primary_key="appointment_id",
+                                   schema={"date": "date"}),
+        "notifications": CSVManager(path("notificacions.csv"), indexes=("user_id", "reminder_key"),
+                                    primary_key="notification_id", schema={}),
+        "notification_reads": CSVManager(path("notificacions_llegides.csv"), primary_key="user_id",
+                                         schema={"last_read_id": "int"}),
+        "profiles": CSVManager(path("perfils_medics.csv"), primary_key="user_id", schema={"birth_date": "date"}),
+        "social_networks": CSVManager(path("xarxes_socials.csv"), primary_key="network_id",
+                                      schema={"members_count": "int", "members": "pyliteral"}),
+        "social_members": CSVManager(path("membres_xarxes.csv"), indexes=("network_id", "dni"),
+                                     schema={"phones": "strlist", "details": "json"}),
+        "parameters": CSVManager(path("constants.csv"), indexes=("user_id",), schema={"value": "float"}),
+        "iot": CSVManager(path("dispositius_iot.csv"), indexes=("user_id", "serial_number"),
+                          schema={"constants": "strlist", "sampling_frequency": "float"}),
+        "thresholds": CSVManager(path("thresholds.csv"), primary_key="constant",
+                                 schema={"min_level": "float", "max_level": "float"}),
+        "alerts": CSVManager(path("alertes.csv"), schema={"value": "float", "additional_info": "json"}),
+    }
+    measurement_store = MeasurementStore(path("mesures"), aggregates=RollingAggregates())
+    managers["measurements"] = measurement_store
+    for manager in managers.values():
+        if isinstance(manager, CSVManager):
+            # Escriptures duradores amb registre WAL (i replay del que hagi quedat pendent);
+            # els lectors veuen també les files que el procés principal encara no ha compactat
+            manager.enable_wal(read_only=read_only)
+    if read_only:
+        return managers
+    if managers["social_members"].version() is None and managers["social_networks"].version() is not None:
+        # Primera execució: els membres de la columna `members` passen a la seva taula
+        migrate_social_members(managers["social_networks"], managers["social_members"])
+    if measurement_store.is_empty() and managers["parameters"].version() is not None:
+        # Primera execució: es traslladen les mesures existents a les particions
+        measurement_store.import_rows(managers["parameters"].iter_rows())
+    measurement_store.enable_retention()
+    return managers
+
+
 def main_menu():
     # Models
-    users_manager = CSVManager(r"C:\Users\abell\Downloads\usuaris.csv")
-    appointments_manager = CSVManager(r"C:\Users\abell\Downloads\cites.csv")
-    notifications_manager = CSVManager(r"C:\Users\abell\Downloads\notificacions.csv")
-    profiles_manager = CSVManager(r"C:\Users\abell\Downloads\perfils_medics.csv")
-    social_network_manager = CSVManager(r"C:\Users\abell\Downloads\xarxes_socials.csv")
-    parameters_manager = CSVManager(r"C:\Users\abell\Downloads\constants.csv")
-    iot_manager = CSVManager(r"C:\Users\abell\Downloads\dispositius_iot.csv")
-    thresholds_manager = CSVManager(r"C:\Users\abell\Downloads\thresholds.csv")  
-    alert_manager = CSVManager(r"C:\Users\abell\Downloads\alertes.csv")
+    managers = create_managers()
+    users_manager = managers["users"]
+    appointments_manager = managers["appointments"]
+    notifications_manager = managers["notifications"]
+    profiles_manager = managers["profiles"]
+    social_network_manager = managers["social_networks"]
+    parameters_manager = managers["parameters"]
+    iot_manager = managers["iot"]
+    thresholds_manager = managers["thresholds"]
+    alert_manager = managers["alerts"]
+    measurement_store = managers["measurements"]
 
     # Views
     view = View()
 
     # Controllers
     users_controller = UserController(users_manager, view)
-    appointment_controller = AppointmentController(appointments_manager, users_controller, view)
-    notification_controller = NotificationController(notifications_manager, users_controller, view)
-    parameter_controller = ParameterController(parameters_manager, users_controller, view)
+    appointment_controller = AppointmentController(appointments_manager, users_controller, view,
+                                                   AppointmentCalendar(appointments_manager))
+    notification_controller = NotificationController(
+        notifications_manager, users_controller, view, appointments_manager,
+        NotificationInbox(notifications_manager, managers["notification_reads"])
+    )
+    parameter_controller = ParameterController(parameters_manager, users_controller, view, measurement_store)
     medical_controller = MedicalProfileController(profiles_manager, users_controller, view)
-    social_network_controller = SocialNetworkController(social_network_manager, users_controller, view)
+    care_index = CareNetworkIndex(managers["social_members"])
+    social_network_controller = SocialNetworkController(social_network_manager, users_controller, view,
+                                                        managers["social_members"], care_index)
+    alert_dispatcher = AlertDispatcher(alert_manager, profiles_manager, care_index=care_index).start()
     iot_controller = IoTDeviceController(
-        iot_manager, parameters_manager, thresholds_manager, alert_manager, users_controller, view
+        iot_manager, parameters_manager, thresholds_manager, alert_manager, users_controller, view,
+        measurement_store=measurement_store, alert_dispatcher=alert_dispatcher,
+        anomaly_detector=AnomalyDetector()
     )
 
     print(Fore.BLUE + Style.BRIGHT + "\n\nBenvingut a SeniorLife! El teu gestor mèdic de confiança.\n")
@@ -809,8 +3153,7 @@ def main_menu():
 
         if choice == "1":
             email = view.get_input("Introdueix el teu correu electrònic: ")
-            users = users_manager.read()
-            current_user = next((u for u in users if u["email"] == email), None)
+            current_user = users_manager.find_one("email", email)
             if current_user:
                 user_type = current_user["type"]  # Assigna el tipus d'usuari des del fitxer
                 view.display_message(f"\nBenvingut/a de nou, {current_user['name']}!")
@@ -825,14 +3168,13 @@ def main_menu():
 
             if user_type_choice in ["1", "2", "3"]:
                 user_type = "pacient" if user_type_choice == "1" else "metge" if user_type_choice == "2" else "familiar"
-                users = users_manager.read()
                 email = view.get_input("Introdueix el teu correu electrònic per registrar-te: ")
-                if any(u["email"] == email for u in users):
+                if users_manager.find_one("email", email):
                     view.display_message("Aquest correu ja està registrat. Si us plau, inicia sessió.")
                 else:
                     name = view.get_input("Introdueix el teu nom: ")
                     registration_date = format_date(datetime.now())
-                    user_id = len(users) + 1
+                    user_id = users_manager.next_id()
 
                     if user_type == "pacient":
                         medical_record = view.get_input("Introdueix l'historial mèdic (opcional): ")
@@ -849,10 +3191,9 @@ def main_menu():
                     user_dict = new_user.__dict__
                     user_dict["type"] = user_type  # Afegir explícitament el tipus d'usuari
 
-                    users.append(user_dict)
                     users_manager.write(
                         ["user_id", "name", "email", "registration_date", "type", "medical_record", "specialty", "colegiate_number", "relationship"],
-                        users
+                        [user_dict]
                     )
                     view.display_message(f"Usuari registrat amb èxit. Benvingut/da, {name}!")
                     # Un cop registrat, es reinicia el menú principal
@@ -860,6 +3201,7 @@ def main_menu():
                 view.display_message("Tipus d'usuari no vàlid. Si us plau, intenta-ho de nou.")
         elif choice == "3":
             view.display_message("\nSortint del sistema... Gràcies per confiar en SeniorLife!")
+            alert_dispatcher.stop()
             return
         else:
             view.display_message("Opció no vàlida. Si us plau, intenta-ho de nou.")
@@ -873,12 +3215,15 @@ def main_menu():
             print("2. Crear perfil mèdic")
             print("3. Veure paràmetres de salut")
             print("4. Gestionar xarxa social")
+            print("5. Consultar hores lliures d'un metge")
+            print("6. Veure notificacions")
         elif current_user["type"] == "metge":
             print("1. Enviar notificació")
             print("2. Afegir dispositiu IoT")
             print("3. Configurar llindars")
             print("4. Registrar mesura")
             print("5. Veure paràmetres de salut")
+            print("6. Enviar recordatoris de cites")
         elif current_user["type"] == "familiar":
             print("1. Gestionar xarxa social")
         print("9. Sortir")
@@ -886,6 +3231,7 @@ def main_menu():
 
         if choice == "9":  # Afegit per sortir del bucle principal
             view.display_message("\nSortint del sistema... Gràcies per confiar en SeniorLife!")
+            alert_dispatcher.stop()  # Desa les alertes que encara són a la cua
             running = False
         elif current_user["type"] == "pacient":
             if choice == "1":
@@ -896,6 +3242,10 @@ def main_menu():
                 parameter_controller.view_parameters()
             elif choice == "4":
                 social_network_controller.manage_social_network()
+            elif choice == "5":
+                appointment_controller.view_free_slots()
+            elif choice == "6":
+                notification_controller.view_inbox()
             else:
                 view.display_message("Opció no vàlida. Si us plau, intenta-ho de nou.")
         elif current_user["type"] == "metge":
@@ -909,6 +3259,8 @@ def main_menu():
                 iot_controller.record_measurement()
             elif choice == "5":
                 parameter_controller.view_parameters()
+            elif choice == "6":
+                notification_controller.send_reminders()
             else:
                 view.display_message("Opció no vàlida. Si us plau, intenta-ho de nou.")
         elif current_user["type"] == "familiar":
@@ -917,8 +3269,634 @@ def main_menu():
             else:
                 view.display_message("Opció no vàlida. Si us plau, intenta-ho de nou.")
 
+# ------------------ Ingestion server ------------------
+
+class IngestionServer:
+    """
+    Servidor asyncio local (TCP o socket Unix) per on els dispositius IoT
+    registrats envien mesures. Protocol de línies JSON:
+        {"serial_number": "HM001", "user_id": "3", "constant": "Heart Rate", "value": 72.0, "timestamp": "..."}
+    A cada línia es respon {"ok": true} o {"ok": false, "error": "..."}.
+    Les mesures vàlides s'acumulen i es desen per lots en un fil apart
+    (IoTDeviceController.ingest_measurements), sense bloquejar el bucle d'esdeveniments.
+    Els lots es desen d'un en un; si un lot falla, se'n torna a desar cada mesura
+    per separat i les que continuen fallant es compten a `stats["failed"]`.
+    Com que el controlador no és segur entre fils, les consultes de dispositius
+    esperen que acabi el lot en curs.
+    """
+
+    def __init__(self, iot_controller, host="127.0.0.1", port=8765, unix_path=None,
+                 batch_size=2000, flush_interval=0.2):
+        self.iot_controller = iot_controller
+        self.host, self.port, self.unix_path = host, port, unix_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.stats = {"connections": 0, "received": 0, "rejected": 0, "stored": 0, "breaches": 0, "failed": 0}
+        self._buffer = []
+        self._server = None
+        self._flusher = None
+        self._controller_lock = None
+
+    def _lock(self):
+        """Bloqueig (asyncio) que comparteixen el lot en curs i les consultes de dispositius."""
+        if self._controller_lock is None:
+            self._controller_lock = asyncio.Lock()
+        return self._controller_lock
+
+    def _validate(self, message):
+        """
+        Comprova el missatge contra el registre de dispositius (amb les mateixes
+        regles que IoTDeviceController.ingest_measurements). Retorna (mesura, error).
+        """
+        try:
+            serial_number = str(message["serial_number"])
+            user_id = str(message["user_id"])
+            constant = str(message["constant"])
+            value = float(message["value"])
+            timestamp = message.get("timestamp") or datetime.now().isoformat()
+            MeasurementStore._to_datetime(timestamp)
+        except (KeyError, TypeError, ValueError):
+            return None, "Falten camps, o el valor o la data no són vàlids"
+        device, constants = self.iot_controller.device_info(serial_number)
+        if device is None:
+            return None, "Dispositiu no registrat"
+        if device.get("user_id") and str(device["user_id"]) != user_id:
+            return None, "El dispositiu pertany a un altre usuari"
+        if constant.strip().lower() not in constants:
+            return None, "Constant no declarada pel dispositiu"
+        return (user_id, serial_number, constant, value, timestamp), None
+
+    async def _handle(self, reader, writer):
+        self.stats["connections"] += 1
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except (ValueError, asyncio.LimitOverrunError):
+                    # Línia més llarga que el límit del flux: es descarta i es continua amb la següent
+                    line, error = None, "Línia massa llarga"
+                else:
+                    if not line:
+                        break
+                if line is not None:
+                    try:
+                        message = json.loads(line)
+                        async with self._lock():
+                            reading, error = self._validate(message)
+                    except (ValueError, AttributeError):
+                        # JSON mal format o bytes que no són UTF-8 (UnicodeDecodeError)
+                        reading, error = None, "JSON no vàlid"
+                self.stats["received"] += 1
+                if error:
+                    self.stats["rejected"] += 1
+                    writer.write(json.dumps({"ok": False, "error": error}).encode() + b"\n")
+                else:
+                    self._buffer.append(reading)
+                    writer.write(b'{"ok": true}\n')
+                    if len(self._buffer) >= self.batch_size:
+                        await self.flush()
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def flush(self):
+        """
+        Desa el lot acumulat en un fil del pool perquè el bucle no es bloquegi.
+        Només hi ha un lot en curs alhora: el controlador no és segur entre fils.
+        Les mesures que el controlador rebutja es compten a `stats["rejected"]`.
+        """
+        async with self._lock():
+            if not self._buffer:
+                return
+            batch, self._buffer = self._buffer, []
+            loop = asyncio.get_running_loop()
+            try:
+                result = await loop.run_in_executor(None, self.iot_controller.ingest_measurements, batch)
+            except Exception as e:
+                # Els clients ja han rebut la confirmació: es reintenta mesura a mesura
+                print(f"Error en desar un lot de {len(batch)} mesures: {e}")
+                result = await loop.run_in_executor(None, self._ingest_each, batch)
+            self.stats["stored"] += result["accepted"]
+            self.stats["rejected"] += len(result["rejected"])
+            self.stats["breaches"] += len(result["breaches"])
+
+    def _ingest_each(self, batch):
+        """Desa les mesures d'un lot que ha fallat una a una i compta les que no es poden desar."""
+        accepted, rejected, breaches = 0, [], []
+        for reading in batch:
+            try:
+                result = self.iot_controller.ingest_measurements([reading])
+            except Exception as e:
+                self.stats["failed"] += 1
+                print(f"Mesura descartada {reading}: {e}")
+                continue
+            accepted += result["accepted"]
+            rejected += result["rejected"]
+            breaches += result["breaches"]
+        return {"accepted": accepted, "rejected": rejected, "breaches": breaches}
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Error en el desament periòdic de mesures: {e}")
+
+    async def start(self):
+        if self.unix_path:
+            self._server = await asyncio.start_unix_server(self._handle, path=self.unix_path)
+        else:
+            self._server = await asyncio.start_server(self._handle, self.host, self.port, backlog=4096)
+        self._flusher = asyncio.create_task(self._flush_periodically())
+        return self
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.stop()
+
+    async def stop(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        await self.flush()
+
+
+def run_ingestion_server(host="127.0.0.1", port=8765, unix_path=None, data_dir=DATA_DIR, shards=0):
+    """Arrenca el servidor d'ingesta amb les taules de `data_dir` (repartint-la en `shards` processos si n'hi ha)."""
+    managers = create_managers(data_dir)
+    alert_dispatcher = AlertDispatcher(managers["alerts"], managers["profiles"],
+                                       care_index=CareNetworkIndex(managers["social_members"])).start()
+    liveness_monitor = None
+    if not shards:
+        # Amb fragments, cada procés vigila els seus dispositius
+        liveness_monitor = LivenessMonitor(alert_dispatcher)
+        liveness_monitor.watch_devices(managers["iot"].read())
+        liveness_monitor.start()
+    iot_controller = IoTDeviceController(
+        managers["iot"], managers["parameters"], managers["thresholds"], managers["alerts"], None, View(),
+        measurement_store=managers["measurements"], alert_dispatcher=alert_dispatcher,
+        anomaly_detector=AnomalyDetector(), liveness_monitor=liveness_monitor
+    )
+    if shards:
+        ingestion = ShardedIngestion(iot_controller, data_dir, shards, liveness_interval=10.0).start()
+    else:
+        ingestion = iot_controller
+    server = IngestionServer(ingestion, host, port, unix_path)
+    print(Fore.BLUE + f"Servidor d'ingesta escoltant a {unix_path or f'{host}:{port}'}")
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if shards:
+            ingestion.stop()
+        else:
+            liveness_monitor.stop()
+        alert_dispatcher.stop()
+
+
+# ------------------ Sharded ingestion ------------------
+
+def shard_of(user_id, shards):
+    """Fragment estable (independent del procés) que correspon a un usuari."""
+    return zlib.crc32(str(user_id).encode("utf-8")) % shards
+
+
+class AlertForwarder:
+    """
+    Substitut d'AlertDispatcher dins d'un procés de fragment: enregistra en
+    ordre les crides enqueue/recover perquè el procés principal les repeteixi
+    sobre el distribuïdor real. Com que cada usuari sempre va al mateix fragment,
+    `open_series` coincideix amb el del distribuïdor per als usuaris del fragment.
+    """
+
+    def __init__(self):
+        self.open_series = set()
+        self.pending = []
+
+    def enqueue(self, user_id, constant, value, limits=None, timestamp=None, detectors=None, info=None):
+        self.open_series.add((str(user_id), ThresholdTable.normalize(constant)))
+        self.pending.append(("enqueue", (user_id, constant, value, limits, timestamp, detectors, info)))
+
+    def recover(self, user_id, constant, value, timestamp=None):
+        series = (str(user_id), ThresholdTable.normalize(constant))
+        if series not in self.open_series:
+            return False
+        self.open_series.discard(series)
+        self.pending.append(("recover", (user_id, constant, value, timestamp)))
+        return True
+
+    def drain(self):
+        pending, self.pending = self.pending, []
+        return pending
+
+
+def _shard_worker(data_dir, shard, shards, inbox, outbox):
+    """
+    Bucle d'un procés de fragment: és l'únic que escriu les mesures dels seus
+    usuaris, n'avalua llindars i anomalies i en manté els agregats.
+    """
+    managers = create_managers(data_dir, read_only=True)
+    store = managers["measurements"]
+    store.enable_retention(owns=lambda user_id: shard_of(user_id, shards) == shard)
+    forwarder = AlertForwarder()
+    liveness_monitor = LivenessMonitor(forwarder)
+    liveness_monitor.watch_devices(d for d in managers["iot"].read() if shard_of(d.get("user_id"), shards) == shard)
+    controller = IoTDeviceController(
+        managers["iot"], managers["parameters"], managers["thresholds"], managers["alerts"], None, View(),
+        measurement_store=store, alert_dispatcher=forwarder, anomaly_detector=AnomalyDetector(),
+        liveness_monitor=liveness_monitor
+    )
+    for request_id, command, args in iter(inbox.get, None):
+        try:
+            if command == "ingest":
+                result = controller.ingest_measurements(args)
+                result["alerts"] = forwarder.drain()
+            elif command == "liveness":
+                result = {"silent": controller.check_liveness(*args), "alerts": forwarder.drain()}
+            elif command == "query":
+                result = store.query(*args)
+            elif command == "summary":
+                result = store.summary(*args)
+            else:
+                raise ValueError(f"Ordre desconeguda: {command}")
+            outbox.put((request_id, result, None))
+        except Exception as e:
+            outbox.put((request_id, None, f"{type(e).__name__}: {e}"))
+    store.close()
+
+
+class ShardedIngestion:
+    """
+    Ingesta de mesures repartida per user_id entre `shards` processos. Cada
+    fragment és l'únic escriptor de les particions dels seus usuaris; el procés
+    principal valida dispositius, reparteix els lots, combina els resultats i
+    repeteix les alertes sobre l'AlertDispatcher del controlador. Les consultes
+    (`query`, `query_many`, `summary`) passen pel fragment propietari, de manera
+    que veuen exactament el que aquest ha escrit.
+    Es pot fer servir on s'espera un IoTDeviceController per ingerir (servidor,
+    simulador): ofereix `device_info` i `ingest_measurements`. Si un fragment
+    s'atura o no respon en `timeout` segons, la petició falla en lloc d'esperar
+    indefinidament.
+    """
+
+    def __init__(self, iot_controller, data_dir, shards=None, liveness_interval=None, timeout=60.0):
+        self.iot_controller = iot_controller
+        self.liveness_interval = liveness_interval
+        self.timeout = timeout
+        self.data_dir = data_dir
+        self.shards = shards or os.cpu_count() or 1
+        self._context = multiprocessing.get_context("spawn")  # Igual a Windows i Linux
+        self._processes, self._inboxes = [], []
+        self._outbox = None
+        self._pending = {}  # id de petició -> Future
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._receiver = None
+        self._shard_cache = {}
+
+    def start(self):
+        # Les particions de mesures passen a ser només dels fragments
+        measurement_store = self.iot_controller.measurement_store
+        if measurement_store is not None:
+            measurement_store.close()
+        self._outbox = self._context.Queue()
+        for shard in range(self.shards):
+            inbox = self._context.Queue()
+            process = self._context.Process(target=_shard_worker, name=f"shard-{shard}", daemon=True,
+                                            args=(self.data_dir, shard, self.shards, inbox, self._outbox))
+            process.start()
+            self._inboxes.append(inbox)
+            self._processes.append(process)
+        self._receiver = threading.Thread(target=self._receive, name="shard-receiver", daemon=True)
+        self._receiver.start()
+        if self.liveness_interval:
+            self._ticker = threading.Event()
+            threading.Thread(target=self._check_liveness_periodically, args=(self._ticker, self.liveness_interval),
+                             name="shard-liveness", daemon=True).start()
+        return self
+
+    def _check_liveness_periodically(self, stop, interval):
+        while not stop.wait(interval):
+            self.check_liveness()
+
+    def stop(self):
+        """Atura els fragments (després d'acabar el que tinguin a la cua)."""
+        if getattr(self, "_ticker", None) is not None:
+            self._ticker.set()
+            self._ticker = None
+        for inbox in self._inboxes:
+            inbox.put(None)
+        for process in self._processes:
+            process.join(self.timeout)
+            if process.is_alive():
+                # Fragment encallat: no s'espera indefinidament
+                print(f"El fragment {process.name} no s'ha aturat en {self.timeout} s; es finalitza.")
+                process.terminate()
+                process.join()
+        if self._receiver is not None:
+            self._outbox.put(None)
+            self._receiver.join()
+        self._processes, self._inboxes, self._receiver = [], [], None
+
+    def _receive(self):
+        for request_id, result, error in iter(self._outbox.get, None):
+            try:
+                with self._lock:
+                    future = self._pending.pop(request_id, None)
+                if future is None:
+                    continue  # Resposta tardana d'una petició que ja ha fallat per temps
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(RuntimeError(error))
+            except Exception as e:
+                # Una resposta errònia no pot aturar el fil: la resta de peticions en depenen
+                print(f"Error en rebre la resposta {request_id} d'un fragment: {e}")
+
+    def _submit(self, shard, command, args):
+        future = Future()
+        with self._lock:
+            request_id = next(self._ids)
+            self._pending[request_id] = future
+        self._inboxes[shard].put((request_id, command, args))
+        return future
+
+    def _result(self, shard, future):
+        """Espera la resposta d'un fragment; falla si el procés s'ha aturat o se supera `timeout`."""
+        deadline = time.monotonic() + self.timeout
+        while not wait([future], timeout=min(1.0, max(0.0, deadline - time.monotonic()))).done:
+            process = self._processes[shard]
+            if not process.is_alive():
+                error = RuntimeError(f"El fragment {shard} s'ha aturat (codi de sortida {process.exitcode}).")
+            elif time.monotonic() >= deadline:
+                error = TimeoutError(f"El fragment {shard} no ha respost en {self.timeout} s.")
+            else:
+                continue
+            with self._lock:
+                # La resposta ja no arribarà (o ningú l'espera): es descarta la petició
+                for request_id in [key for key, value in self._pending.items() if value is future]:
+                    del self._pending[request_id]
+            raise error
+        return future.result()
+
+    def shard(self, user_id):
+        user_id = str(user_id)
+        if user_id not in self._shard_cache:
+            self._shard_cache[user_id] = shard_of(user_id, self.shards)
+        return self._shard_cache[user_id]
+
+    def device_info(self, serial_number):
+        return self.iot_controller.device_info(serial_number)
+
+    def ingest_measurements(self, readings):
+        """
+        Reparteix el lot per fragment, l'ingereix en paral·lel i retorna el
+        resultat combinat amb el mateix format que IoTDeviceController.ingest_measurements.
+        """
+        batches = {}
+        for reading in readings:
+            batches.setdefault(self.shard(reading[0]), []).append(reading)
+        futures = [(shard, self._submit(shard, "ingest", batch)) for shard, batch in batches.items()]
+        merged = {"accepted": 0, "rejected": [], "breaches": [], "anomalies": []}
+        for shard, future in futures:
+            result = self._result(shard, future)
+            merged["accepted"] += result["accepted"]
+            for key in ("rejected", "breaches", "anomalies"):
+                merged[key].extend(result[key])
+            self._replay_alerts(result["alerts"])
+        return merged
+
+    def _replay_alerts(self, alerts):
+        dispatcher = self.iot_controller.alert_dispatcher
+        if dispatcher is not None:
+            # Les sèries d'un usuari són d'un sol fragment: l'ordre de cada sèrie es conserva
+            for method, args in alerts:
+                getattr(dispatcher, method)(*args)
+
+    def check_liveness(self, now=None):
+        """Comprova els terminis dels dispositius a tots els fragments i retorna els silenciosos."""
+        silent = []
+        futures = [(shard, self._submit(shard, "liveness", (now,))) for shard in range(self.shards)]
+        for shard, future in futures:
+            result = self._result(shard, future)
+            silent.extend(result["silent"])
+            self._replay_alerts(result["alerts"])
+        return silent
+
+    def query(self, user_id, constant=None, start=None, end=None):
+        shard = self.shard(user_id)
+        return self._result(shard, self._submit(shard, "query", (user_id, constant, start, end)))
+
+    def query_many(self, user_ids, constant=None, start=None, end=None):
+        """Consulta diversos usuaris en paral·lel i retorna les mesures ordenades per usuari i moment."""
+        futures = [(self.shard(user_id), self._submit(self.shard(user_id), "query", (user_id, constant, start, end)))
+                   for user_id in user_ids]
+        rows = [row for shard, future in futures for row in self._result(shard, future)]
+        return sorted(rows, key=lambda row: (row["user_id"], row["timestamp"]))
+
+    def summary(self, user_id, now=None):
+        shard = self.shard(user_id)
+        return self._result(shard, self._submit(shard, "summary", (user_id, now)))
+
+
+# ------------------ Simulator ------------------
+
+class FleetSimulator:
+    """
+    Simulador d'una flota de dispositius IoT per mesurar el rendiment de punta a punta.
+    Genera usuaris, dispositius i fluxos realistes de constants vitals (amb
+    excursions fora de rang) en un directori de dades propi, els fa passar pel
+    camí de mesures i alertes i informa del rendiment, la latència p50/p99 i
+    el pic de memòria (RSS màxim del procés, i dels fragments si n'hi ha, llegit
+    al final perquè la mesura no alenteixi el bucle cronometrat).
+    """
+    # constant -> (valor base, soroll, excursió, unitats, mínim, màxim)
+    VITAL_SIGNS = {
+        "Heart Rate": (72.0, 3.0, 45.0, "bpm", 60.0, 100.0),
+        "Blood Pressure": (105.0, 4.0, 35.0, "mmHg", 90.0, 120.0),
+        "Temperature": (36.6, 0.1, 1.5, "°C", 36.1, 37.2),
+    }
+
+    def __init__(self, data_dir, patients=1000, excursion_rate=0.002, dropout_rate=0.0005, seed=42):
+        self.data_dir = data_dir
+        self.patients = patients
+        self.excursion_rate = excursion_rate
+        self.dropout_rate = dropout_rate  # Probabilitat per mostra que el dispositiu calli 10-30 minuts
+        self.random = random.Random(seed)
+        self.devices = []  # (user_id, serial_number, constant, sampling_frequency)
+
+    def setup(self):
+        """Crea les taules de la flota sintètica i retorna el controlador IoT i el distribuïdor d'alertes."""
+        os.makedirs(self.data_dir, exist_ok=True)
+        managers = create_managers(self.data_dir)
+        managers["thresholds"].write(["constant", "min_level", "max_level", "units"], [
+            {"constant": name, "min_level": low, "max_level": high, "units": units}
+            for name, (_, _, _, units, low, high) in self.VITAL_SIGNS.items()
+        ])
+        users, profiles, devices = [], [], []
+        today = format_date(datetime.now())
+        constants = list(self.VITAL_SIGNS)
+        for user_id in managers["users"].reserve_ids(self.patients):
+            constant = constants[user_id % len(constants)]
+            serial_number = f"SIM{user_id:07d}"
+            frequency = self.random.randint(30, 60)
+            users.append({"user_id": user_id, "name": f"Pacient {user_id}", "email": f"pacient{user_id}@sim.local",
+                          "registration_date": today, "type": "pacient"})
+            profiles.append({"user_id": user_id, "phone": f"600{user_id:06d}"})
+            devices.append({"user_id": user_id, "name": f"{constant} Monitor", "serial_number": serial_number,
+                            "constants": [constant], "sampling_frequency": frequency})
+            self.devices.append((str(user_id), serial_number, constant, frequency))
+        managers["users"].append(["user_id", "name", "email", "registration_date", "type"], users)
+        managers["profiles"].append(["user_id", "phone"], profiles)
+        managers["iot"].append(["user_id", "name", "serial_number", "constants", "sampling_frequency"], devices)
+        alert_dispatcher = AlertDispatcher(managers["alerts"], managers["profiles"]).start()
+        iot_controller = IoTDeviceController(
+            managers["iot"], managers["parameters"], managers["thresholds"], managers["alerts"], None, View(),
+            measurement_store=managers["measurements"], alert_dispatcher=alert_dispatcher,
+            anomaly_detector=AnomalyDetector(), liveness_monitor=LivenessMonitor(alert_dispatcher)
+        )
+        return iot_controller, alert_dispatcher
+
+    def readings(self, start, duration, window):
+        """Genera, per finestres de `window` segons, les mesures de tots els dispositius."""
+        state = {serial: [self.random.uniform(0, freq), 0] for _, serial, _, freq in self.devices}
+        for offset in range(0, duration, window):
+            batch = []
+            for user_id, serial_number, constant, frequency in self.devices:
+                base, noise, excursion, _, _, _ = self.VITAL_SIGNS[constant]
+                next_sample, excursion_left = state[serial_number]
+                while next_sample < offset + window:
+                    if self.random.random() < self.dropout_rate:
+                        next_sample += self.random.randint(600, 1800)
+                        continue
+                    if excursion_left == 0 and self.random.random() < self.excursion_rate:
+                        excursion_left = self.random.randint(2, 10)
+                    value = self.random.gauss(base, noise)
+                    if excursion_left:
+                        value += excursion
+                        excursion_left -= 1
+                    batch.append((user_id, serial_number, constant, round(value, 1),
+                                  start + timedelta(seconds=next_sample)))
+                    next_sample += frequency
+                state[serial_number] = [next_sample, excursion_left]
+            yield batch
+
+    def run(self, duration=3600, window=60, start=None, shards=0):
+        """
+        Executa la simulació i retorna un informe amb rendiment, latències i memòria.
+        Amb `shards` la ingesta es reparteix entre processos i s'informa també del
+        pic de memòria del fragment més gran.
+        """
+        iot_controller, alert_dispatcher = self.setup()
+        start = start or datetime.now().replace(microsecond=0)
+        if shards:
+            iot_controller = ShardedIngestion(iot_controller, self.data_dir, shards).start()
+        else:
+            iot_controller.liveness_monitor.watch_devices(iot_controller.iot_manager.read(), start)
+        latencies, total, breaches, silent = [], 0, 0, 0
+        began = time.perf_counter()
+        for index, batch in enumerate(self.readings(start, duration, window)):
+            batch_start = time.perf_counter()
+            result = iot_controller.ingest_measurements(batch)
+            # El rellotge de la simulació és el final de la finestra
+            silent += len(iot_controller.check_liveness(start + timedelta(seconds=(index + 1) * window)))
+            latencies.append(time.perf_counter() - batch_start)
+            total += result["accepted"]
+            breaches += len(result["breaches"])
+        if shards:
+            iot_controller.stop()
+        alert_dispatcher.stop()
+        elapsed = time.perf_counter() - began
+        latencies.sort()
+        percentile = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] if latencies else 0.0
+        return {
+            "patients": self.patients,
+            "shards": shards,
+            "readings": total,
+            "alerts": breaches,
+            "silent_devices": silent,
+            "seconds": round(elapsed, 3),
+            "throughput_per_s": round(total / elapsed, 1) if elapsed else 0.0,
+            "batch_latency_p50_ms": round(percentile(0.50) * 1000, 2),
+            "batch_latency_p99_ms": round(percentile(0.99) * 1000, 2),
+            "peak_memory_mb": self._peak_memory_mb("self"),
+            "peak_shard_memory_mb": self._peak_memory_mb("children") if shards else None,
+        }
+
+    @staticmethod
+    def _peak_memory_mb(who):
+        """RSS màxim (MB) del procés o dels fills ja acabats; None si la plataforma no ho permet."""
+        if resource is None:
+            return None
+        usage = resource.getrusage(resource.RUSAGE_SELF if who == "self" else resource.RUSAGE_CHILDREN)
+        # ru_maxrss és en KB a Linux i en bytes a macOS
+        return round(usage.ru_maxrss / (2 ** 20 if sys.platform == "darwin" else 2 ** 10), 2)
+
+
+def run_benchmark(patients=1000, duration=3600, window=60, data_dir=None, shards=0):
+    """Executa el simulador en un directori temporal (o `data_dir`) i mostra l'informe."""
+    data_dir = data_dir or tempfile.mkdtemp(prefix="seniorlife-bench-")
+    report = FleetSimulator(data_dir, patients).run(duration, window, shards=shards)
+    print(Fore.BLUE + Style.BRIGHT + f"\n--- BENCHMARK ({data_dir}) ---")
+    for key, value in report.items():
+        print(f"{key}: {value}")
+    return report
+
+
+def run_reminders(hours=24, data_dir=DATA_DIR):
+    """Tasca per lots (p. ex. nocturna): recordatoris de les cites de les properes `hours` hores."""
+    managers = create_managers(data_dir)
+    controller = NotificationController(managers["notifications"], None, View(), managers["appointments"])
+    began = time.perf_counter()
+    created = controller.send_appointment_reminders(hours)
+    managers["notifications"].close()
+    print(Fore.BLUE + f"{created} recordatoris creats en {time.perf_counter() - began:.2f} s.")
+    return created
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="SeniorLife")
+    commands = parser.add_subparsers(dest="command")
+    serve = commands.add_parser("serve", help="Servidor d'ingesta de mesures IoT")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8765)
+    serve.add_argument("--unix", dest="unix_path", help="Ruta d'un socket Unix en lloc de TCP")
+    serve.add_argument("--data-dir", default=DATA_DIR)
+    serve.add_argument("--shards", type=int, default=0, help="Processos d'ingesta per user_id (0: un sol procés)")
+    benchmark = commands.add_parser("benchmark", help="Simulació d'una flota de dispositius")
+    benchmark.add_argument("--patients", type=int, default=1000)
+    benchmark.add_argument("--duration", type=int, default=3600, help="Segons de mesures a simular")
+    benchmark.add_argument("--window", type=int, default=60, help="Segons de mesures per lot")
+    benchmark.add_argument("--data-dir", default=None, help="Per defecte, un directori temporal")
+    benchmark.add_argument("--shards", type=int, default=0, help="Processos d'ingesta per user_id (0: un sol procés)")
+    reminders = commands.add_parser("reminders", help="Recordatoris de les cites de les properes hores")
+    reminders.add_argument("--hours", type=int, default=24)
+    reminders.add_argument("--data-dir", default=DATA_DIR)
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        run_ingestion_server(args.host, args.port, args.unix_path, args.data_dir, args.shards)
+    elif args.command == "benchmark":
+        run_benchmark(args.patients, args.duration, args.window, args.data_dir, args.shards)
+    elif args.command == "reminders":
+        run_reminders(args.hours, args.data_dir)
+    else:
+        main_menu()
+
+
 if __name__ == "__main__":
-    main_menu()
+    main()
 
 
 
@@ -1,9 +1,16 @@
    
 import unittest
 from unittest.mock import patch, MagicMock
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import sys
 import os
+import tempfile
+import threading
+import time
+import asyncio
+import queue
+import json
+from concurrent.futures import Future
 
 # Ruta al archivo programa_FINAL_SeniorLife.py
 module_dir = r"C:\Users\abell\OneDrive\Documentos\3r_Carrera\Programari\Projecte_programari"
@@ -12,7 +19,10 @@ sys.path.append(module_dir)
 from programa_FINAL_SeniorLife import (
     format_date, validate_input, is_valid_date, is_valid_time, CSVManager, Factory,
     UserController, AppointmentController, View, MedicalProfileController,
-    NotificationController, ParameterController, IoTDeviceController, SocialNetworkController
+    NotificationController, ParameterController, IoTDeviceController, SocialNetworkController,
+    RollingAggregates, MeasurementStore, AnomalyDetector, AlertDispatcher, AlertForwarder, shard_of,
+    LivenessMonitor, AppointmentCalendar, NotificationInbox, migrate_social_members,
+    CareNetworkIndex, IngestionServer, IDSequence, ShardedIngestion, ThresholdTable, FleetSimulator
 )
 
 
@@ -70,9 +80,9 @@ class TestSeniorLife(unittest.TestCase):
         
 
     def test_confirm_user_id(self):
-        self.users_manager.read.return_value = [
-            {"user_id": "1", "name": "John Doe", "email": "john@example.com", "registration_date": "01-Jan-2024"}
-        ]
+        self.users_manager.find_one.return_value = {
+            "user_id": "1", "name": "John Doe", "email": "john@example.com", "registration_date": "01-Jan-2024"
+        }
         self.view.get_input.side_effect = ["1", "sí"]
         user_id = self.users_controller.confirm_user_id()
         expected = "1"
@@ -82,6 +92,7 @@ class TestSeniorLife(unittest.TestCase):
     def test_schedule_appointment(self):
         appointments_manager = MagicMock(spec=CSVManager)
         appointments_manager.read.return_value = []
+        appointments_manager.next_id.return_value = 1
         user_id = "1"
         users_controller = MagicMock(spec=UserController)
         users_controller.confirm_user_id.return_value = user_id
@@ -119,6 +130,7 @@ class TestSeniorLife(unittest.TestCase):
     def test_send_notification(self):
         notifications_manager = MagicMock(spec=CSVManager)
         notifications_manager.read.return_value = []
+        notifications_manager.next_id.return_value = 1
         user_id = "1"
         users_controller = MagicMock(spec=UserController)
         users_controller.confirm_user_id.return_value = user_id
@@ -230,7 +242,7 @@ class TestSeniorLife(unittest.TestCase):
         Test para visualizar los parámetros de salud.
         """
         parameters_manager = MagicMock(spec=CSVManager)
-        parameters_manager.read.return_value = [
+        parameters_manager.find.return_value = [
             {"user_id": "1", "constant": "Frecuencia cardíaca", "value": "75", "timestamp": "2024-12-07T15:00:00"},
             {"user_id": "1", "constant": "Oxígeno en sangre", "value": "98", "timestamp": "2024-12-07T15:10:00"}
         ]
@@ -261,6 +273,7 @@ class TestSeniorLife(unittest.TestCase):
         """
         social_network_manager = MagicMock(spec=CSVManager)
         social_network_manager.read.return_value = []
+        social_network_manager.next_id.return_value = 1
         user_id = "1"
         users_controller = MagicMock(spec=UserController)
         users_controller.confirm_user_id.return_value = user_id
@@ -288,7 +301,940 @@ class TestSeniorLife(unittest.TestCase):
         ]
         actual = social_network_manager.write.call_args[0][1]
         self.assert_with_score(expected, actual, "test_manage_social_network")
-    
+
+
+class TestSeniorLifeStorage(unittest.TestCase):
+    """
+    Proves de l'emmagatzematge, la ingesta, les alertes i les xarxes. Fallen
+    amb assertEqual i cada una treballa en un directori temporal propi.
+    """
+
+    def setUp(self):
+        self.view = MagicMock(spec=View)
+        self.users_controller = UserController(MagicMock(spec=CSVManager), self.view)
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.data_dir = temp_dir.name
+
+    def manager(self, name, **kwargs):
+        """Gestor d'un fitxer del directori temporal; s'oblida (singleton) en acabar la prova."""
+        path = os.path.join(self.data_dir, name)
+        self.addCleanup(CSVManager._instances.pop, path, None)
+        return CSVManager(path, **kwargs)
+
+    def test_append_only_writes(self):
+        """
+        Test de l'escriptura per addició: les files noves s'afegeixen sense reescriure les existents.
+        """
+        manager = self.manager("usuaris.csv", primary_key="user_id")
+        manager.append(["user_id", "name"], [{"user_id": "1", "name": "Anna"}])
+        with open(manager.file_path, encoding="utf-8") as file:
+            before = file.read()
+        manager.append(["user_id", "name"], [{"user_id": "2", "name": "Pere"}])
+        with open(manager.file_path, encoding="utf-8") as file:
+            after = file.read()
+
+        self.assertEqual(before + "2,Pere\n", after)
+        self.assertEqual(["Anna", "Pere"], [row["name"] for row in manager.read()])
+
+    def test_append_after_missing_newline(self):
+        """
+        Test de l'addició a un fitxer sense salt de línia final: la fila nova no s'enganxa a l'última.
+        """
+        manager = self.manager("constants.csv", schema={"value": "float"})
+        with open(manager.file_path, mode="w", newline="", encoding="utf-8") as file:
+            file.write("user_id,constant,value\r\n3,hr,1.0")
+        manager.append(["user_id", "constant", "value"], [{"user_id": "4", "constant": "hr", "value": 2.0}])
+        cached = manager.read()
+        manager.invalidate()
+
+        self.assertEqual([("3", 1.0), ("4", 2.0)], [(row["user_id"], row["value"]) for row in cached])
+        self.assertEqual(cached, manager.read())
+
+    def test_wal_replay_after_restart(self):
+        """
+        Test del registre WAL: en reobrir, les files confirmades es bolquen al CSV i una línia tallada s'ignora.
+        """
+        path = os.path.join(self.data_dir, "alertes.csv")
+        manager = self.manager("alertes.csv", primary_key="alert_id")
+        manager.enable_wal(compact_interval=3600, compact_min_bytes=1 << 30)
+        manager.append(["alert_id", "level"], [{"alert_id": "1", "level": "low"}])
+        manager.append(["alert_id", "level"], [{"alert_id": "2", "level": "high"}])
+        manager._wal.close()  # Aturada sense compactar, com si el procés hagués caigut
+        CSVManager._instances.pop(path)
+        with open(path + ".wal", "a", encoding="utf-8") as file:
+            file.write('{"alert_id": "3", "lev')
+
+        reopened = self.manager("alertes.csv", primary_key="alert_id")
+        reopened.enable_wal(compact_interval=3600)
+        self.addCleanup(reopened.close)
+
+        expected = (["1", "2"], 0)
+        actual = ([row["alert_id"] for row in reopened.read()], os.path.getsize(path + ".wal"))
+        self.assertEqual(expected, actual)
+
+    def test_wal_concurrent_appends(self):
+        """
+        Test del registre WAL: dues instàncies (com dos processos) que hi escriuen mentre es compacta no perden files.
+        """
+        path = os.path.join(self.data_dir, "alertes.csv")
+        with open(path, "w", encoding="utf-8") as file:
+            file.write("alert_id,writer\n")
+        menu = self.manager("alertes.csv")
+        menu.enable_wal(compact_interval=3600, compact_min_bytes=1 << 30)
+        CSVManager._instances.pop(path)
+        server = self.manager("alertes.csv")
+        server.enable_wal(compact_interval=3600, compact_min_bytes=1 << 30, commit_delay=0.001)
+
+        def append_many(manager, writer):
+            for i in range(100):
+                manager.append(["alert_id", "writer"], [{"alert_id": f"{writer}-{i}", "writer": writer}])
+        writers = [threading.Thread(target=append_many, args=(manager, name))
+                   for manager, name in ((menu, "menu"), (server, "server"), (server, "job"))]
+        for writer in writers:
+            writer.start()
+        while any(writer.is_alive() for writer in writers):
+            menu.compact()
+        for writer in writers:
+            writer.join()
+        server.close()
+        menu.close()
+        CSVManager._instances.pop(path)
+
+        rows = self.manager("alertes.csv").read()
+        self.assertEqual((300, 300), (len(rows), len({row["alert_id"] for row in rows})))
+
+    def test_cache_invalidation(self):
+        """
+        Test de la memòria cau: es reutilitza mentre el fitxer no canvia i es torna a llegir si canvia des de fora.
+        """
+        manager = self.manager("perfils.csv", primary_key="user_id")
+        manager.append(["user_id", "phone"], [{"user_id": "1", "phone": "600"}])
+        manager.read()
+        manager.read()
+        hits = manager.cache_stats()["hits"]
+        with open(manager.file_path, mode="w", newline="", encoding="utf-8") as file:
+            file.write("user_id,phone\n1,600111222\n2,611\n")
+
+        self.assertGreaterEqual(hits, 1)
+        self.assertEqual([("1", "600111222"), ("2", "611")], [(r["user_id"], r["phone"]) for r in manager.read()])
+
+    def test_hash_indexes(self):
+        """
+        Test dels índexs: les cerques per columna indexada segueixen les altes i els upserts.
+        """
+        manager = self.manager("cites.csv", indexes=("user_id",), primary_key="appointment_id")
+        manager.append(["appointment_id", "user_id"], [{"appointment_id": "1", "user_id": "1"},
+                                                       {"appointment_id": "2", "user_id": "1"}])
+        self.assertEqual(["1", "2"], [row["appointment_id"] for row in manager.find("user_id", "1")])
+
+        manager.write(["appointment_id", "user_id"], [{"appointment_id": "2", "user_id": "7"}])
+        self.assertEqual(["1"], [row["appointment_id"] for row in manager.find("user_id", "1")])
+        self.assertEqual(["2"], [row["appointment_id"] for row in manager.find("user_id", "7")])
+        self.assertIsNone(manager.find_one("user_id", "9"))
+
+    def test_iter_rows_streaming(self):
+        """
+        Test del recorregut en streaming: projecció de columnes (igual que amb memòria cau) i aturada a mig fitxer.
+        """
+        manager = self.manager("constants.csv", schema={"value": "float"})
+        manager.append(["user_id", "constant", "value"], [
+            {"user_id": str(i % 3), "constant": "Heart Rate", "value": 60 + i} for i in range(10)
+        ])
+        manager.invalidate()
+        rows = manager.iter_rows(columns=("user_id", "value"))
+
+        self.assertEqual({"user_id": "0", "value": 60.0}, next(rows))
+        self.assertEqual({"user_id": "1", "value": 61.0}, next(rows))
+        self.assertEqual(0, manager.cache_stats()["rows"])
+        streamed = next(manager.iter_rows(columns=("user_id", "units")))
+        manager.read()
+        cached = next(manager.iter_rows(columns=("user_id", "units")))
+        self.assertEqual(({"user_id": "0", "units": ""},) * 2, (streamed, cached))
+
+    def test_primary_key_upsert(self):
+        """
+        Test dels upserts: la darrera versió d'una clau és la vigent i les antigues es compacten.
+        """
+        manager = self.manager("xarxes.csv", primary_key="network_id", schema={"members_count": "int"})
+        for count in range(3):
+            manager.write(["network_id", "title", "members_count"],
+                          [{"network_id": "1", "title": "Família", "members_count": count}])
+        manager.write(["network_id", "title", "members_count"],
+                      [{"network_id": "1", "title": "Família", "members_count": 2}])
+        with open(manager.file_path, encoding="utf-8") as file:
+            lines = file.read().splitlines()
+
+        self.assertEqual([2], [row["members_count"] for row in manager.read()])
+        self.assertEqual(["network_id,title,members_count", "1,Família,2"], lines)
+
+    def test_column_codecs(self):
+        """
+        Test dels codecs: cada columna es llegeix amb el tipus declarat (dates ISO o DD-MMM-YYYY) i les cel·les
+        errònies es conserven.
+        """
+        manager = self.manager("dispositius.csv", schema={"frequency": "float", "since": "date",
+                                                          "constants": "strlist", "info": "json"})
+        manager.append(["serial_number", "frequency", "since", "constants", "info"], [
+            {"serial_number": "HM001", "frequency": 30.0, "since": datetime(2024, 12, 7).date(),
+             "constants": ["Heart Rate"], "info": {"model": "X1"}},
+            {"serial_number": "HM002", "frequency": "cada minut", "since": "", "constants": "", "info": ""},
+            {"serial_number": "HM003", "frequency": 60.0, "since": "07-Dec-2024", "constants": "", "info": ""},
+        ])
+        manager.invalidate()
+        errors = manager.cache_stats()["decode_errors"]
+        first, second, third = manager.read()
+
+        self.assertEqual({"serial_number": "HM001", "frequency": 30.0, "since": datetime(2024, 12, 7).date(),
+                          "constants": ["Heart Rate"], "info": {"model": "X1"}}, first)
+        self.assertEqual(("cada minut", None, [], None),
+                         (second["frequency"], second["since"], second["constants"], second["info"]))
+        self.assertEqual(datetime(2024, 12, 7).date(), third["since"])
+        self.assertEqual(errors + 1, manager.cache_stats()["decode_errors"])
+
+    def test_id_sequence_shared_between_processes(self):
+        """
+        Test de la seqüència d'IDs: dues instàncies sobre el mateix fitxer (com dos processos) no repeteixen IDs.
+        """
+        path = os.path.join(self.data_dir, "notificacions.csv.seq")
+        menu, job = IDSequence(path, initial_value=1), IDSequence(path)
+        self.assertEqual(2, menu.next())
+        self.assertEqual(range(3, 6), job.reserve(3))
+        self.assertEqual(6, menu.next())
+
+        reserved = []
+        def reserve_many():
+            sequence = IDSequence(path)
+            reserved.extend(sequence.next() for _ in range(50))
+        workers = [threading.Thread(target=reserve_many) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(list(range(7, 207)), sorted(reserved))
+
+    def test_ingest_measurements(self):
+        """
+        Test per la ingesta d'un lot de mesures d'un dispositiu IoT.
+        """
+        iot_manager = MagicMock(spec=CSVManager)
+        iot_manager.find_one.side_effect = lambda column, value: {
+            "user_id": "1", "name": "Heart Monitor", "serial_number": "HM001",
+            "constants": "['Heart Rate', ' Blood Pressure']", "sampling_frequency": "30"
+        } if value == "HM001" else None
+        thresholds_manager = MagicMock(spec=CSVManager)
+        thresholds_manager.read.return_value = [{"constant": "Heart Rate", "min_level": "60.0", "max_level": "100.0"}]
+        constants_manager = MagicMock(spec=CSVManager)
+
+        iot_controller = IoTDeviceController(iot_manager, constants_manager, thresholds_manager, MagicMock(),
+                                             MagicMock(spec=UserController), MagicMock(spec=View))
+        result = iot_controller.ingest_measurements([
+            ("1", "HM001", "heart rate", 75, "2024-12-07T15:00:00"),
+            ("1", "HM001", "Heart Rate", 130, "2024-12-07T15:00:30"),
+            ("1", "XX999", "Heart Rate", 80, "2024-12-07T15:01:00"),
+            ("1", "HM001", "Temperature", 36.5, "2024-12-07T15:01:30"),
+        ])
+
+        expected = (2, 2, [130.0], 1)
+        actual = (
+            result["accepted"],
+            len(result["rejected"]),
+            [b["value"] for b in result["breaches"]],
+            constants_manager.append.call_count,
+        )
+        self.assertEqual(expected, actual)
+
+    def test_ingest_timezone_aware_timestamps(self):
+        """
+        Test de la ingesta amb dates amb zona ("...Z"): es desen com a hora local i el control de vida continua.
+        """
+        iot_manager = MagicMock(spec=CSVManager)
+        iot_manager.find_one.return_value = {"user_id": "1", "serial_number": "HM001", "constants": ["Heart Rate"],
+                                             "sampling_frequency": "60"}
+        thresholds_manager = MagicMock(spec=CSVManager)
+        thresholds_manager.read.return_value = []
+        store = MeasurementStore(os.path.join(self.data_dir, "mesures"))
+        monitor = LivenessMonitor(missed_samples=3, grace_seconds=0)
+        iot_controller = IoTDeviceController(iot_manager, MagicMock(spec=CSVManager), thresholds_manager, MagicMock(),
+                                             MagicMock(spec=UserController), MagicMock(spec=View),
+                                             measurement_store=store, liveness_monitor=monitor)
+        result = iot_controller.ingest_measurements([
+            ("1", "HM001", "Heart Rate", 72, "2024-12-07T15:00:00Z"),
+            ("1", "HM001", "Heart Rate", 74, "2024-12-07T16:01:00+01:00"),
+        ])
+        local = datetime(2024, 12, 7, 15, 0, tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
+
+        self.assertEqual((2, []), (result["accepted"], result["rejected"]))
+        self.assertEqual([local.isoformat(), (local + timedelta(minutes=1)).isoformat()],
+                         [row["timestamp"] for row in store.query("1")])
+        self.assertEqual([], monitor.check(local + timedelta(minutes=3)))
+        self.assertEqual(["HM001"], monitor.check("2024-12-07T15:05:00Z"))
+
+    def test_ingestion_server_flush(self):
+        """
+        Test del servidor d'ingesta: un lot erroni no perd les mesures vàlides i els lots no se solapen.
+        """
+        state = {"running": 0, "max_running": 0}
+        lock = threading.Lock()
+
+        def ingest_measurements(batch):
+            with lock:
+                state["running"] += 1
+                state["max_running"] = max(state["max_running"], state["running"])
+            time.sleep(0.01)
+            with lock:
+                state["running"] -= 1
+            if any(reading[3] is None for reading in batch):
+                raise TypeError("valor buit")
+            return {"accepted": len(batch), "rejected": [], "breaches": [], "anomalies": []}
+
+        controller = MagicMock()
+        controller.ingest_measurements.side_effect = ingest_measurements
+        server = IngestionServer(controller)
+        reading = ("1", "HM001", "Heart Rate", 72.0, "2024-12-07T15:00:00")
+
+        async def scenario():
+            server._buffer = [reading, ("1", "HM001", "Heart Rate", None, "2024-12-07T15:00:30"), reading]
+            await server.flush()
+            flushes = []
+            for _ in range(5):
+                server._buffer.append(reading)
+                flushes.append(asyncio.create_task(server.flush()))
+                await asyncio.sleep(0)
+            await asyncio.gather(*flushes)
+
+        asyncio.run(scenario())
+        self.assertEqual((7, 1, 1), (server.stats["stored"], server.stats["failed"], state["max_running"]))
+
+    def test_ingestion_server_validation(self):
+        """
+        Test del servidor d'ingesta: es rebutgen el dispositiu d'un altre usuari, les dates no vàlides i les
+        línies no UTF-8 o massa llargues sense tancar la connexió, i es compten les rebutjades pel controlador.
+        """
+        controller = MagicMock(spec=IoTDeviceController)
+        controller.device_info.return_value = ({"user_id": "1", "serial_number": "HM001"}, {"heart rate": "Heart Rate"})
+        controller.ingest_measurements.side_effect = lambda batch: {
+            "accepted": len(batch) - 1, "rejected": [(batch[0], "Valor o data no vàlids")], "breaches": [],
+            "anomalies": []}
+        server = IngestionServer(controller, unix_path=os.path.join(self.data_dir, "ingesta.sock"))
+        reading = {"serial_number": "HM001", "user_id": "1", "constant": "Heart Rate", "value": 72.0,
+                   "timestamp": "2024-12-07T15:00:00"}
+        lines = [
+            json.dumps(reading).encode(),
+            json.dumps({**reading, "user_id": "2"}).encode(),
+            json.dumps({**reading, "timestamp": "ahir"}).encode(),
+            b"\xff\xfe",
+            b"x" * 70000,
+            json.dumps(reading).encode(),
+        ]
+
+        async def scenario():
+            await server.start()
+            reader, writer = await asyncio.open_unix_connection(server.unix_path)
+            writer.write(b"".join(line + b"\n" for line in lines))
+            replies = [json.loads(await reader.readline()) for _ in lines]
+            writer.close()
+            await server.stop()
+            return replies
+
+        replies = asyncio.run(scenario())
+
+        expected = ([True, False, False, False, False, True], 4 + 1, 1)
+        actual = ([reply["ok"] for reply in replies], server.stats["rejected"], server.stats["stored"])
+        self.assertEqual(expected, actual)
+
+    def test_threshold_batch_matches_scalar(self):
+        """
+        Test de l'avaluació per lots dels llindars: dona el mateix que la comprovació d'un sol valor (amb i sense
+        NumPy), també amb constants desconegudes, valors al límit i NaN.
+        """
+        thresholds_manager = MagicMock(spec=CSVManager)
+        thresholds_manager.version.return_value = (1, 1)
+        thresholds_manager.read.return_value = [
+            {"constant": "Heart Rate", "min_level": "60", "max_level": "100"},
+            {"constant": "Temperature", "min_level": "36.1", "max_level": ""},
+            {"constant": "Blood Pressure", "min_level": "noranta", "max_level": "120"},
+        ]
+        table = ThresholdTable(thresholds_manager)
+        nan = float("nan")
+        constants = ["Heart Rate", " heart  rate", "Temperature", "Temperature", "Blood Pressure", "Glucosa",
+                     "Heart Rate", "Heart Rate", "Heart Rate", "Glucosa"]
+        values = [59.9, 60.0, 36.0, 45.0, 200.0, 500.0, 100.0, 100.1, nan, nan]
+        scalar = [table.is_out_of_range(c, v) for c, v in zip(constants, values)]
+        heart_rate = [table.is_out_of_range("Heart Rate", v) for v in values]
+
+        batches = [(list(table.evaluate_batch(constants, values)), list(table.evaluate_batch("Heart Rate", values)))]
+        with patch("programa_FINAL_SeniorLife.np", None):
+            batches.append((table.evaluate_batch(constants, values), table.evaluate_batch("Heart Rate", values)))
+
+        self.assertEqual([True, False, True, False, False, False, False, True, False, False], scalar)
+        self.assertEqual([(scalar, heart_rate)] * 2, [([bool(v) for v in a], [bool(v) for v in b]) for a, b in batches])
+
+    def test_fleet_simulator(self):
+        """
+        Test del simulador de flota: és determinista amb la llavor i l'informe quadra amb les mesures desades
+        (fora de rang = alertes) i amb els silencis dels dispositius.
+        """
+        start = datetime.now().replace(microsecond=0) - timedelta(hours=2)
+        reports, out_of_range, stored = [], [], []
+        for name in ("a", "b"):
+            data_dir = os.path.join(self.data_dir, name)
+            simulator = FleetSimulator(data_dir, patients=6, excursion_rate=0.05, dropout_rate=0.02, seed=7)
+            reports.append(simulator.run(duration=3600, window=60, start=start))
+            for path in [path for path in CSVManager._instances if path.startswith(data_dir)]:
+                CSVManager._instances.pop(path).close()
+            rows = [row for user_id, *_ in simulator.devices
+                    for row in MeasurementStore(os.path.join(data_dir, "mesures")).query(user_id)]
+            limits = {name: signs[4:] for name, signs in FleetSimulator.VITAL_SIGNS.items()}
+            stored.append(len(rows))
+            out_of_range.append(sum(1 for row in rows if not limits[row["constant"]][0] <= row["value"]
+                                    <= limits[row["constant"]][1]))
+        report = reports[0]
+
+        self.assertEqual({"patients", "shards", "readings", "alerts", "silent_devices", "seconds", "throughput_per_s",
+                          "batch_latency_p50_ms", "batch_latency_p99_ms", "peak_memory_mb",
+                          "peak_shard_memory_mb"}, set(report))
+        self.assertEqual([(r["readings"], r["alerts"], r["silent_devices"]) for r in reports],
+                         [(report["readings"], report["alerts"], report["silent_devices"])] * 2)
+        self.assertEqual(([report["readings"]] * 2, [report["alerts"]] * 2), (stored, out_of_range))
+        self.assertTrue(0 < report["alerts"] < report["readings"] and report["silent_devices"] > 0)
+
+    def test_rolling_aggregates(self):
+        """
+        Test dels agregats per finestres: les mesures antigues només compten a les finestres llargues.
+        """
+        aggregates = RollingAggregates()
+        aggregates.add("1", "Heart Rate", 120, "2024-12-06T20:00:00")
+        for minute, value in enumerate([70, 80, 90]):
+            aggregates.add("1", "Heart Rate", value, f"2024-12-07T15:{minute:02d}:00")
+        summary = aggregates.summary("1", now=datetime(2024, 12, 7, 15, 30))["Heart Rate"]
+
+        expected = (90.0, (3, 70.0, 90.0, 80.0, 80.0), (4, 70.0, 120.0, 90.0, 80.0))
+        actual = (
+            summary["last"],
+            tuple(summary["1h"][k] for k in ("count", "min", "max", "mean", "p50")),
+            tuple(summary["24h"][k] for k in ("count", "min", "max", "mean", "p50")),
+        )
+        self.assertEqual(expected, actual)
+
+    def test_summary_sees_other_process_writes(self):
+        """
+        Test dels agregats del magatzem: el resum es torna a carregar si un altre procés escriu mesures noves.
+        """
+        base_dir = os.path.join(self.data_dir, "mesures")
+        menu = MeasurementStore(base_dir, aggregates=RollingAggregates())
+        server = MeasurementStore(base_dir, aggregates=RollingAggregates())
+        now = datetime.now().replace(microsecond=0)
+        menu.append("1", "Heart Rate", 70, now - timedelta(minutes=2))
+        first = menu.summary("1")["Heart Rate"]["last"]
+        with patch.object(menu, "last_hours", wraps=menu.last_hours) as reloads:
+            menu.append("1", "Heart Rate", 75, now - timedelta(minutes=1))
+            own = menu.summary("1")["Heart Rate"]["last"]
+            server.append("1", "Heart Rate", 140, now)
+            other = menu.summary("1")["Heart Rate"]
+
+        expected = (70.0, 75.0, 140.0, 3, 1)
+        actual = (first, own, other["last"], other["1h"]["count"], reloads.call_count)
+        self.assertEqual(expected, actual)
+
+    def test_query_range_does_not_list_history(self):
+        """
+        Test de les consultes per rang: només es proven les particions dels dies demanats, sense llistar l'historial.
+        """
+        store = MeasurementStore(os.path.join(self.data_dir, "mesures"))
+        first = datetime(2024, 1, 1, 12, 0)
+        store.append_many([("1", "Heart Rate", 60 + day % 40, first + timedelta(days=day)) for day in range(300)])
+
+        with patch("programa_FINAL_SeniorLife.os.listdir", wraps=os.listdir) as listdir:
+            rows = store.query("1", start=datetime(2024, 3, 1), end=datetime(2024, 3, 2, 23, 59))
+
+        expected = (0, ["2024-03-01T12:00:00", "2024-03-02T12:00:00"])
+        actual = (listdir.call_count, [row["timestamp"] for row in rows])
+        self.assertEqual(expected, actual)
+
+    def test_retention_tiers(self):
+        """
+        Test de la retenció: els dies antics es resumeixen per minut i per hora i es continuen consultant.
+        """
+        now = datetime(2024, 12, 20, 12, 0)
+        store = MeasurementStore(os.path.join(self.data_dir, "mesures"), retention={"raw": 2, "minute": 5})
+        store.append_many([
+            ("1", "Heart Rate", value, now - timedelta(days=days) + timedelta(seconds=seconds))
+            for days in (0, 3, 7) for seconds, value in ((0, 70), (20, 80), (90, 90))
+        ])
+        rolled = store.compact_tiers(now)
+        rows = store.query("1", "Heart Rate")
+
+        expected = (3, [(2, 80.0), (1, 90.0)], [(3, 70.0, 90.0)], 3)
+        actual = (
+            rolled,
+            [(r["count"], r["max"]) for r in rows if r["timestamp"].startswith("2024-12-17")],
+            [(r["count"], r["min"], r["max"]) for r in rows if r["timestamp"].startswith("2024-12-13")],
+            len([r for r in rows if "count" not in r]),
+        )
+        self.assertEqual(expected, actual)
+
+    def test_retention_shared_between_processes(self):
+        """
+        Test de la retenció amb dos compactadors (com el menú i el servidor) i un resum interromput: cap mesura
+        es compta dues vegades i la partició esborrada per l'altre es torna a crear amb capçalera.
+        """
+        now = datetime(2024, 12, 20, 12, 0)
+        base_dir = os.path.join(self.data_dir, "mesures")
+        menu = MeasurementStore(base_dir, retention={"raw": 2, "minute": 5})
+        server = MeasurementStore(base_dir, retention={"raw": 2, "minute": 5})
+        server.append_many([("1", "Heart Rate", 70 + i, now - timedelta(days=3, minutes=i)) for i in range(3)])
+        menu.append_many([("2", "Heart Rate", 80, now - timedelta(days=4))])
+        rolled = []
+        compactors = [threading.Thread(target=lambda store=store: rolled.append(store.compact_tiers(now)))
+                      for store in (menu, server)]
+        for compactor in compactors:
+            compactor.start()
+        for compactor in compactors:
+            compactor.join()
+        # Mesura endarrerida d'un dia que ja ha resumit l'altre procés
+        server.append_many([("1", "Heart Rate", 99, now - timedelta(days=3, minutes=30))])
+        with patch.object(MeasurementStore, "_finish_roll", side_effect=OSError("aturada")):
+            with self.assertRaises(OSError):
+                menu.compact_tiers(now)
+        resumed = server.compact_tiers(now)
+
+        expected = (2, 0, [1, 1, 1, 1], [1])
+        actual = (
+            sum(rolled),
+            resumed,
+            [row["count"] for row in server.query("1")],
+            [row["count"] for row in menu.query("2")],
+        )
+        self.assertEqual(expected, actual)
+
+    def test_late_reading_after_rollup(self):
+        """
+        Test d'una mesura endarrerida d'un dia ja resumit: la consulta combina el resum i la partició nova.
+        """
+        now = datetime(2024, 12, 20, 12, 0)
+        day = now - timedelta(days=3)
+        store = MeasurementStore(os.path.join(self.data_dir, "mesures"), retention={"raw": 2, "minute": 5})
+        store.append_many([("1", "Heart Rate", 70 + i % 5, day + timedelta(minutes=i)) for i in range(120)])
+        store.compact_tiers(now)
+        store.append("1", "Heart Rate", 88, day + timedelta(minutes=30, seconds=30))
+        rows = store.query("1", "Heart Rate")
+
+        self.assertEqual(121, sum(row.get("count", 1) for row in rows))
+        self.assertEqual(sorted(row["timestamp"] for row in rows), [row["timestamp"] for row in rows])
+        store.compact_tiers(now)
+        self.assertEqual(121, sum(row.get("count", 1) for row in store.query("1", "Heart Rate")))
+
+    def test_anomaly_detector(self):
+        """
+        Test dels detectors d'anomalies: un salt dins del rang normal s'avisa un sol cop.
+        """
+        detector = AnomalyDetector()
+        start = datetime(2024, 12, 7, 15, 0)
+        values = [70, 72, 71, 73, 70, 72, 71, 73, 70, 72, 71, 73, 95, 96, 95, 71]
+        fired = {
+            minute: detectors
+            for minute, value in enumerate(values)
+            for detectors in [detector.observe("1", "Heart Rate", value, start + timedelta(minutes=minute))]
+            if detectors
+        }
+        self.assertEqual({12: ["ewma", "zscore"]}, fired)
+
+    def test_alert_deduplication(self):
+        """
+        Test de la deduplicació d'alertes: un sensor avariat genera una alerta, una escalada i un resum.
+        """
+        alerts_manager = MagicMock(spec=CSVManager)
+        dispatcher = AlertDispatcher(alerts_manager).start()
+        start = datetime(2024, 12, 7, 15, 0)
+        for second in range(0, 300, 30):
+            dispatcher.enqueue("1", "Heart Rate", 900.0, (60.0, 100.0), (start + timedelta(seconds=second)).isoformat())
+        dispatcher.flush()
+        dispatcher.recover("1", "Heart Rate", 75.0, (start + timedelta(minutes=6)).isoformat())
+        dispatcher.stop()
+
+        rows = [row for call in alerts_manager.append.call_args_list for row in call[0][1]]
+        expected = (["Alt", "Alt", "Resolt"], 10, 8)
+        actual = ([row["risk_level"] for row in rows], rows[-1]["additional_info"]["repeats"], dispatcher.suppressed)
+        self.assertEqual(expected, actual)
+
+    def test_alert_dispatcher_survives_errors(self):
+        """
+        Test del fil d'alertes: una alerta errònia o un contacte que falla no fan perdre la resta.
+        """
+        def resolver(user_id):
+            if user_id == "2":
+                raise KeyError(user_id)
+            return "600111222"
+
+        alerts_manager = MagicMock(spec=CSVManager)
+        dispatcher = AlertDispatcher(alerts_manager, contact_resolver=resolver).start()
+        self.addCleanup(dispatcher.stop)
+        dispatcher.enqueue("1", "Heart Rate", 130.0, (60.0, 100.0), "no és una data")
+        dispatcher.enqueue("1", "Heart Rate", 130.0, (60.0, 100.0), "2024-12-07T15:00:00")
+        dispatcher.enqueue("2", "Heart Rate", 130.0, (60.0, 100.0), "2024-12-07T15:00:00")
+        flusher = threading.Thread(target=dispatcher.flush, daemon=True)
+        flusher.start()
+        flusher.join(5)
+
+        rows = [row for call in alerts_manager.append.call_args_list for row in call[0][1]]
+        self.assertFalse(flusher.is_alive())
+        self.assertEqual([("1", "600111222"), ("2", "")], [(row["user_id"], row["contact_number"]) for row in rows])
+        self.assertEqual(1, dispatcher.failed)
+
+    def test_record_measurement_single_alert(self):
+        """
+        Test del registre interactiu: llindar i detectors d'una mateixa mesura generen una sola alerta.
+        """
+        iot_manager = MagicMock(spec=CSVManager)
+        iot_manager.find.return_value = [{"user_id": "1", "name": "Heart Monitor", "serial_number": "HM001",
+                                          "constants": ["Heart Rate"]}]
+        thresholds_manager = MagicMock(spec=CSVManager)
+        thresholds_manager.read.return_value = [{"constant": "Heart Rate", "min_level": "60.0", "max_level": "100.0"}]
+        users_controller = MagicMock(spec=UserController)
+        users_controller.confirm_user_id.return_value = "1"
+        view = MagicMock(spec=View)
+        view.get_input.side_effect = ["130", "75"]
+        dispatcher = MagicMock(spec=AlertDispatcher)
+        detector = MagicMock(spec=AnomalyDetector)
+        detector.observe.side_effect = [["zscore"], ["ewma"]]
+        iot_controller = IoTDeviceController(iot_manager, MagicMock(spec=CSVManager), thresholds_manager,
+                                             MagicMock(), users_controller, view, alert_dispatcher=dispatcher,
+                                             anomaly_detector=detector)
+
+        with patch("programa_FINAL_SeniorLife.validate_input", side_effect=["1", "Heart Rate"] * 2):
+            iot_controller.record_measurement()
+            iot_controller.record_measurement()
+
+        calls = dispatcher.enqueue.call_args_list
+        self.assertEqual([((60.0, 100.0), ["zscore"]), (None, ["ewma"])], [(c[0][3], c[0][5]) for c in calls])
+        self.assertEqual(0, dispatcher.recover.call_count)
+
+    def test_shard_alert_forwarding(self):
+        """
+        Test de la ingesta per fragments: el fragment és estable i les alertes es repeteixen en ordre.
+        """
+        iot_manager = MagicMock(spec=CSVManager)
+        iot_manager.find_one.return_value = {"user_id": "1", "serial_number": "HM001", "constants": ["Heart Rate"]}
+        thresholds_manager = MagicMock(spec=CSVManager)
+        thresholds_manager.read.return_value = [{"constant": "Heart Rate", "min_level": "60.0", "max_level": "100.0"}]
+        forwarder = AlertForwarder()
+        iot_controller = IoTDeviceController(iot_manager, MagicMock(spec=CSVManager), thresholds_manager, MagicMock(),
+                                             MagicMock(spec=UserController), MagicMock(spec=View),
+                                             alert_dispatcher=forwarder)
+        iot_controller.ingest_measurements([
+            ("1", "HM001", "Heart Rate", 75, "2024-12-07T15:00:00"),
+            ("1", "HM001", "Heart Rate", 130, "2024-12-07T15:00:30"),
+            ("1", "HM001", "Heart Rate", 80, "2024-12-07T15:01:00"),
+            ("1", "HM001", "Heart Rate", 82, "2024-12-07T15:01:30"),
+        ])
+
+        expected = (shard_of("1", 4), ["enqueue", "recover"], set())
+        actual = (shard_of(1, 4), [method for method, _ in forwarder.drain()], forwarder.open_series)
+        self.assertEqual(expected, actual)
+
+    def test_shard_read_only_wal(self):
+        """
+        Test dels gestors dels fragments: veuen les files del registre WAL d'un altre procés sense tocar-lo.
+        """
+        with open(os.path.join(self.data_dir, "dispositius_iot.csv"), "w", encoding="utf-8") as file:
+            file.write("user_id,serial_number\n1,HM001\n")
+        with open(os.path.join(self.data_dir, "dispositius_iot.csv.wal"), "w", encoding="utf-8") as file:
+            file.write('{"user_id": "2", "serial_number": "HM002"}\n')
+        manager = self.manager("dispositius_iot.csv", indexes=("serial_number",))
+        manager.enable_wal(read_only=True)
+        self.addCleanup(manager.close)
+        found = manager.find_one("serial_number", "HM002")
+        manager.append(["user_id", "serial_number"], [{"user_id": "3", "serial_number": "HM003"}])
+
+        with open(os.path.join(self.data_dir, "dispositius_iot.csv.wal"), encoding="utf-8") as file:
+            wal = file.read()
+        expected = ({"user_id": "2", "serial_number": "HM002"}, 1)
+        actual = (found, wal.count("\n"))
+        self.assertEqual(expected, actual)
+
+    def test_shard_failure_does_not_hang(self):
+        """
+        Test de la ingesta per fragments: un fragment aturat o que no respon fa fallar la petició.
+        """
+        ingestion = ShardedIngestion(MagicMock(spec=IoTDeviceController), self.data_dir, shards=1, timeout=0.2)
+        ingestion._processes = [MagicMock(is_alive=MagicMock(return_value=False), exitcode=-9)]
+        ingestion._inboxes = [MagicMock()]
+        dead = ingestion._submit(0, "query", ("1", None, None, None))
+        with self.assertRaises(RuntimeError):
+            ingestion._result(0, dead)
+        ingestion._processes[0].is_alive.return_value = True
+        with self.assertRaises(TimeoutError):
+            ingestion._result(0, ingestion._submit(0, "query", ("1", None, None, None)))
+        done = Future()
+        done.set_result([])
+        self.assertEqual(([], {}), (ingestion._result(0, done), ingestion._pending))
+
+        # Una resposta tardana (petició 1, ja descartada) no atura el receptor
+        ingestion._outbox = queue.Queue()
+        pending = ingestion._submit(0, "query", ("1", None, None, None))
+        for reply in ((1, [], None), (2, ["fila"], None), None):
+            ingestion._outbox.put(reply)
+        ingestion._receive()
+        # Un fragment encallat es finalitza en aturar
+        wedged = ingestion._processes[0]
+        ingestion.stop()
+
+        expected = (["fila"], 1, 1)
+        actual = (pending.result(timeout=0), wedged.join.call_count - 1, wedged.terminate.call_count)
+        self.assertEqual(expected, actual)
+
+    def test_liveness_monitor(self):
+        """
+        Test del control de vida: un dispositiu que deixa d'enviar mesures genera una sola alerta.
+        """
+        dispatcher = MagicMock(spec=AlertDispatcher)
+        monitor = LivenessMonitor(dispatcher, missed_samples=3, grace_seconds=0)
+        start = datetime(2024, 12, 7, 15, 0)
+        monitor.watch_devices([{"user_id": "1", "serial_number": "HM001", "sampling_frequency": 60.0},
+                               {"user_id": "2", "serial_number": "HM002", "sampling_frequency": 60.0}], start)
+        monitor.heartbeat("HM001", "1", start + timedelta(minutes=2), 60.0)
+
+        checks = [monitor.check(start + timedelta(minutes=minutes)) for minutes in (2, 3, 4, 6)]
+        monitor.heartbeat("HM002", "2", start + timedelta(minutes=7), 60.0)
+
+        expected = ([[], ["HM002"], [], ["HM001"]], 2, 1, ["HM001"])
+        actual = (checks, dispatcher.enqueue.call_count, dispatcher.recover.call_count, list(monitor.silent))
+        self.assertEqual(expected, actual)
+
+    def test_appointment_conflicts(self):
+        """
+        Test del calendari de cites: es rebutja una cita solapada (sense gastar cap ID) i es llisten les hores lliures.
+        """
+        appointments_manager = MagicMock(spec=CSVManager)
+        appointments_manager.next_id.return_value = 2
+        appointments_manager.version.return_value = (1, 1)
+        appointments_manager.iter_rows.return_value = [
+            {"user_id": "7", "doctor": "Dr. Smith", "date": "2024-12-20", "time": "14:00"},
+        ]
+        users_controller = MagicMock(spec=UserController)
+        users_controller.confirm_user_id.return_value = "1"
+        view = MagicMock(spec=View)
+        view.get_input.side_effect = ["dr.  smith", "Cardiología", "Chequeo general"]
+        calendar = AppointmentCalendar(appointments_manager, slot_minutes=30, day_start="13:00", day_end="16:00")
+
+        with patch("programa_FINAL_SeniorLife.validate_input", side_effect=["2024-12-20", "14:15"]):
+            AppointmentController(appointments_manager, users_controller, view, calendar).schedule_appointment()
+
+        expected = (0, 0, ["13:00", "13:30", "14:30", "15:00", "15:30"], None)
+        actual = (
+            appointments_manager.write.call_count,
+            appointments_manager.next_id.call_count,
+            calendar.free_slots("Dr. Smith", "2024-12-20", days=1)["2024-12-20"],
+            calendar.conflict("Dr. Smith", "1", "2024-12-20", "14:30"),
+        )
+        self.assertEqual(expected, actual)
+
+    def test_appointment_calendar_updates_in_place(self):
+        """
+        Test del calendari de cites: les cites noves s'hi insereixen sense tornar a llegir cites.csv.
+        """
+        appointments_manager = self.manager("cites.csv", indexes=("user_id",), primary_key="appointment_id",
+                                            schema={"date": "date"})
+        calendar = AppointmentCalendar(appointments_manager)
+        users_controller = MagicMock(spec=UserController)
+        users_controller.confirm_user_id.side_effect = ["1", "2", "3"]
+        view = MagicMock(spec=View)
+        view.get_input.side_effect = ["Dr. Smith", "Cardiología", "Control"] * 3
+        controller = AppointmentController(appointments_manager, users_controller, view, calendar)
+
+        with patch.object(appointments_manager, "iter_rows", wraps=appointments_manager.iter_rows) as rebuilds, \
+                patch("programa_FINAL_SeniorLife.validate_input",
+                      side_effect=["2024-12-20", "09:00", "2024-12-20", "09:30", "2024-12-20", "10:00"]):
+            for _ in range(3):
+                controller.schedule_appointment()
+
+        doctor_key = calendar._keys("Dr. Smith", "1", "2024-12-20")[0]
+        expected = (1, [540, 570, 600], 3)
+        actual = (rebuilds.call_count, calendar._starts[doctor_key], len(appointments_manager.read()))
+        self.assertEqual(expected, actual)
+
+    def test_appointment_reminders(self):
+        """
+        Test dels recordatoris per lots: una sola escriptura i cap duplicat en tornar-los a enviar.
+        """
+        appointments_manager = self.manager("cites.csv", primary_key="appointment_id", schema={"date": "date"})
+        notifications_manager = self.manager("notificacions.csv", indexes=("user_id", "reminder_key"),
+                                             primary_key="notification_id")
+        appointments_manager.append(["appointment_id", "user_id", "doctor", "specialty", "date", "time"], [
+            {"appointment_id": "1", "user_id": "1", "doctor": "Dr. Smith", "specialty": "Cardiología",
+             "date": "2024-12-20", "time": "09:00"},
+            {"appointment_id": "2", "user_id": "2", "doctor": "Dr. Smith", "specialty": "Cardiología",
+             "date": "2024-12-20", "time": "18:30"},
+            {"appointment_id": "3", "user_id": "3", "doctor": "Dr. Jones", "specialty": "Neurología",
+             "date": "2024-12-23", "time": "10:00"},
+        ])
+        controller = NotificationController(notifications_manager, MagicMock(spec=UserController),
+                                            MagicMock(spec=View), appointments_manager)
+        now = datetime(2024, 12, 19, 20, 0)
+
+        expected = (2, 0, ["Recordatori: cita amb Dr. Smith (Cardiología) el 2024-12-20 a les 09:00.",
+                           "Recordatori: cita amb Dr. Smith (Cardiología) el 2024-12-20 a les 18:30."])
+        actual = (
+            controller.send_appointment_reminders(24, now),
+            controller.send_appointment_reminders(24, now + timedelta(hours=1)),
+            [row["message"] for row in notifications_manager.read()],
+        )
+        self.assertEqual(expected, actual)
+
+    def test_notification_inbox(self):
+        """
+        Test de la safata: pàgines de la més nova a la més antiga i comptador de no llegides.
+        """
+        notifications_manager = self.manager("notificacions.csv", indexes=("user_id",), primary_key="notification_id")
+        reads_manager = self.manager("notificacions_llegides.csv", primary_key="user_id", schema={"last_read_id": "int"})
+        notifications_manager.append(["notification_id", "user_id", "message", "timestamp"], [
+            {"notification_id": str(i), "user_id": "1" if i % 2 else "2", "message": f"Missatge {i}",
+             "timestamp": f"2024-12-07T15:{i:02d}:00"}
+            for i in range(1, 10)
+        ])
+        inbox = NotificationInbox(notifications_manager, reads_manager)
+        first = inbox.page("1", limit=2)
+        inbox.mark_read("1", first["items"][0]["notification_id"])
+        version = notifications_manager.version()
+        notifications_manager.append(["notification_id", "user_id", "message", "timestamp"],
+                                     [{"notification_id": "10", "user_id": "1"}])
+        inbox.add([{"notification_id": "10", "user_id": "1"}], version)
+        second = inbox.page("1", limit=2, cursor=first["next_cursor"])
+
+        expected = (["9", "7"], 5, ["5", "3"], 1)
+        actual = (
+            [row["notification_id"] for row in first["items"]],
+            first["unread"],
+            [row["notification_id"] for row in second["items"]],
+            second["unread"],
+        )
+        self.assertEqual(expected, actual)
+
+    def test_notification_inbox_updates_in_place(self):
+        """
+        Test de la safata: les notificacions enviades s'hi afegeixen sense tornar a llegir notificacions.csv.
+        """
+        notifications_manager = self.manager("notificacions.csv", indexes=("user_id", "reminder_key"),
+                                             primary_key="notification_id")
+        notifications_manager.append(NotificationController.FIELDNAMES, [
+            {"notification_id": "1", "user_id": "1", "message": "Hola", "timestamp": "2024-12-07T15:00:00"},
+        ])
+        inbox = NotificationInbox(notifications_manager)
+        users_controller = MagicMock(spec=UserController)
+        users_controller.confirm_user_id.return_value = "1"
+        view = MagicMock(spec=View)
+        view.get_input.return_value = "Recorda la medicació"
+        controller = NotificationController(notifications_manager, users_controller, view, inbox=inbox)
+        inbox.page("1")
+
+        with patch.object(notifications_manager, "iter_rows", wraps=notifications_manager.iter_rows) as rebuilds:
+            for _ in range(3):
+                controller.send_notification()
+            page = inbox.page("1")
+
+        # La primera reserva d'ID també recorre la taula (només la columna de la clau) per inicialitzar la seqüència
+        expected = (0, ["4", "3", "2", "1"])
+        actual = (
+            sum(1 for call in rebuilds.call_args_list if call.args == (["notification_id", "user_id"],)),
+            [row["notification_id"] for row in page["items"]],
+        )
+        self.assertEqual(expected, actual)
+
+    def test_view_inbox_marks_read_after_last_page(self):
+        """
+        Test de la safata al menú: les notificacions només es marquen com a llegides si s'han vist totes les pàgines.
+        """
+        inbox = MagicMock(spec=NotificationInbox)
+        inbox.page.side_effect = lambda user_id, limit, cursor=None: {
+            None: {"items": [{"notification_id": "9"}, {"notification_id": "7"}], "next_cursor": "7", "unread": 3},
+            "7": {"items": [{"notification_id": "5"}], "next_cursor": None, "unread": 3},
+        }[cursor]
+        users_controller = MagicMock(spec=UserController)
+        users_controller.confirm_user_id.return_value = "1"
+        controller = NotificationController(MagicMock(spec=CSVManager), users_controller, self.view, inbox=inbox)
+        self.view.get_input.return_value = "n"
+        controller.view_inbox(page_size=2)
+        stopped = inbox.mark_read.call_count
+        self.view.get_input.return_value = "s"
+        controller.view_inbox(page_size=2)
+
+        expected = (0, 1, ("1", "9"))
+        actual = (stopped, inbox.mark_read.call_count, inbox.mark_read.call_args.args)
+        self.assertEqual(expected, actual)
+
+    def test_social_network_members(self):
+        """
+        Test de la taula de membres: migració de la columna `members` (que es conserva si l'escriptura falla) i
+        altes amb comptador incremental.
+        """
+        networks_manager = self.manager("xarxes_socials.csv", primary_key="network_id",
+                                        schema={"members_count": "int", "members": "pyliteral"})
+        members_manager = self.manager("membres_xarxes.csv", indexes=("network_id", "dni"),
+                                       schema={"phones": "strlist", "details": "json"})
+        # Fila amb el format antic de xarxes_socials.csv: els detalls són claus soltes del membre
+        with open(os.path.join(self.data_dir, "xarxes_socials.csv"), mode="w", newline="", encoding="utf-8") as file:
+            file.write("network_id,title,creation_date,members_count,members\n"
+                       "1,Family Group,2024-12-01,1,\"[{'name': 'Alice Smith', 'dni': '12345678A', "
+                       "'phones': ['123-456-789'], 'role': 'Família', 'relationship': 'Germana', "
+                       "'gender': 'Dona', 'birth_date': '1990-01-01'}]\"\n")
+        with patch.object(members_manager, "compact"):  # compact() només informa dels errors
+            failed = migrate_social_members(networks_manager, members_manager)
+        self.assertEqual((0, 1), (failed, len(networks_manager.find_one("network_id", "1")["members"])))
+        migrated = migrate_social_members(networks_manager, members_manager)
+        controller = SocialNetworkController(networks_manager, self.users_controller, self.view, members_manager)
+        member = Factory.create_social_member("Pere", "87654321B", ["600333444"], "amic", relationship="veí")
+        controller.add_member(networks_manager.find_one("network_id", "1"), "1", member)
+        controller.add_member(networks_manager.find_one("network_id", "1"), "1", member)
+
+        expected = (1, ["12345678A", "87654321B"],
+                    {"relationship": "Germana", "gender": "Dona", "birth_date": "1990-01-01"}, 2, [])
+        network = networks_manager.find_one("network_id", "1")
+        members = controller.network_members("1")
+        actual = (
+            migrated,
+            [row["dni"] for row in members],
+            members[0]["details"],
+            network["members_count"],
+            network["members"],
+        )
+        self.assertEqual(expected, actual)
+
+    def test_care_network_index(self):
+        """
+        Test de l'índex invers: xarxes d'un DNI i telèfon del personal sanitari per a les alertes (els membres
+        nous s'hi afegeixen sense tornar a llegir la taula).
+        """
+        networks_manager = self.manager("xarxes_socials.csv", primary_key="network_id", schema={"members_count": "int"})
+        members_manager = self.manager("membres_xarxes.csv", indexes=("network_id", "dni"),
+                                       schema={"phones": "strlist", "details": "json"})
+        networks_manager.append(SocialNetworkController.NETWORK_FIELDNAMES, [
+            {"network_id": "1", "title": "Cures", "creation_date": "07-Dec-2024", "members_count": 0},
+            {"network_id": "2", "title": "Família", "creation_date": "07-Dec-2024", "members_count": 0},
+        ])
+        members_manager.append(SocialNetworkController.MEMBER_FIELDNAMES, [
+            {"network_id": "1", "user_id": "3", **Factory.create_social_member("Marta", "1A", ["611"], "Infermer")},
+        ])
+        care_index = CareNetworkIndex(members_manager)
+        controller = SocialNetworkController(networks_manager, self.users_controller, self.view,
+                                             members_manager, care_index)
+        care_index.networks_of("1A")
+        with patch.object(members_manager, "iter_rows", wraps=members_manager.iter_rows) as rebuilds:
+            controller.add_member(networks_manager.find_one("network_id", "1"), "3",
+                                  Factory.create_social_member("Joan", "2B", ["622", "633"], "Metge"))
+            controller.add_member(networks_manager.find_one("network_id", "2"), "4",
+                                  Factory.create_social_member("Joan", "2B", ["622"], "Família"))
+        alerts_manager = MagicMock(spec=CSVManager)
+        dispatcher = AlertDispatcher(alerts_manager, care_index=care_index)
+
+        expected = (0, [("1", "Metge"), ("2", "Família")], "622", "")
+        actual = (
+            rebuilds.call_count,
+            [(entry["network_id"], entry["role"]) for entry in care_index.networks_of("2B")],
+            dispatcher.contact_resolver("3"),
+            dispatcher.contact_resolver("4"),
+        )
+        self.assertEqual(expected, actual)
 
 
 # Ejecutar las pruebas